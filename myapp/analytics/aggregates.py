@@ -0,0 +1,242 @@
+import threading
+from bisect import bisect_right
+from collections import Counter, OrderedDict, deque
+
+# Upper bounds (seconds) of the dwell time histogram buckets, the last bucket is open
+DWELL_BUCKETS = (5, 15, 30, 60, 120, 300)
+DWELL_LABELS = ("<5s", "5-15s", "15-30s", "30-60s", "1-2min", "2-5min", ">5min")
+
+
+class _DocAggregate:
+    __slots__ = (
+        "clicks", "impressions", "queries", "dwell_count", "dwell_sum", "dwell_histogram", "recent_dwell", "abandoned",
+    )
+
+    def __init__(self, max_recent):
+        self.clicks = 0
+        self.impressions = 0
+        # query -> times the document was shown for it
+        self.queries = {}
+        self.dwell_count = 0
+        self.dwell_sum = 0.0
+        self.dwell_histogram = [0] * len(DWELL_LABELS)
+        self.recent_dwell = deque(maxlen=max_recent)
+        # Clicks whose session ended before the user came back (censored dwell, not in the averages)
+        self.abandoned = 0
+
+
+class _QueryAggregate:
+    __slots__ = ("count", "num_terms", "docs")
+
+    def __init__(self, num_terms):
+        self.count = 0
+        self.num_terms = num_terms
+        # doc ids shown for the query, in the order they were first shown
+        self.docs = {}
+
+
+class _MissionAggregate:
+    __slots__ = ("session_id", "queries", "num_queries", "unique", "start", "end")
+
+    def __init__(self, session_id, timestamp, max_recent):
+        self.session_id = session_id
+        self.queries = deque(maxlen=max_recent)
+        self.num_queries = 0
+        self.unique = set()
+        self.start = timestamp
+        self.end = timestamp
+
+
+class Aggregates:
+    """
+    Analytics counters kept up to date as the events are saved, so the stats pages read them instead of
+    scanning the fact lists.
+    Every add_*() is O(1): per-document clicks, impressions, related queries and dwell (count, sum,
+    histogram), per-query counts and returned documents, per-mission queries and time span, and the
+    global totals. HTTP requests count for their sampling weight (see RequestPolicy).
+    The lists that would grow with the traffic (related queries, returned documents, recent dwell
+    times, queries of a mission) keep at most `max_related` entries, only the last `max_missions`
+    missions and the `max_queries` most recently searched queries are kept (the totals still count
+    all of them).
+    The views (document_stats, query_stats, ...) cost O(distinct documents / kept queries / kept
+    missions), not O(events).
+    """
+
+    def __init__(self, max_related=20, max_missions=1_000, max_queries=1_000):
+        """
+        :param max_related: entries kept in each per-document / per-query / per-mission list
+        :param max_missions: missions kept for the missions view
+        :param max_queries: queries kept for the queries view, the least recently searched are dropped
+        """
+        self.max_related = max_related
+        self.max_missions = max_missions
+        self.max_queries = max_queries
+        self._lock = threading.Lock()
+        self.docs = {}
+        self.queries = OrderedDict()
+        self.missions = OrderedDict()
+        self.total_queries = 0
+        self.total_clicks = 0
+        self.total_docs_clicked = 0
+        self.total_dwell_events = 0
+        self.total_dwell_time = 0.0
+        self.total_abandoned = 0
+        self.total_missions = 0
+        self.total_mission_queries = 0
+        self.total_requests = 0
+        self.method_counts = Counter()
+        self.user_agent_counts = Counter()
+
+    def _doc(self, doc_id):
+        doc = self.docs.get(doc_id)
+        if doc is None:
+            doc = self.docs[doc_id] = _DocAggregate(self.max_related)
+        return doc
+
+    # Events
+    def add_http(self, method, user_agent, weight=1.0):
+        """A recorded request standing for `weight` requests (1 / sampling rate)."""
+        with self._lock:
+            self.total_requests += weight
+            self.method_counts[method] += weight
+            self.user_agent_counts[user_agent] += weight
+
+    def add_query(self, session_id, query, num_terms, mission_id, timestamp):
+        with self._lock:
+            self.total_queries += 1
+            aggregate = self.queries.get(query)
+            if aggregate is None:
+                aggregate = self.queries[query] = _QueryAggregate(num_terms)
+                if len(self.queries) > self.max_queries:
+                    self.queries.popitem(last=False)
+            else:
+                self.queries.move_to_end(query)
+            aggregate.count += 1
+            if mission_id is None:
+                return
+            mission = self.missions.get(mission_id)
+            if mission is None:
+                mission = self.missions[mission_id] = _MissionAggregate(session_id, timestamp, self.max_related)
+                self.total_missions += 1
+                if len(self.missions) > self.max_missions:
+                    self.missions.popitem(last=False)
+            mission.queries.append(query)
+            mission.num_queries += 1
+            if len(mission.unique) < self.max_related:
+                mission.unique.add(query)
+            mission.start = min(mission.start, timestamp)
+            mission.end = max(mission.end, timestamp)
+            self.total_mission_queries += 1
+
+    def add_impression(self, query, doc_id):
+        with self._lock:
+            doc = self._doc(doc_id)
+            doc.impressions += 1
+            if query in doc.queries or len(doc.queries) < self.max_related:
+                doc.queries[query] = doc.queries.get(query, 0) + 1
+            aggregate = self.queries.get(query)
+            if aggregate is not None and len(aggregate.docs) < self.max_related:
+                aggregate.docs[doc_id] = None
+
+    def add_click(self, doc_id):
+        with self._lock:
+            doc = self._doc(doc_id)
+            if not doc.clicks:
+                self.total_docs_clicked += 1
+            doc.clicks += 1
+            self.total_clicks += 1
+
+    def add_dwell(self, doc_id, dwell_time, censored=False):
+        """censored dwell times (the user did not come back) are counted apart, not in the histogram and averages"""
+        with self._lock:
+            doc = self._doc(doc_id)
+            if censored:
+                doc.abandoned += 1
+                self.total_abandoned += 1
+                return
+            doc.dwell_count += 1
+            doc.dwell_sum += dwell_time
+            doc.dwell_histogram[bisect_right(DWELL_BUCKETS, dwell_time)] += 1
+            doc.recent_dwell.append(dwell_time)
+            self.total_dwell_events += 1
+            self.total_dwell_time += dwell_time
+
+    # Views
+    def document_stats(self):
+        """Documents with clicks, most clicked first."""
+        with self._lock:
+            stats = [
+                {
+                    "doc_id": doc_id,
+                    "clicks": doc.clicks,
+                    "impressions": doc.impressions,
+                    "related_queries": list(doc.queries),
+                    "dwell_times": list(doc.recent_dwell),
+                    "dwell_histogram": dict(zip(DWELL_LABELS, doc.dwell_histogram)),
+                    "avg_dwell_time": doc.dwell_sum / doc.dwell_count if doc.dwell_count else 0,
+                    "abandoned": doc.abandoned,
+                }
+                for doc_id, doc in self.docs.items() if doc.clicks
+            ]
+        stats.sort(key=lambda x: x["clicks"], reverse=True)
+        return stats
+
+    def query_stats(self):
+        with self._lock:
+            return {
+                "total_queries": self.total_queries,
+                "queries": [
+                    {"query": query, "num_terms": aggregate.num_terms, "count": aggregate.count}
+                    for query, aggregate in self.queries.items()
+                ],
+                "query_results": {query: list(aggregate.docs) for query, aggregate in self.queries.items()},
+            }
+
+    def mission_stats(self):
+        """Kept missions in start order, and the summary over all the missions."""
+        with self._lock:
+            missions = [
+                {
+                    "mission_id": mission_id,
+                    "session_id": mission.session_id,
+                    "queries": list(mission.queries),
+                    "num_queries": mission.num_queries,
+                    "unique_queries": len(mission.unique),
+                    "start": mission.start,
+                    "end": mission.end,
+                    "duration_seconds": (mission.end - mission.start).total_seconds(),
+                }
+                for mission_id, mission in self.missions.items()
+            ]
+            summary = {
+                "total_missions": self.total_missions,
+                "avg_queries_per_mission": (
+                    self.total_mission_queries / self.total_missions if self.total_missions else 0
+                ),
+            }
+        missions.sort(key=lambda x: x["start"])
+        return {"summary": summary, "missions": missions}
+
+    def summary(self):
+        with self._lock:
+            return {
+                "total_clicks": self.total_clicks,
+                "total_docs_clicked": self.total_docs_clicked,
+                "total_dwell_events": self.total_dwell_events,
+                "total_dwell_time": self.total_dwell_time,
+                "total_abandoned": self.total_abandoned,
+                "avg_dwell_time": (
+                    self.total_dwell_time / self.total_dwell_events if self.total_dwell_events else 0
+                ),
+                "total_queries": self.total_queries,
+                "unique_queries": len(self.queries),
+                "total_requests": round(self.total_requests),
+            }
+
+    def http_stats(self):
+        with self._lock:
+            return {
+                "total_requests": round(self.total_requests),
+                "method_counts": {method: round(count) for method, count in self.method_counts.items()},
+                "user_agent_counts": {agent: round(count) for agent, count in self.user_agent_counts.items()},
+            }
@@ -1,11 +1,16 @@
+import hashlib
 import json
 import random
+import time
 import altair as alt
 import pandas as pd
-import requests
-from myapp.search.algorithms import _tokenize
-import math
+from myapp.analytics.aggregates import Aggregates
+from myapp.analytics.event_log import EventLog
+from myapp.analytics.geolocation import GeoLocator
+from myapp.analytics.missions import MissionIndex
+from myapp.analytics.sessions import SessionStore
 import uuid
+from collections import deque
 
 class AnalyticsData:
     """
@@ -16,33 +21,53 @@ class AnalyticsData:
     - Results analytics (ranking, shown docs)
     - Document clicks analytics
     - Dwell time tracking
+    fact_results holds impressions (results shown on a rendered page), not whole rankings.
+    The fact lists only keep the last max_events events in memory; every event is also appended to
+    the event log, which writes them to disk in the background (see EventLog). The event log times are
+    Unix seconds (time.time()); the "timestamp" of the in-memory events is the same time, local.
+    The stats views are read from counters updated as the events are saved (see Aggregates).
+    Sessions end after session_timeout seconds without activity (or when more than max_sessions are
+    open): their pending dwell time is saved as censored (the user did not come back from the document)
+    and the session is written to the event log.
     """
 
-    def __init__(self):
+    def __init__(self, geolocator=None, event_log=None, max_events=10_000, aggregates=None, missions=None,
+                 session_timeout=30 * 60, max_sessions=100_000):
+        # IP locations come from a local database, resolved off the request path (see GeoLocator)
+        self.geolocator = geolocator if geolocator is not None else GeoLocator()
+        self.event_log = event_log if event_log is not None else EventLog()
+        self.aggregates = aggregates if aggregates is not None else Aggregates()
+        self.missions = missions if missions is not None else MissionIndex()
         self.fact_clicks = {}
-        self.fact_queries = []
-        self.fact_results = []
-        self.fact_dwell = []
-        self.fact_http = []
-        self.fact_sessions = {}
-        self.last_click = {}
+        self.fact_queries = deque(maxlen=max_events)
+        self.fact_results = deque(maxlen=max_events)
+        self.fact_dwell = deque(maxlen=max_events)
+        self.fact_http = deque(maxlen=max_events)
+        # Last query id, used as the id of the next query; it goes on from the ids already in the event
+        # log so that they stay unique across restarts (the reports join on them)
+        rows = self.event_log.query("SELECT MAX(query_id) FROM queries")
+        self.num_queries = (rows[0][0] or 0) if rows else 0
+        self.fact_sessions = SessionStore(
+            idle_timeout=session_timeout,
+            max_sessions=max_sessions,
+            on_expire=self._end_session,
+        )
 
     def get_location(self, ip: str):
-        if ip.startswith("127.") or ip == "localhost":
-            return "Localhost", "Localhost"
-        try:
-            res = requests.get(f"http://ip-api.com/json/{ip}", timeout=2)
-            data = res.json()
-            if data.get("status") == "success":
-                return data.get("city", "Unknown"), data.get("country", "Unknown")
-        except:
-            pass
-        return "Unknown", "Unknown"
-
-    def save_http_request(self, request, session_id: str):
+        """(city, country) of the IP, from the local database (blocking)."""
+        return self.geolocator.resolve(ip)
+
+    def save_http_request(self, request, session_id: str, weight=1.0):
+        """
+        Save a request of the session.
+        weight: requests this one stands for when its route is sampled (see RequestPolicy)
+        """
         ip = request.remote_addr
-        city, country = self.get_location(ip)
+        # Cached (or local) locations are known now, the others are backfilled by the geolocation thread
+        location = self.geolocator.lookup(ip)
+        city, country = location if location is not None else ("Unknown", "Unknown")
 
+        ts = time.time()
         event = {
             "session_id": session_id,
             "path": request.path,
@@ -51,103 +76,112 @@ class AnalyticsData:
             "city": city,
             "country": country,
             "user_agent": str(request.user_agent),
-            "timestamp": pd.Timestamp.now(),
+            "weight": weight,
+            "ts": ts,
+            "timestamp": pd.Timestamp.fromtimestamp(ts),
         }
         self.fact_http.append(event)
+        self.aggregates.add_http(event["method"], event["user_agent"], weight)
 
         # Update session
-        if session_id not in self.fact_sessions:
-            self.fact_sessions[session_id] = {
-                "start": event["timestamp"],
+        session = self._session(session_id, ts, city, country)
+        session["num_requests"] += 1
+        if location is not None and session.get("city", "Unknown") == "Unknown":
+            session["city"] = city
+            session["country"] = country
+
+        if location is None:
+            # Logged once the location is known
+            self.geolocator.enqueue(ip, lambda city, country: self._backfill_location(event, session_id, city, country))
+        else:
+            self._log_http(event)
+
+    def _backfill_location(self, event, session_id, city, country):
+        """Called by the geolocation thread once the IP of a saved request is resolved."""
+        event["city"] = city
+        event["country"] = country
+        session = self.fact_sessions.get(session_id)
+        if session is not None and session.get("city", "Unknown") == "Unknown":
+            session["city"] = city
+            session["country"] = country
+        self._log_http(event)
+
+    def _log_http(self, event):
+        self.event_log.append("http", (
+            event["session_id"], event["path"], event["method"], event["ip"], event["city"],
+            event["country"], event["user_agent"], event["ts"], event["weight"],
+        ))
+
+    # Sessions
+    def _session(self, session_id, timestamp, city="Unknown", country="Unknown"):
+        """The session, created when it is not open (its times are Unix seconds)."""
+        session = self.fact_sessions.get(session_id)
+        if session is None:
+            session = {
+                "start": timestamp,
+                "last_activity": timestamp,
                 "num_requests": 0,
                 "num_queries": 0,
                 "city": city,
                 "country": country,
                 "missions": [],
             }
-        self.fact_sessions[session_id]["num_requests"] += 1
+            self.fact_sessions[session_id] = session
+        return session
+
+    def start_session(self):
+        """Id of a new session, open from now."""
+        session_id = str(uuid.uuid4())
+        self._session(session_id, time.time())
+        return session_id
 
-    # Sessions
     def update_physical_session(self, session_id: str):
-        now = pd.Timestamp.now()
+        """
+        Id of the session the request belongs to: session_id while it is open, a new one when it
+        ended (idle for too long, or already expired and written to the event log).
+        """
+        now = time.time()
         session = self.fact_sessions.get(session_id)
-        if session:
-            last_time = session.get("last_activity", session["start"])
-            if (now - last_time).total_seconds() > 1800:
-                # Create new session ID for this sit-down
-                import uuid
-                new_session_id = str(uuid.uuid4())
-                self.fact_sessions[new_session_id] = {
-                    "start": now,
-                    "num_requests": 0,
-                    "num_queries": 0,
-                    "last_activity": now,
-                }
-                return new_session_id
-            else:
-                session["last_activity"] = now
+        if session is None:
+            # Ended by another request (or a restart): its row is written, do not reuse the id
+            session_id = self.start_session()
+        elif now - session.get("last_activity", session["start"]) > self.fact_sessions.idle_timeout:
+            # The previous sit-down is over: end it and create new session ID for this one
+            self.fact_sessions.end(session_id, "idle")
+            session_id = self.start_session()
+        else:
+            session["last_activity"] = now
+            self.fact_sessions.touch(session_id)
+        # End the other sessions idle for too long
+        self.fact_sessions.expire()
         return session_id
 
+    def _end_session(self, session_id, session, reason):
+        """Called by the session store when a session ends."""
+        end = session.get("last_activity", session["start"])
+        last_click = session.pop("last_click", None)
+        if last_click is not None:
+            # The user did not come back from the document: the dwell time is unknown (censored), at
+            # least the time until the last activity seen
+            doc_id, click_time = last_click
+            self._save_dwell(session_id, doc_id, max(end - click_time, 0.0), censored=True)
+        self.event_log.append("sessions", (
+            session_id, session["start"], end, session.get("num_requests", 0),
+            session.get("num_queries", 0), len(session.get("missions", ())), session.get("city", "Unknown"),
+            session.get("country", "Unknown"), reason, time.time(),
+        ))
+        self.missions.forget(session_id)
+
     def assign_mission(self, session_id: str, query: str):
         session = self.fact_sessions.get(session_id)
         if not session:
             return None
 
-        # Helpers per TF i cosinus -
-        def build_tf(tokens):
-            tf = {}
-            for t in tokens:
-                tf[t] = tf.get(t, 0) + 1
-            return tf
-
-        def cosine_sim(tf1, tf2):
-            if not tf1 or not tf2:
-                return 0.0
-            common = set(tf1.keys()) & set(tf2.keys())
-            num = sum(tf1[t] * tf2[t] for t in common)
-            den1 = math.sqrt(sum(v * v for v in tf1.values()))
-            den2 = math.sqrt(sum(v * v for v in tf2.values()))
-            if den1 == 0 or den2 == 0:
-                return 0.0
-            return num / (den1 * den2)
-
-        # Preprocess the actual query
-        now = pd.Timestamp.now()
-        current_tokens = _tokenize(query)
-        current_tf = build_tf(current_tokens)
-
-        TIME_WINDOW_SECONDS = 2 * 60 * 60
-        SIM_THRESHOLD = 0.35
-
-        previous_queries = [
-            q for q in self.fact_queries
-            if q["session_id"] == session_id and "mission_id" in q
-        ]
-
-        best_sim = 0.0
-        best_mission_id = None
-
-        for q in previous_queries:
-            if (now - q["timestamp"]).total_seconds() > TIME_WINDOW_SECONDS:
-                continue
-
-            prev_tokens = _tokenize(q["query"])
-            prev_tf = build_tf(prev_tokens)
-            sim = cosine_sim(current_tf, prev_tf)
-
-            if sim > best_sim:
-                best_sim = sim
-                best_mission_id = q["mission_id"]
-
-        if best_mission_id is None or best_sim < SIM_THRESHOLD:
-            mission_id = str(uuid.uuid4())
-        else:
-            mission_id = best_mission_id
-
+        # Compared with the recent queries of the session only (see MissionIndex)
+        mission_id = self.missions.assign(session_id, query)
 
         # Save query
-        event = self.save_query(session_id, query)
-        event["mission_id"] = mission_id
+        event = self.save_query(session_id, query, mission_id)
 
         if "missions" not in session:
             session["missions"] = []
@@ -158,44 +192,61 @@ class AnalyticsData:
         return mission_id
 
     # QUERIES
-    def save_query(self, session_id: str, query: str):
+    def save_query(self, session_id: str, query: str, mission_id: str = None):
         """
         Save query with metadata: terms, order, timestamp.
         """
         terms = query.split()
+        self.num_queries += 1
+        ts = time.time()
         event = {
             "session_id": session_id,
             "query": query,
             "num_terms": len(terms),
             "terms": terms,
-            "timestamp": pd.Timestamp.now(),
+            "timestamp": pd.Timestamp.fromtimestamp(ts),
         }
+        if mission_id is not None:
+            event["mission_id"] = mission_id
         self.fact_queries.append(event)
+        self.aggregates.add_query(session_id, query, len(terms), mission_id, event["timestamp"])
+        self.event_log.append("queries", (
+            session_id, self.num_queries, query, len(terms), mission_id, ts,
+        ))
 
-        if session_id not in self.fact_sessions:
-            self.fact_sessions[session_id] = {"start": event["timestamp"],
-                                              "num_requests": 0,
-                                              "num_queries": 0}
-
-        self.fact_sessions[session_id]["num_queries"] += 1
+        self._session(session_id, ts)["num_queries"] += 1
         return event
 
     # RESULTS
-    def save_results(self, session_id: str, query: str, results):
+    def save_results(self, session_id: str, query: str, results, query_id=None, page=1, per_page=None,
+                     ranking_key=None):
         """
-        Save ranked results returned for a query.
-        results: list of (doc_id, rank)
+        Save the impressions of a results page: the results actually shown, with their rank.
+        results: RankedResults handle returned by the search engine
+        page / per_page: page rendered (all the ranked results when per_page is None)
+        ranking_key: result cache key of the search (SearchEngine.ranking_key), logged with a hash of the
+            query so the full ranking can be recomputed for offline analysis
         """
-        timestamp = pd.Timestamp.now()
+        ts = time.time()
+        timestamp = pd.Timestamp.fromtimestamp(ts)
+        start = (page - 1) * per_page if per_page else 0
+        shown = results.pids[start:start + per_page] if per_page else results.pids
 
-        for doc_id, rank in results:
+        for rank, doc_id in enumerate(shown, start + 1):
             self.fact_results.append({
                 "session_id": session_id,
+                "query_id": query_id,
                 "query": query,
+                "page": page,
                 "doc_id": doc_id,
                 "rank": rank,
                 "timestamp": timestamp
             })
+            self.event_log.append("impressions", (session_id, query_id, query, page, doc_id, rank, ts))
+            self.aggregates.add_impression(query, doc_id)
+
+        query_hash = hashlib.sha1(" ".join(query.lower().split()).encode("utf-8")).hexdigest()
+        self.event_log.append("searches", (session_id, query_id, page, query_hash, ranking_key, results.total_hits, ts))
 
     # DOCUMENT CLICKS
     def save_doc_click(self, session_id: str, doc_id: str, title: str, description: str):
@@ -206,17 +257,20 @@ class AnalyticsData:
         if doc_id not in self.fact_clicks:
             self.fact_clicks[doc_id] = 0
         self.fact_clicks[doc_id] += 1
+        self.aggregates.add_click(doc_id)
 
         # Start dwell timing
-        self.last_click[session_id] = (doc_id, pd.Timestamp.now())
+        ts = time.time()
+        self._session(session_id, ts)["last_click"] = (doc_id, ts)
 
         event = {
             "session_id": session_id,
             "doc_id": doc_id,
             "title": title,
             "description": description,
-            "timestamp": pd.Timestamp.now()
+            "timestamp": pd.Timestamp.fromtimestamp(ts)
         }
+        self.event_log.append("clicks", (session_id, doc_id, ts))
 
         return event
 
@@ -226,21 +280,28 @@ class AnalyticsData:
         Called when returning to results page:
         Computes dwell time since last document click.
         """
-        if session_id not in self.last_click:
+        session = self.fact_sessions.get(session_id)
+        if session is None or "last_click" not in session:
             return None
 
-        doc_id, click_time = self.last_click[session_id]
-        dwell = (pd.Timestamp.now() - click_time).total_seconds()
+        doc_id, click_time = session.pop("last_click")
+        dwell = time.time() - click_time
+        return self._save_dwell(session_id, doc_id, dwell)
 
+    def _save_dwell(self, session_id, doc_id, dwell, censored=False):
+        """censored: the session ended before the user came back, `dwell` is only a lower bound"""
+        ts = time.time()
         event = {
             "session_id": session_id,
             "doc_id": doc_id,
             "dwell_time": dwell,
-            "timestamp": pd.Timestamp.now()
+            "censored": censored,
+            "timestamp": pd.Timestamp.fromtimestamp(ts)
         }
 
         self.fact_dwell.append(event)
-        del self.last_click[session_id]
+        self.aggregates.add_dwell(doc_id, dwell, censored)
+        self.event_log.append("dwell", (session_id, doc_id, dwell, ts, int(censored)))
 
         return event
 
@@ -271,56 +332,15 @@ class AnalyticsData:
         """
         Returns a list of documents with clicks, related queries, dwell times, and average dwell.
         """
-        stats = []
-        for doc_id, clicks in self.fact_clicks.items():
-            related_queries = [
-                log["query"] for log in self.fact_results if log["doc_id"] == doc_id
-            ]
-            dwell_times = [
-                log["dwell_time"] for log in self.fact_dwell if log["doc_id"] == doc_id
-            ]
-            avg_dwell = sum(dwell_times)/len(dwell_times) if dwell_times else 0
-
-            stats.append({
-                "doc_id": doc_id,
-                "clicks": clicks,
-                "related_queries": related_queries,
-                "dwell_times": dwell_times,
-                "avg_dwell_time": avg_dwell
-            })
-
-        # Sort by clicks descending
-        stats.sort(key=lambda x: x["clicks"], reverse=True)
-        return stats
+        return self.aggregates.document_stats()
 
     # QUERY STATS
     def get_query_stats(self):
-        aggregated = {}
-
-        for q in self.fact_queries:
-            text = q["query"]
-            if text not in aggregated:
-                aggregated[text] = {
-                    "query": text,
-                    "num_terms": q.get("num_terms", len(q.get("terms", []))),
-                    "count": 1,
-                }
-            else:
-                aggregated[text]["count"] += 1
-
-        queries_list = list(aggregated.values())
-
-        query_results_map = {}
-        for q_text in aggregated.keys():
-            query_results_map[q_text] = [
-                r["doc_id"] for r in self.fact_results if r["query"] == q_text
-            ]
-
-        return {
-            "total_queries": len(self.fact_queries),
-            "queries": queries_list,
-            "query_results": query_results_map,
-        }
+        return self.aggregates.query_stats()
+
+    # MISSION STATS
+    def get_mission_stats(self):
+        return self.aggregates.mission_stats()
 
 
 class ClickedDoc:
@@ -0,0 +1,217 @@
+import json
+import os
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+from myapp.analytics.event_log import SCHEMAS
+
+_NUMPY_TYPES = {"TEXT": str, "INTEGER": np.int64, "REAL": np.float64}
+# Stored in place of NULL, the columns have a fixed dtype
+_MISSING = {"TEXT": "", "INTEGER": -1, "REAL": np.nan}
+
+
+class ColumnarStore:
+    """
+    The event log tables (see EventLog) copied to columnar files for the reports.
+    Each table is partitioned by day: <root>/<table>/<YYYY-MM-DD>/<first rowid>.npz, one array per
+    column plus the sorted session ids of the part. manifest.json keeps, per table, the last rowid
+    copied and the time range of every part.
+    scan() prunes the parts with the time range of the manifest and the session ids of the part,
+    then loads only the columns asked for (a .npz reads its arrays lazily).
+    sync() copies the rows logged since the last call, so it costs O(new events); the parts of a day
+    are merged into one when there are more than `max_parts`. The manifest is saved before the merged
+    parts are deleted, so it never points to a missing file.
+    With a `sync_interval`, sync() runs in a background thread and the reports never wait for it (they
+    lag behind the event log by at most the interval).
+    """
+
+    def __init__(self, root, event_log, batch_size=100_000, max_parts=16, sync_interval=None):
+        """
+        :param root: directory of the partitions
+        :param event_log: EventLog the rows are read from
+        :param batch_size: rows read from the event log at once
+        :param max_parts: parts of a day before they are merged
+        :param sync_interval: seconds between two syncs of the background thread, None for no thread
+        """
+        self.root = root
+        self.event_log = event_log
+        self.batch_size = batch_size
+        self.max_parts = max_parts
+        self.sync_interval = sync_interval
+        self._lock = threading.Lock()
+        self._manifest_path = os.path.join(root, "manifest.json")
+        self.manifest = {}
+        if os.path.exists(self._manifest_path):
+            with open(self._manifest_path) as f:
+                self.manifest = json.load(f)
+        self._stop = threading.Event()
+        self._syncer = None
+        if sync_interval:
+            self._syncer = threading.Thread(target=self._run, name="columnar-sync", daemon=True)
+            self._syncer.start()
+
+    def _table(self, table):
+        return self.manifest.setdefault(table, {"last_rowid": 0, "parts": []})
+
+    def _save_manifest(self):
+        tmp = self._manifest_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.manifest, f)
+        os.replace(tmp, self._manifest_path)
+
+    @staticmethod
+    def _columns(table, rows, offset=0):
+        """{column: array} of SQLite rows, the column values starting at rows[i][offset]."""
+        columns = {}
+        for i, (name, kind) in enumerate(SCHEMAS[table]):
+            missing = _MISSING[kind]
+            values = [missing if row[offset + i] is None else row[offset + i] for row in rows]
+            columns[name] = np.array(values, dtype=_NUMPY_TYPES[kind])
+        return columns
+
+    def _write_part(self, table, day, first_rowid, columns, suffix=""):
+        directory = os.path.join(self.root, table, day)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"{first_rowid}{suffix}.npz")
+        sessions = np.unique(columns["session_id"])
+        np.savez(path, __sessions=sessions, **columns)
+        ts = columns["ts"]
+        return {
+            "day": day,
+            "first_rowid": first_rowid,
+            "path": os.path.relpath(path, self.root),
+            "rows": int(len(ts)),
+            "min_ts": float(ts.min()),
+            "max_ts": float(ts.max()),
+        }
+
+    def sync(self):
+        """Copy the new rows of the event log; returns how many were copied."""
+        copied = 0
+        with self._lock:
+            for table in SCHEMAS:
+                meta = self._table(table)
+                while True:
+                    rows = self.event_log.query(
+                        f"SELECT rowid, * FROM {table} WHERE rowid > ? ORDER BY rowid LIMIT ?",
+                        (meta["last_rowid"], self.batch_size),
+                    )
+                    if not rows:
+                        break
+                    columns = self._columns(table, rows, offset=1)
+                    rowids = np.array([row[0] for row in rows], dtype=np.int64)
+                    days = pd.to_datetime(columns["ts"], unit="s").strftime("%Y-%m-%d").to_numpy()
+                    for day in np.unique(days):
+                        selected = days == day
+                        part = {name: values[selected] for name, values in columns.items()}
+                        meta["parts"].append(self._write_part(table, day, int(rowids[selected][0]), part))
+                    # The new parts and the last rowid are saved together, then the days are compacted
+                    meta["last_rowid"] = int(rowids[-1])
+                    copied += len(rows)
+                    self._save_manifest()
+                    for day in np.unique(days):
+                        self._compact(table, day)
+                    if len(rows) < self.batch_size:
+                        break
+        return copied
+
+    def _compact(self, table, day):
+        """Merge the parts of a day into one when there are too many."""
+        meta = self._table(table)
+        parts = [part for part in meta["parts"] if part["day"] == day]
+        if len(parts) <= self.max_parts:
+            return
+        names = [name for name, _ in SCHEMAS[table]]
+        loaded = [np.load(os.path.join(self.root, part["path"])) for part in parts]
+        columns = {name: np.concatenate([data[name] for data in loaded]) for name in names}
+        for data in loaded:
+            data.close()
+        first_rowid = min(part["first_rowid"] for part in parts)
+        # A new file name: the part starting at first_rowid is one of the merged ones
+        merged = self._write_part(table, day, first_rowid, columns, suffix=f"-{int(time.time() * 1000)}")
+        meta["parts"] = [part for part in meta["parts"] if part["day"] != day] + [merged]
+        # The manifest no longer points to the merged parts before they are deleted
+        self._save_manifest()
+        for part in parts:
+            os.remove(os.path.join(self.root, part["path"]))
+
+    def _run(self):
+        while not self._stop.wait(self.sync_interval):
+            try:
+                self.sync()
+            except Exception as e:
+                print(f"ColumnarStore: sync failed: {e}")
+
+    def close(self):
+        """Stop the background sync (after a last one)."""
+        self._stop.set()
+        if self._syncer is not None:
+            self._syncer.join(timeout=10)
+            self._syncer = None
+            self.sync()
+
+    @staticmethod
+    def _column(table, data, name, rows):
+        """Column of a part; parts written before a column was added get its NULL value."""
+        if name in data.files:
+            return data[name]
+        kind = dict(SCHEMAS[table])[name]
+        return np.full(rows, _MISSING[kind], dtype=_NUMPY_TYPES[kind])
+
+    def scan(self, table, columns=None, start=None, end=None, session_id=None):
+        """
+        Rows of `table` as a DataFrame.
+        :param columns: columns to load, all of them by default
+        :param start: Unix seconds, rows with ts >= start
+        :param end: Unix seconds, rows with ts < end
+        :param session_id: rows of this session only
+        """
+        names = [name for name, _ in SCHEMAS[table]]
+        columns = list(columns) if columns else names
+        with self._lock:
+            parts = list(self._table(table)["parts"])
+        frames = []
+        for part in parts:
+            if start is not None and part["max_ts"] < start:
+                continue
+            if end is not None and part["min_ts"] >= end:
+                continue
+            with np.load(os.path.join(self.root, part["path"])) as data:
+                if session_id is not None:
+                    sessions = data["__sessions"]
+                    i = np.searchsorted(sessions, session_id)
+                    if i == len(sessions) or sessions[i] != session_id:
+                        continue
+                mask = None
+                if start is not None or end is not None:
+                    ts = data["ts"]
+                    mask = np.ones(len(ts), dtype=bool)
+                    if start is not None:
+                        mask &= ts >= start
+                    if end is not None:
+                        mask &= ts < end
+                if session_id is not None:
+                    in_session = data["session_id"] == session_id
+                    mask = in_session if mask is None else mask & in_session
+                if mask is not None and not mask.any():
+                    continue
+                frames.append(pd.DataFrame({
+                    name: self._column(table, data, name, part["rows"]) if mask is None
+                    else self._column(table, data, name, part["rows"])[mask]
+                    for name in columns
+                }))
+        if not frames:
+            return pd.DataFrame({
+                name: np.array([], dtype=_NUMPY_TYPES[kind]) for name, kind in SCHEMAS[table] if name in columns
+            })[columns]
+        return pd.concat(frames, ignore_index=True)
+
+    def stats(self):
+        with self._lock:
+            return {
+                table: {"rows": sum(part["rows"] for part in meta["parts"]), "parts": len(meta["parts"])}
+                for table, meta in self.manifest.items()
+            }
@@ -0,0 +1,191 @@
+import os
+import sqlite3
+import threading
+import time
+from collections import deque
+
+# Fixed schema of each fact table: (column, SQLite type), in the order of the rows given to append().
+# New columns go at the end: they are added to the tables of existing files.
+SCHEMAS = {
+    # weight: requests the row stands for when its route is sampled
+    "http": (
+        ("session_id", "TEXT"), ("path", "TEXT"), ("method", "TEXT"), ("ip", "TEXT"),
+        ("city", "TEXT"), ("country", "TEXT"), ("user_agent", "TEXT"), ("ts", "REAL"), ("weight", "REAL"),
+    ),
+    "queries": (
+        ("session_id", "TEXT"), ("query_id", "INTEGER"), ("query", "TEXT"), ("num_terms", "INTEGER"),
+        ("mission_id", "TEXT"), ("ts", "REAL"),
+    ),
+    # One row per result shown (the rendered page only)
+    "impressions": (
+        ("session_id", "TEXT"), ("query_id", "INTEGER"), ("query", "TEXT"), ("page", "INTEGER"),
+        ("doc_id", "TEXT"), ("rank", "INTEGER"), ("ts", "REAL"),
+    ),
+    # One row per results page rendered, pointing to the full ranking (query hash + result cache key)
+    "searches": (
+        ("session_id", "TEXT"), ("query_id", "INTEGER"), ("page", "INTEGER"), ("query_hash", "TEXT"),
+        ("ranking_key", "TEXT"), ("total_hits", "INTEGER"), ("ts", "REAL"),
+    ),
+    "clicks": (
+        ("session_id", "TEXT"), ("doc_id", "TEXT"), ("ts", "REAL"),
+    ),
+    # censored: 1 when the session ended before the user came back from the document (the dwell time
+    # is only a lower bound)
+    "dwell": (
+        ("session_id", "TEXT"), ("doc_id", "TEXT"), ("dwell_time", "REAL"), ("ts", "REAL"), ("censored", "INTEGER"),
+    ),
+    # One row per ended session (idle, evicted to bound the memory, or open at shutdown)
+    "sessions": (
+        ("session_id", "TEXT"), ("started", "REAL"), ("last_activity", "REAL"), ("num_requests", "INTEGER"),
+        ("num_queries", "INTEGER"), ("num_missions", "INTEGER"), ("city", "TEXT"), ("country", "TEXT"),
+        ("reason", "TEXT"), ("ts", "REAL"),
+    ),
+}
+
+
+class EventLog:
+    """
+    Append-only log of the analytics events.
+    append() only puts the row in a bounded ring buffer (O(1), no I/O in the request); a background
+    thread writes the buffered rows in batches to a SQLite file in WAL mode, one table per fact with
+    the fixed columns of SCHEMAS (timestamps as Unix seconds). When the writer falls behind by more
+    than `capacity` rows, the oldest ones are dropped and counted, so memory stays flat.
+    Without a path the rows are only counted (the in-memory analytics keep working).
+    """
+
+    def __init__(self, path=None, capacity=100_000, flush_interval=1.0, batch_size=5_000):
+        """
+        :param path: SQLite file, None to keep nothing on disk
+        :param capacity: rows buffered at most
+        :param flush_interval: seconds between two flushes
+        :param batch_size: buffered rows that trigger a flush before the interval
+        """
+        self.path = path
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._buffer = deque(maxlen=capacity)
+        self._cond = threading.Condition()
+        self._db_lock = threading.Lock()
+        self._closed = False
+        self.appended = 0
+        self.written = 0
+        self.dropped = 0
+        self._db = None
+        self._writer = None
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            for table, columns in SCHEMAS.items():
+                self._db.execute(
+                    f"CREATE TABLE IF NOT EXISTS {table} ({', '.join(f'{name} {kind}' for name, kind in columns)})"
+                )
+                existing = {row[1] for row in self._db.execute(f"PRAGMA table_info({table})")}
+                for name, kind in columns:
+                    if name not in existing:
+                        self._db.execute(f"ALTER TABLE {table} ADD COLUMN {name} {kind}")
+                self._db.execute(f"CREATE INDEX IF NOT EXISTS {table}_ts ON {table} (ts)")
+            self._db.commit()
+            self._writer = threading.Thread(target=self._run, name="event-log", daemon=True)
+            self._writer.start()
+
+    def append(self, table, row):
+        """Buffer one row (a tuple in the column order of SCHEMAS[table])."""
+        self.appended += 1
+        if self._db is None:
+            return
+        with self._cond:
+            if len(self._buffer) == self._buffer.maxlen:
+                self.dropped += 1
+            self._buffer.append((table, row))
+            if len(self._buffer) >= self.batch_size:
+                self._cond.notify()
+
+    def _drain(self):
+        with self._cond:
+            rows = list(self._buffer)
+            self._buffer.clear()
+        return rows
+
+    def _requeue(self, rows):
+        """Put rows that could not be written back in front of the buffer (what does not fit is dropped)."""
+        with self._cond:
+            room = self._buffer.maxlen - len(self._buffer)
+            kept = rows[len(rows) - room:] if room < len(rows) else rows
+            self.dropped += len(rows) - len(kept)
+            self._buffer.extendleft(reversed(kept))
+
+    def flush(self):
+        """
+        Write the buffered rows now; returns how many were written.
+        When the write fails, the rows are buffered again if the error can be transient (locked
+        database, full disk: sqlite3.OperationalError) and counted as dropped otherwise.
+        """
+        rows = self._drain()
+        if not rows or self._db is None:
+            return 0
+        by_table = {}
+        for table, row in rows:
+            by_table.setdefault(table, []).append(row)
+        try:
+            with self._db_lock:
+                with self._db:
+                    for table, table_rows in by_table.items():
+                        placeholders = ", ".join("?" * len(SCHEMAS[table]))
+                        self._db.executemany(f"INSERT INTO {table} VALUES ({placeholders})", table_rows)
+        except sqlite3.OperationalError:
+            self._requeue(rows)
+            raise
+        except sqlite3.Error:
+            with self._cond:
+                self.dropped += len(rows)
+            raise
+        self.written += len(rows)
+        return len(rows)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._closed and len(self._buffer) < self.batch_size:
+                    self._cond.wait(self.flush_interval)
+                closed = self._closed
+            try:
+                self.flush()
+            except sqlite3.Error as e:
+                print(f"EventLog: flush failed: {e}")
+                time.sleep(self.flush_interval)
+            if closed:
+                break
+
+    def query(self, sql, params=()):
+        """Run a read query on the log (buffered rows are flushed first)."""
+        if self._db is None:
+            return []
+        self.flush()
+        with self._db_lock:
+            return self._db.execute(sql, params).fetchall()
+
+    def stats(self):
+        return {
+            "path": self.path,
+            "buffered": len(self._buffer),
+            "capacity": self._buffer.maxlen,
+            "appended": self.appended,
+            "written": self.written,
+            "dropped": self.dropped,
+        }
+
+    def close(self):
+        """Flush what is buffered and close the file."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        if self._writer is not None:
+            self._writer.join(timeout=10)
+            self._writer = None
+        if self._db is not None:
+            self.flush()
+            with self._db_lock:
+                self._db.close()
+                self._db = None
@@ -0,0 +1,134 @@
+import ipaddress
+import os
+import queue
+import threading
+
+from myapp.core.cache import LRUCache
+
+try:
+    import geoip2.database
+    import geoip2.errors
+except ImportError:  # geolocation is optional, every IP is then "Unknown"
+    geoip2 = None
+
+UNKNOWN = ("Unknown", "Unknown")
+LOCALHOST = ("Localhost", "Localhost")
+
+
+class GeoLocator:
+    """
+    IP -> (city, country) from a local MaxMind database (GeoLite2-City / GeoIP2-City .mmdb).
+    Requests never wait for it: lookup() only answers from the per-IP LRU cache, and the IPs that are
+    not cached yet are resolved by a background thread (enqueue), which calls back the requester so
+    it can backfill what it saved with "Unknown" meanwhile.
+    Without geoip2 or without the database file, every public IP resolves to "Unknown".
+    """
+
+    def __init__(self, db_path=None, cache_size=4096, max_pending=10_000):
+        """
+        :param db_path: .mmdb file (GEOIP_DB_PATH), None for no database
+        :param cache_size: IPs kept in the LRU cache
+        :param max_pending: IPs waiting to be resolved, the next ones are dropped (and stay "Unknown")
+        """
+        self.db_path = db_path
+        self.cache = LRUCache(maxsize=cache_size)
+        self._reader = None
+        if db_path and geoip2 is None:
+            print("GeoLocator: geoip2 is not installed, IP locations are not resolved")
+        elif db_path and not os.path.exists(db_path):
+            print(f"GeoLocator: {db_path} not found, IP locations are not resolved")
+        elif db_path:
+            self._reader = geoip2.database.Reader(db_path)
+        # ip -> callbacks waiting for it; each ip is queued once
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._worker = None
+        self.dropped = 0
+
+    @staticmethod
+    def _local(ip):
+        """LOCALHOST / UNKNOWN for the addresses that are not looked up, None for public ones."""
+        if ip == "localhost":
+            return LOCALHOST
+        try:
+            address = ipaddress.ip_address(ip)
+        except (TypeError, ValueError):
+            return UNKNOWN
+        if address.is_loopback:
+            return LOCALHOST
+        if address.is_private or address.is_reserved or address.is_multicast:
+            return UNKNOWN
+        return None
+
+    def lookup(self, ip):
+        """(city, country) when it is known without a database lookup, None otherwise (non-blocking)."""
+        location = self._local(ip)
+        if location is not None:
+            return location
+        if self._reader is None:
+            return UNKNOWN
+        return self.cache.get(ip)
+
+    def resolve(self, ip):
+        """(city, country) of the IP, reading the database when it is not cached (blocking, but local)."""
+        location = self.lookup(ip)
+        if location is not None:
+            return location
+        try:
+            response = self._reader.city(ip)
+            location = (
+                response.city.name or "Unknown",
+                response.country.name or "Unknown",
+            )
+        except (geoip2.errors.AddressNotFoundError, ValueError):
+            location = UNKNOWN
+        self.cache.set(ip, location)
+        return location
+
+    def enqueue(self, ip, callback):
+        """Resolve the IP in the background, then call callback(city, country)."""
+        with self._lock:
+            callbacks = self._pending.get(ip)
+            if callbacks is not None:
+                callbacks.append(callback)
+                return
+            try:
+                self._queue.put_nowait(ip)
+            except queue.Full:
+                self.dropped += 1
+                return
+            self._pending[ip] = [callback]
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name="geolocation", daemon=True)
+                self._worker.start()
+
+    def _run(self):
+        while True:
+            ip = self._queue.get()
+            if ip is None:
+                break
+            try:
+                location = self.resolve(ip)
+            except Exception as e:
+                print(f"GeoLocator: cannot resolve {ip}: {e}")
+                location = UNKNOWN
+            with self._lock:
+                callbacks = self._pending.pop(ip, [])
+            # A failing callback must not stop the worker: the other IPs would never be resolved
+            for callback in callbacks:
+                try:
+                    callback(*location)
+                except Exception as e:
+                    print(f"GeoLocator: callback for {ip} failed: {e}")
+
+    def close(self):
+        with self._lock:
+            worker = self._worker
+            self._worker = None
+        if worker is not None:
+            self._queue.put(None)
+            worker.join(timeout=5)
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
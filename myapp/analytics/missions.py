@@ -0,0 +1,114 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+
+import numpy as np
+
+from myapp.search.algorithms import _tokenize
+
+
+class _SessionQueries:
+    """Recent queries of a session: (timestamp, mission id, term ids, unit TF weights), oldest first."""
+
+    __slots__ = ("entries", "last_seen")
+
+    def __init__(self, max_queries):
+        self.entries = deque(maxlen=max_queries)
+        self.last_seen = 0.0
+
+
+class MissionIndex:
+    """
+    Assigns each query of a session to a mission (a group of related queries).
+    A query joins the mission of the most similar recent query of its session (cosine of the term
+    frequencies >= threshold), otherwise it starts a new mission.
+    Each session keeps its last queries of the time window, already tokenised as sparse unit vectors
+    (hashed term ids + weights), so assign() only compares with them: the similarities of all of them
+    are one vectorised sparse dot product. Sessions without a query in the time window are dropped
+    (the sessions are kept in last-seen order, so this is O(1) per expired session).
+    The cost of assign() depends on max_queries, not on the traffic of the site.
+    """
+
+    def __init__(self, time_window=2 * 60 * 60, threshold=0.35, max_queries=100, clock=time.time):
+        """
+        :param time_window: seconds a query can still be joined by the next queries of its session
+        :param threshold: minimum cosine similarity to join a mission
+        :param max_queries: queries kept per session
+        :param clock: time source (Unix seconds)
+        """
+        self.time_window = time_window
+        self.threshold = threshold
+        self.max_queries = max_queries
+        self._clock = clock
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def vector(query):
+        """(term ids, weights) of the query: its TF vector normalised to unit length, ids sorted."""
+        tokens = _tokenize(query) if isinstance(query, str) else []
+        if not tokens:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+        ids, counts = np.unique(np.fromiter((hash(t) for t in tokens), dtype=np.int64, count=len(tokens)),
+                                return_counts=True)
+        weights = counts.astype(np.float64)
+        return ids, weights / np.sqrt(np.dot(weights, weights))
+
+    def _expire(self, now):
+        deadline = now - self.time_window
+        while self._sessions:
+            session_id, queries = next(iter(self._sessions.items()))
+            if queries.last_seen >= deadline:
+                break
+            del self._sessions[session_id]
+
+    def best_match(self, session_id, ids, weights, now):
+        """(mission id, similarity) of the most similar recent query of the session, (None, 0.0) if none."""
+        queries = self._sessions.get(session_id)
+        if queries is None or not len(ids):
+            return None, 0.0
+        entries = queries.entries
+        deadline = now - self.time_window
+        while entries and entries[0][0] < deadline:
+            entries.popleft()
+        if not entries:
+            return None, 0.0
+        # Sparse dot product of the query with every kept query at once
+        entry_ids = np.concatenate([entry[2] for entry in entries])
+        entry_weights = np.concatenate([entry[3] for entry in entries])
+        owners = np.repeat(np.arange(len(entries)), [len(entry[2]) for entry in entries])
+        positions = np.minimum(np.searchsorted(ids, entry_ids), len(ids) - 1)
+        common = ids[positions] == entry_ids
+        similarities = np.bincount(
+            owners[common], weights=entry_weights[common] * weights[positions[common]], minlength=len(entries),
+        )
+        # The oldest of the most similar queries, as when they were compared one by one
+        best = int(np.argmax(similarities))
+        return entries[best][1], float(similarities[best])
+
+    def assign(self, session_id, query, now=None):
+        """Mission id of the query (an existing one or a new one); the query is added to the index."""
+        now = self._clock() if now is None else now
+        ids, weights = self.vector(query)
+        with self._lock:
+            self._expire(now)
+            mission_id, similarity = self.best_match(session_id, ids, weights, now)
+            if mission_id is None or similarity < self.threshold:
+                mission_id = str(uuid.uuid4())
+            queries = self._sessions.get(session_id)
+            if queries is None:
+                queries = self._sessions[session_id] = _SessionQueries(self.max_queries)
+            else:
+                self._sessions.move_to_end(session_id)
+            queries.entries.append((now, mission_id, ids, weights))
+            queries.last_seen = now
+        return mission_id
+
+    def forget(self, session_id):
+        """Drop the queries of a session (when it ends)."""
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def __len__(self):
+        return len(self._sessions)
@@ -0,0 +1,94 @@
+import numpy as np
+import pandas as pd
+
+
+class AnalyticsReports:
+    """
+    Historical reports over the columnar copy of the event log (see ColumnarStore), computed with
+    pandas / NumPy on whole columns. Every report takes the same filters, pushed down to the scan:
+    start / end (Unix seconds, end excluded) and session_id.
+    """
+
+    def __init__(self, store, category_of=None):
+        """
+        :param store: ColumnarStore
+        :param category_of: doc_id -> category, for dwell_by_category
+        """
+        self.store = store
+        self.category_of = category_of
+
+    def refresh(self):
+        """
+        Copy the events logged since the last refresh to the columnar store (its background thread does
+        it when it has a sync_interval).
+        """
+        return self.store.sync()
+
+    def ctr_by_rank(self, start=None, end=None, session_id=None, max_rank=50):
+        """
+        Impressions, clicks and click-through rate per rank. A click counts for the last impression of
+        the same document in the same session before it.
+        """
+        impressions = self.store.scan("impressions", ("session_id", "doc_id", "rank", "ts"), start, end, session_id)
+        clicks = self.store.scan("clicks", ("session_id", "doc_id", "ts"), start, end, session_id)
+        shown = np.bincount(np.clip(impressions["rank"].to_numpy(), 0, max_rank + 1), minlength=max_rank + 2)
+        clicked = np.zeros_like(shown)
+        if len(impressions) and len(clicks):
+            attributed = pd.merge_asof(
+                clicks.sort_values("ts"), impressions.sort_values("ts"),
+                on="ts", by=["session_id", "doc_id"], direction="backward",
+            )
+            ranks = attributed["rank"].dropna().astype(np.int64).to_numpy()
+            clicked = np.bincount(np.clip(ranks, 0, max_rank + 1), minlength=max_rank + 2)
+        # Ranks start at 1, the last slot gathers the ranks after max_rank
+        ranks = np.arange(1, max_rank + 1)
+        shown, clicked = shown[1:max_rank + 1], clicked[1:max_rank + 1]
+        ctr = clicked / np.maximum(shown, 1)
+        report = pd.DataFrame({"rank": ranks, "impressions": shown, "clicks": clicked, "ctr": ctr})
+        return report[report["impressions"] > 0].reset_index(drop=True)
+
+    def dwell_by_category(self, start=None, end=None, session_id=None):
+        """
+        Dwell events, total, mean and median dwell time per document category. Censored dwell times (the
+        session ended before the user came back from the document) are left out.
+        """
+        dwell = self.store.scan("dwell", ("doc_id", "dwell_time", "censored"), start, end, session_id)
+        dwell = dwell[dwell["censored"] != 1].drop(columns="censored")
+        if dwell.empty:
+            return pd.DataFrame(columns=["category", "events", "total", "mean", "median"])
+        # The category is looked up once per distinct document
+        doc_ids = dwell["doc_id"].unique()
+        categories = pd.Series(
+            [(self.category_of(doc_id) if self.category_of else None) or "Unknown" for doc_id in doc_ids],
+            index=doc_ids,
+        )
+        dwell["category"] = dwell["doc_id"].map(categories)
+        report = dwell.groupby("category")["dwell_time"].agg(
+            events="count", total="sum", mean="mean", median="median",
+        )
+        return report.sort_values("events", ascending=False).reset_index()
+
+    def zero_result_queries(self, start=None, end=None, session_id=None, limit=50):
+        """Queries that returned no result, most frequent first."""
+        searches = self.store.scan(
+            "searches", ("session_id", "query_id", "total_hits", "ts"), start, end, session_id,
+        )
+        searches = searches[searches["total_hits"] == 0].drop_duplicates(["session_id", "query_id"])
+        if searches.empty:
+            return pd.DataFrame(columns=["query", "count", "sessions", "last_seen"])
+        queries = self.store.scan("queries", ("session_id", "query_id", "query"), start, end, session_id)
+        zero = searches.merge(queries, on=["session_id", "query_id"], how="inner")
+        report = zero.groupby("query").agg(
+            count=("query_id", "size"), sessions=("session_id", "nunique"), last_seen=("ts", "max"),
+        )
+        report["last_seen"] = pd.to_datetime(report["last_seen"], unit="s")
+        return report.sort_values("count", ascending=False).head(limit).reset_index()
+
+    def time_buckets(self, table, bucket="1h", start=None, end=None, session_id=None):
+        """Events of `table` per time bucket (a pandas offset such as "15min", "1h" or "1D")."""
+        ts = self.store.scan(table, ("ts",), start, end, session_id)["ts"].to_numpy()
+        if not len(ts):
+            return pd.DataFrame(columns=["bucket", "events"])
+        width = pd.Timedelta(bucket).total_seconds()
+        buckets, counts = np.unique(np.floor(ts / width) * width, return_counts=True)
+        return pd.DataFrame({"bucket": pd.to_datetime(buckets, unit="s"), "events": counts})
@@ -0,0 +1,113 @@
+import random
+import threading
+from bisect import bisect_left
+
+# Upper bounds (milliseconds) of the latency histogram buckets, the last bucket is open
+LATENCY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+EXCLUDED = 0.0
+
+
+class RequestPolicy:
+    """
+    Decides which requests the analytics record.
+    - excluded: static files, health checks, plots and the other endpoints that are not user activity
+      (matched by endpoint name or by path prefix); nothing is recorded for them,
+    - sampled: an endpoint with a rate < 1 is recorded for that fraction of its requests, each recorded
+      request then counts for 1 / rate in the aggregates,
+    - everything else is recorded with weight 1.
+    """
+
+    def __init__(self, excluded_endpoints=(), excluded_prefixes=("/static/",), sample_rates=None, rng=random.random):
+        """
+        :param excluded_endpoints: Flask endpoint names never recorded
+        :param excluded_prefixes: URL path prefixes never recorded
+        :param sample_rates: {endpoint: fraction of the requests recorded}, 1 for the endpoints not listed
+        :param rng: returns a float in [0, 1)
+        """
+        self.excluded_endpoints = frozenset(excluded_endpoints)
+        self.excluded_prefixes = tuple(excluded_prefixes)
+        self.sample_rates = {}
+        for endpoint, rate in (sample_rates or {}).items():
+            if not 0 < rate <= 1:
+                raise ValueError(f"sample rate of {endpoint} must be in (0, 1], got {rate}")
+            self.sample_rates[endpoint] = rate
+        self._rng = rng
+
+    @staticmethod
+    def parse_rates(text):
+        """{endpoint: rate} of "endpoint=rate,endpoint=rate" (e.g. the ANALYTICS_SAMPLE_RATES variable)."""
+        rates = {}
+        for item in (text or "").split(","):
+            if item.strip():
+                endpoint, _, rate = item.partition("=")
+                rates[endpoint.strip()] = float(rate)
+        return rates
+
+    def is_excluded(self, endpoint, path):
+        return endpoint in self.excluded_endpoints or path.startswith(self.excluded_prefixes)
+
+    def weight(self, endpoint, path):
+        """0 when the request is not recorded, otherwise the number of requests it stands for."""
+        if self.is_excluded(endpoint, path):
+            return EXCLUDED
+        rate = self.sample_rates.get(endpoint)
+        if rate is None or rate >= 1:
+            return 1.0
+        return 1.0 / rate if self._rng() < rate else EXCLUDED
+
+
+class _Histogram:
+    __slots__ = ("count", "total", "max", "buckets")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+
+
+class LatencyHistograms:
+    """Per-route request latencies: count, mean, max and a fixed-bucket histogram (O(1) per request)."""
+
+    def __init__(self):
+        self._routes = {}
+        self._lock = threading.Lock()
+
+    def add(self, route, milliseconds):
+        with self._lock:
+            histogram = self._routes.get(route)
+            if histogram is None:
+                histogram = self._routes[route] = _Histogram()
+            histogram.count += 1
+            histogram.total += milliseconds
+            histogram.max = max(histogram.max, milliseconds)
+            histogram.buckets[bisect_left(LATENCY_BUCKETS, milliseconds)] += 1
+
+    @staticmethod
+    def _percentile(histogram, fraction):
+        """Upper bound of the bucket holding the percentile (the max for the open bucket)."""
+        rank = fraction * histogram.count
+        seen = 0
+        for i, count in enumerate(histogram.buckets):
+            seen += count
+            if seen >= rank:
+                return LATENCY_BUCKETS[i] if i < len(LATENCY_BUCKETS) else histogram.max
+        return histogram.max
+
+    def stats(self):
+        with self._lock:
+            return {
+                route: {
+                    "count": h.count,
+                    "mean_ms": h.total / h.count,
+                    "p50_ms": self._percentile(h, 0.5),
+                    "p95_ms": self._percentile(h, 0.95),
+                    "p99_ms": self._percentile(h, 0.99),
+                    "max_ms": h.max,
+                    "buckets": {
+                        f"<={bound}ms": count for bound, count in zip(LATENCY_BUCKETS, h.buckets)
+                    } | {f">{LATENCY_BUCKETS[-1]}ms": h.buckets[-1]},
+                }
+                for route, h in self._routes.items()
+            }
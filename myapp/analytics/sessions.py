@@ -0,0 +1,167 @@
+import heapq
+import itertools
+import threading
+import time
+
+
+class SessionStore:
+    """
+    Sessions (session_id -> session dict) that expire after `idle_timeout` seconds without activity.
+    The expiry times are kept in a heap: touch() pushes the new expiry time and leaves the old entry,
+    which is skipped when it is popped (the heap is rebuilt when it holds too many of them).
+    expire() ends the sessions whose time has passed, in expiry order, and at most `max_sessions` are
+    kept: the least recently active ones end first, so bot traffic or millions of visitors do not grow
+    the memory. Ended sessions are given to on_expire(session_id, session, reason) with reason
+    "idle" or "capacity", outside of the lock.
+    Reads like a dict (get, in, [], len, items, keys, values), in activity order: set() and touch()
+    move the session to the end, so recent(n) gives the last active sessions without a sort.
+    """
+
+    def __init__(self, idle_timeout=30 * 60, max_sessions=100_000, on_expire=None, clock=time.time):
+        """
+        :param idle_timeout: seconds without activity before a session ends
+        :param max_sessions: sessions kept at most
+        :param on_expire: called with (session_id, session, reason) for every ended session
+        :param clock: time source (Unix seconds)
+        """
+        self.idle_timeout = idle_timeout
+        self.max_sessions = max_sessions
+        self.on_expire = on_expire
+        self._clock = clock
+        self._sessions = {}
+        # session_id -> expiry time; the heap entry with another time is stale
+        self._expires = {}
+        self._heap = []
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self.expired = 0
+        self.evicted = 0
+
+    def _schedule(self, session_id, now):
+        expires = now + self.idle_timeout
+        self._expires[session_id] = expires
+        heapq.heappush(self._heap, (expires, next(self._seq), session_id))
+        if len(self._heap) > 2 * len(self._expires) + 64:
+            self._heap = [(t, next(self._seq), s) for s, t in self._expires.items()]
+            heapq.heapify(self._heap)
+
+    def _pop_first(self):
+        """(session_id, session) of the session that expires first, removed from the store."""
+        while self._heap:
+            expires, _, session_id = heapq.heappop(self._heap)
+            if self._expires.get(session_id) == expires:
+                del self._expires[session_id]
+                return session_id, self._sessions.pop(session_id)
+        return None, None
+
+    def set(self, session_id, session, now=None):
+        """Add or replace a session, active now."""
+        now = self._clock() if now is None else now
+        ended = []
+        with self._lock:
+            self._sessions.pop(session_id, None)
+            self._sessions[session_id] = session
+            self._schedule(session_id, now)
+            while len(self._sessions) > self.max_sessions:
+                ended.append(self._pop_first() + ("capacity",))
+                self.evicted += 1
+        self._ended(ended)
+
+    __setitem__ = set
+
+    def touch(self, session_id, now=None):
+        """Record activity of the session; False when there is no such session."""
+        now = self._clock() if now is None else now
+        with self._lock:
+            if session_id not in self._sessions:
+                return False
+            self._sessions[session_id] = self._sessions.pop(session_id)
+            self._schedule(session_id, now)
+            return True
+
+    def idle_seconds(self, session_id, now=None):
+        """Seconds since the last activity of the session, None when there is no such session."""
+        now = self._clock() if now is None else now
+        with self._lock:
+            expires = self._expires.get(session_id)
+        return None if expires is None else now - (expires - self.idle_timeout)
+
+    def end(self, session_id, reason="ended"):
+        """End a session now (on_expire is called); returns it, None when there is no such session."""
+        with self._lock:
+            session = self._sessions.pop(session_id, None)
+            self._expires.pop(session_id, None)
+        if session is not None:
+            self._ended([(session_id, session, reason)])
+        return session
+
+    def expire(self, now=None):
+        """End the sessions idle for more than idle_timeout; returns how many ended."""
+        now = self._clock() if now is None else now
+        ended = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                expires, _, session_id = heapq.heappop(self._heap)
+                if self._expires.get(session_id) == expires:
+                    del self._expires[session_id]
+                    ended.append((session_id, self._sessions.pop(session_id), "idle"))
+            self.expired += len(ended)
+        self._ended(ended)
+        return len(ended)
+
+    def _ended(self, ended):
+        if self.on_expire is None:
+            return
+        for session_id, session, reason in ended:
+            try:
+                self.on_expire(session_id, session, reason)
+            except Exception as e:
+                print(f"SessionStore: cannot end session {session_id}: {e}")
+
+    def close(self):
+        """End all the sessions (at shutdown)."""
+        with self._lock:
+            ended = [(session_id, session, "shutdown") for session_id, session in self._sessions.items()]
+            self._sessions.clear()
+            self._expires.clear()
+            self._heap.clear()
+        self._ended(ended)
+
+    # dict-like reads
+    def get(self, session_id, default=None):
+        return self._sessions.get(session_id, default)
+
+    def __getitem__(self, session_id):
+        return self._sessions[session_id]
+
+    def __contains__(self, session_id):
+        return session_id in self._sessions
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def items(self):
+        with self._lock:
+            return list(self._sessions.items())
+
+    def keys(self):
+        with self._lock:
+            return list(self._sessions)
+
+    def values(self):
+        with self._lock:
+            return list(self._sessions.values())
+
+    def recent(self, n):
+        """(session_id, session) of the n most recently active sessions, the latest first."""
+        with self._lock:
+            return list(itertools.islice(reversed(self._sessions.items()), n))
+
+    def stats(self):
+        return {
+            "sessions": len(self._sessions),
+            "max_sessions": self.max_sessions,
+            "idle_timeout": self.idle_timeout,
+            "expired": self.expired,
+            "evicted": self.evicted,
+        }
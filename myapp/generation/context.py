@@ -0,0 +1,161 @@
+import re
+
+# Words of a title that only name the colour of a variant
+COLOR_WORDS = frozenset((
+    "black", "white", "grey", "gray", "blue", "navy", "red", "maroon", "pink", "green", "olive", "yellow",
+    "orange", "brown", "beige", "khaki", "cream", "purple", "violet", "gold", "silver", "multicolor",
+    "multicolour", "dark", "light",
+))
+# product_details entries that do not help to choose a product
+SKIPPED_DETAILS = frozenset(("Style Code",))
+
+_WORD_RE = re.compile(r"[a-z0-9]+")
+_LABELED_FIELDS = (("Brand", "brand"), ("Category", "category"), ("Subcategory", "sub_category"))
+
+
+def estimate_tokens(text):
+    """Rough token count of `text` (about 4 characters per token for English)."""
+    return (len(text) + 3) // 4
+
+
+def _number(value):
+    return f"{value:g}" if isinstance(value, float) else str(value)
+
+
+def _price(cents):
+    """Price in euros, as the templates show it (prices are stored in cents)."""
+    return f"{cents / 100:.2f} €"
+
+
+class ContextBuilder:
+    """
+    Builds the products block of the RAG prompt within a token budget.
+    Products are taken in ranking order. Variants of the same product (same brand and title but the
+    colour) are merged into the best ranked one, which lists the other colours. Brand, category or
+    subcategory shared by all the products are given once. The products are first added in a short
+    form (name, brand, category, price, discount, rating, stock) while they fit in the budget, then
+    the best ranked ones get their details and description with the budget that is left.
+    """
+
+    def __init__(self, token_budget=800, max_products=20, description_chars=160, max_details=4):
+        """
+        :param token_budget: estimated tokens of the products block
+        :param max_products: products (after merging the variants) in the block
+        :param description_chars: descriptions are cut to this length
+        :param max_details: product_details entries shown per product
+        """
+        self.token_budget = token_budget
+        self.max_products = max_products
+        self.description_chars = description_chars
+        self.max_details = max_details
+
+    @staticmethod
+    def variant_key(res):
+        """Brand and title without the colour words: products with the same key are variants."""
+        words = _WORD_RE.findall((getattr(res, "title", None) or "").lower())
+        brand = (getattr(res, "brand", None) or "").lower().strip()
+        return brand, tuple(w for w in words if w not in COLOR_WORDS)
+
+    @staticmethod
+    def variant_color(res):
+        words = (getattr(res, "title", None) or "").split()
+        color = " ".join(w for w in words if w.lower() in COLOR_WORDS)
+        return color or None
+
+    def group_variants(self, results):
+        """[(best ranked result, [other colours]), ...] in ranking order."""
+        groups = {}
+        for res in results:
+            key = self.variant_key(res)
+            group = groups.get(key)
+            if group is None:
+                groups[key] = (res, [])
+            else:
+                color = self.variant_color(res)
+                if color and color != self.variant_color(group[0]) and color not in group[1]:
+                    group[1].append(color)
+        return list(groups.values())
+
+    def format_product(self, res, other_colors=(), full=True, shared=()):
+        """
+        Lines of one product, with the real Document fields.
+        :param shared: brand / category / sub_category fields given once for all the products
+        """
+        lines = [f" - Name: {res.title}"]
+        facts = []
+        for label, attr in _LABELED_FIELDS:
+            value = getattr(res, attr, None)
+            if value and attr not in shared:
+                facts.append(f"{label}: {value}")
+
+        price = getattr(res, "selling_price", None)
+        if price is not None:
+            price_text = f"Price: {_price(price)}"
+            actual = getattr(res, "actual_price", None)
+            if actual is not None and actual > price:
+                price_text += f" (was {_price(actual)})"
+            facts.append(price_text)
+        discount = getattr(res, "discount", None)
+        if discount:
+            facts.append(f"Discount: {_number(discount)}% off")
+        rating = getattr(res, "average_rating", None)
+        if rating is not None:
+            facts.append(f"Rating: {_number(rating)}/5")
+        facts.append("Stock: OUT OF STOCK" if getattr(res, "out_of_stock", False) else "Stock: in stock")
+        lines.append("   " + " | ".join(facts))
+        if other_colors:
+            lines.append(f"   Also available in: {', '.join(other_colors)}")
+
+        if full:
+            details = getattr(res, "product_details", None) or {}
+            shown = [
+                f"{name}: {value}" for name, value in details.items()
+                if value and name not in SKIPPED_DETAILS
+            ][:self.max_details]
+            if shown:
+                lines.append("   Details: " + " | ".join(shown))
+            desc = getattr(res, "description", None)
+            if desc:
+                desc = " ".join(str(desc).split())
+                if len(desc) > self.description_chars:
+                    desc = desc[:self.description_chars - 3].rstrip() + "..."
+                lines.append(f"   Description: {desc}")
+        return "\n".join(lines)
+
+    def build(self, results, top_N=20):
+        """Products block for the first top_N results; the empty-results text when there are none."""
+        top_results = results[:top_N] if results else []
+        if not top_results:
+            return "No products were retrieved."
+        groups = self.group_variants(top_results)[:self.max_products]
+        # A field with the same value for every product is given once, before the products
+        shared = {}
+        if len(groups) > 1:
+            for label, attr in _LABELED_FIELDS:
+                values = {getattr(res, attr, None) for res, _ in groups}
+                if len(values) == 1 and None not in values and "" not in values:
+                    shared[attr] = f"{label}: {values.pop()}"
+        blocks = []
+        if shared:
+            blocks.append("All products: " + " | ".join(shared.values()))
+        used = sum(estimate_tokens(block) + 1 for block in blocks)
+
+        # Short forms first, so the budget covers as many products as possible...
+        products = []
+        for res, other_colors in groups:
+            block = self.format_product(res, other_colors, False, shared)
+            tokens = estimate_tokens(block) + 1
+            # The first product is always sent
+            if products and used + tokens > self.token_budget:
+                break
+            products.append(block)
+            used += tokens
+        # ...then the details and descriptions of the best ranked ones while they fit
+        for i, (res, other_colors) in enumerate(groups[:len(products)]):
+            block = self.format_product(res, other_colors, True, shared)
+            extra = estimate_tokens(block) - estimate_tokens(products[i])
+            if used + extra <= self.token_budget:
+                products[i] = block
+                used += extra
+        blocks.extend(products)
+        return "\n".join(blocks)
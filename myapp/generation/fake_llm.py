@@ -0,0 +1,129 @@
+"""
+Local OpenAI compatible chat completion server, to run the RAG without a Groq account (and to test
+timeouts and cancellation). It answers with the first products of the prompt, word by word.
+
+    python -m myapp.generation.fake_llm --port 8099 --delay 0.05
+    GROQ_BASE_URL=http://127.0.0.1:8099 GROQ_API_KEY=fake python web_app.py
+"""
+import argparse
+import json
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+_NAME_RE = re.compile(r"Name: (.+?)(?: \| ID: .*)?$", re.MULTILINE)
+
+
+def fake_answer(prompt):
+    """Answer in the format asked by RAGGenerator.PROMPT_TEMPLATE, built from the product names of the prompt."""
+    names = _NAME_RE.findall(prompt)
+    if not names:
+        return "No results for this search, maybe try: cotton t-shirt"
+    answer = f"Best product: {names[0]}\nWhy: It is the first product retrieved for this request."
+    answer += "\nBe carefull: This answer comes from the fake LLM server."
+    if len(names) > 1:
+        answer += f"\nAlternative: {names[1]}"
+    return answer
+
+
+class FakeLLMHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Set by serve()
+    first_token_delay = 0.0
+    token_delay = 0.0
+
+    def do_POST(self):
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self.send_error(404)
+            return
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        prompt = "\n".join(str(m.get("content", "")) for m in body.get("messages", []))
+        model = body.get("model", "fake")
+        answer = fake_answer(prompt)
+        completion_id = "chatcmpl-" + uuid.uuid4().hex
+        time.sleep(self.first_token_delay)
+
+        if not body.get("stream"):
+            self._send_json({
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": answer},
+                    "finish_reason": "stop",
+                }],
+                "usage": {"prompt_tokens": len(prompt) // 4, "completion_tokens": len(answer) // 4,
+                          "total_tokens": (len(prompt) + len(answer)) // 4},
+            })
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        try:
+            for token in re.findall(r"\S+\s*", answer):
+                self._send_event(completion_id, model, {"content": token}, None)
+                time.sleep(self.token_delay)
+            self._send_event(completion_id, model, {}, "stop")
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # The client closed the stream (cancelled generation)
+            pass
+        self.close_connection = True
+
+    def _send_event(self, completion_id, model, delta, finish_reason):
+        chunk = {
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        }
+        self.wfile.write(b"data: " + json.dumps(chunk).encode("utf-8") + b"\n\n")
+        self.wfile.flush()
+
+    def _send_json(self, data):
+        payload = json.dumps(data).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(host="127.0.0.1", port=8099, first_token_delay=0.0, token_delay=0.0, background=False):
+    """
+    Start the server.
+    :param background: serve from a daemon thread and return the server (server.shutdown() stops it)
+    """
+    handler = type("Handler", (FakeLLMHandler,), {
+        "first_token_delay": first_token_delay,
+        "token_delay": token_delay,
+    })
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    if background:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+    print(f"Fake LLM server on http://{host}:{server.server_address[1]}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds before the first token")
+    parser.add_argument("--delay", type=float, default=0.02, help="seconds between tokens")
+    args = parser.parse_args()
+    serve(args.host, args.port, args.latency, args.delay)
@@ -0,0 +1,129 @@
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+
+class RAGJob:
+    """
+    One RAG generation running in the background.
+    status: pending -> running -> done | cancelled | timeout | failed; `text` grows while the answer streams.
+    """
+
+    __slots__ = ("id", "status", "text", "created", "cancel_event", "future")
+
+    def __init__(self, job_id, created):
+        self.id = job_id
+        self.status = "pending"
+        self.text = ""
+        self.created = created
+        self.cancel_event = threading.Event()
+        self.future = None
+
+    @property
+    def finished(self):
+        return self.status not in ("pending", "running")
+
+    def to_json(self):
+        return {"id": self.id, "status": self.status, "text": self.text, "done": self.finished}
+
+
+class RAGJobManager:
+    """
+    Runs RAG generations on a thread pool so the results page is sent without waiting for the LLM.
+    The page polls status() for the text generated so far and cancels the job when the user leaves.
+    Jobs live in this process (one manager per web worker) and are dropped job_ttl seconds after
+    they were submitted.
+    """
+
+    def __init__(self, generator, max_workers=4, job_ttl=300, clock=time.monotonic):
+        """
+        :param generator: RAGGenerator (build_prompt / complete)
+        :param max_workers: generations running at the same time, the others wait in the queue
+        :param job_ttl: seconds a job (and its answer) is kept
+        """
+        self.generator = generator
+        self.job_ttl = job_ttl
+        self._clock = clock
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="rag")
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, user_query, retrieved_results, top_N=20):
+        """Start the generation for the query and its results; returns the job id."""
+        # The prompt reads the documents, it is built here and the worker thread only talks to the LLM
+        products_block = self.generator.format_products(retrieved_results, top_N)
+        prompt = self.generator.build_prompt(user_query, products_block)
+        cache_key = self.generator.cache_key(user_query, products_block)
+        job = RAGJob(uuid.uuid4().hex, self._clock())
+        with self._lock:
+            self._expire()
+            self._jobs[job.id] = job
+        cached = self.generator.cache.get(cache_key) if cache_key is not None else None
+        if cached is not None:
+            job.text = cached
+            job.status = "done"
+            return job.id
+        job.future = self._pool.submit(self._run, job, prompt, cache_key)
+        return job.id
+
+    def _run(self, job, prompt, cache_key=None):
+        if job.cancel_event.is_set():
+            job.status = "cancelled"
+            return
+        job.status = "running"
+
+        def on_text(text):
+            job.text = text
+
+        def compute():
+            text = self.generator.complete(prompt, cancel=job.cancel_event, on_text=on_text)
+            # A cancelled generation is partial, it is not cached
+            return text, self.generator.cacheable(text) and not job.cancel_event.is_set()
+
+        try:
+            if cache_key is None:
+                job.text = compute()[0]
+            else:
+                job.text = self.generator.cache.get_or_compute(
+                    cache_key, compute, timeout=self.generator.timeout, lookup=False
+                )
+            job.status = "cancelled" if job.cancel_event.is_set() else "done"
+        except TimeoutError as e:
+            print(f"RAG generation timed out: {e}")
+            job.text = job.text or self.generator.DEFAULT_ANSWER
+            job.status = "timeout"
+        except Exception as e:
+            print(f"Error during RAG generation: {e}")
+            job.text = self.generator.DEFAULT_ANSWER
+            job.status = "failed"
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def status(self, job_id):
+        """Status and text of the job, or None for an unknown (or expired) job."""
+        job = self.get(job_id)
+        return job.to_json() if job is not None else None
+
+    def cancel(self, job_id):
+        """Stop the job: a queued job never starts, a running one closes its stream at the next chunk."""
+        job = self.get(job_id)
+        if job is None:
+            return False
+        job.cancel_event.set()
+        if job.future is not None and job.future.cancel():
+            job.status = "cancelled"
+        return True
+
+    def _expire(self):
+        limit = self._clock() - self.job_ttl
+        for job_id in [job_id for job_id, job in self._jobs.items() if job.created < limit]:
+            self._jobs.pop(job_id).cancel_event.set()
+
+    def shutdown(self):
+        with self._lock:
+            for job in self._jobs.values():
+                job.cancel_event.set()
+        self._pool.shutdown(wait=False, cancel_futures=True)
@@ -1,7 +1,13 @@
 import os
+import threading
+import time
+
+import httpx
 from groq import Groq
 from dotenv import load_dotenv
 
+from myapp.generation.context import ContextBuilder
+
 load_dotenv()
 
 
@@ -9,8 +15,32 @@ class RAGGenerator:
     """
     Retrieval-Augmented Generation helper that takes a user query and a list of
     retrieved product objects and asks an LLM to pick the best product.
+    The Groq client (and its HTTP connection pool) is created on first use and shared by all the
+    calls, which may come from several threads (see RAGJobManager).
+    GROQ_BASE_URL points the client to another OpenAI compatible server (e.g. fake_llm.py).
+    With a RAGResponseCache, answers are reused for the same query and the same retrieved products.
     """
 
+    DEFAULT_ANSWER = "RAG is not available. Check your credentials (.env file) or account limits."
+
+    def __init__(self, timeout=None, max_retries=None, max_connections=8, cache=None, context_builder=None):
+        """
+        :param timeout: seconds allowed for a whole generation (RAG_TIMEOUT, 20 by default)
+        :param max_retries: retries of the client on connection errors (RAG_MAX_RETRIES, 1 by default)
+        :param max_connections: size of the HTTP connection pool
+        :param cache: RAGResponseCache, None to always call the LLM
+        :param context_builder: ContextBuilder of the products block (RAG_CONTEXT_TOKENS budget by default)
+        """
+        self.timeout = float(os.environ.get("RAG_TIMEOUT", 20)) if timeout is None else timeout
+        self.max_retries = int(os.environ.get("RAG_MAX_RETRIES", 1)) if max_retries is None else max_retries
+        self.max_connections = max_connections
+        self.cache = cache
+        if context_builder is None:
+            context_builder = ContextBuilder(token_budget=int(os.environ.get("RAG_CONTEXT_TOKENS", 800)))
+        self.context_builder = context_builder
+        self._client = None
+        self._client_lock = threading.Lock()
+
     # Improved prompt
     PROMPT_TEMPLATE = """
         You are a product expert helping a user choose from a list of retrieved products.
@@ -41,50 +71,79 @@ class RAGGenerator:
         If no product fits, set only this next text:
         No results for this search, maybe try: <recomend a similar search to the user, always related to the clothing products, if user request is empty, encourage the user to search in the clothing products>"""
 
-    # Function to pass the features to the AI
-    def _format_product(self, res) -> str:
-
-        lines = []
-
-        # Core identifiers
-        pid = getattr(res, "pid", None) or getattr(res, "id", None)
-        title = getattr(res, "title", None) or getattr(res, "name", None)
-
-        header_parts = []
-        if title:
-            header_parts.append(f"Name: {title}")
-        if pid:
-            header_parts.append(f"ID: {pid}")
-        if header_parts:
-            lines.append(" - " + " | ".join(header_parts))
-
-        def add_field(label: str, attr: str):
-            value = getattr(res, attr, None)
-            if value not in (None, "", [], {}):
-                lines.append(f"   {label}: {value}")
-
-        add_field("Brand", "brand")
-        add_field("Category", "category")
-        add_field("Subcategory", "subcategory")
-        add_field("Price", "price")
-        add_field("Color", "color")
-        add_field("Rating", "rating")
-        add_field("Stock", "stock")
-        add_field("Discount", "discount")
-
-        # Description (truncated to avoid huge prompts)
-        desc = getattr(res, "description", None) or getattr(res, "short_description", None)
-        if desc:
-            desc = str(desc)
-            if len(desc) > 220:
-                desc = desc[:217] + "..."
-            lines.append(f"   Description: {desc}")
-
-        score = getattr(res, "score", None)
-        if score is not None:
-            lines.append(f"   Retrieval score: {score}")
-
-        return "\n".join(lines)
+    def client(self):
+        """The shared Groq client, created on first use."""
+        with self._client_lock:
+            if self._client is None:
+                limits = httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_connections,
+                )
+                self._client = Groq(
+                    api_key=os.environ.get("GROQ_API_KEY"),
+                    base_url=os.environ.get("GROQ_BASE_URL") or None,
+                    timeout=self.timeout,
+                    max_retries=self.max_retries,
+                    http_client=httpx.Client(limits=limits, timeout=self.timeout),
+                )
+            return self._client
+
+    def format_products(self, retrieved_results, top_N: int = 20) -> str:
+        """Products block of the prompt for the first top_N results, within the token budget (reads the documents)."""
+        return self.context_builder.build(retrieved_results, top_N)
+
+    def build_prompt(self, user_query: str, products_block: str) -> str:
+        return self.PROMPT_TEMPLATE.format(
+            retrieved_results=products_block,
+            user_query=user_query,
+        )
+
+    def cache_key(self, user_query: str, products_block: str):
+        """Key of the answer in the response cache, None without a cache."""
+        return self.cache.key(user_query, products_block) if self.cache is not None else None
+
+    def complete(self, prompt: str, cancel=None, on_text=None) -> str:
+        """
+        Stream the completion of `prompt`.
+        :param cancel: threading.Event, the stream is closed (and the partial text returned) when it is set
+        :param on_text: called with the text generated so far after each chunk
+        :raises TimeoutError: when the generation takes longer than self.timeout
+        """
+        deadline = time.monotonic() + self.timeout
+        model_name = os.environ.get("GROQ_MODEL", "llama-3.1-8b-instant")
+        stream = self.client().chat.completions.create(
+            messages=[
+                {
+                    "role": "user",
+                    "content": prompt,
+                }
+            ],
+            model=model_name,
+            stream=True,
+        )
+        parts = []
+        try:
+            for chunk in stream:
+                if cancel is not None and cancel.is_set():
+                    break
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f"RAG generation took more than {self.timeout}s")
+                if chunk.choices and chunk.choices[0].delta.content:
+                    parts.append(chunk.choices[0].delta.content)
+                    if on_text is not None:
+                        on_text("".join(parts))
+        finally:
+            stream.close()
+        return "".join(parts)
+
+    @staticmethod
+    def cacheable(answer):
+        """Answers worth keeping in the response cache (not empty)."""
+        return bool(answer and answer.strip())
+
+    def _answer_for_cache(self, prompt):
+        answer = self.complete(prompt)
+        return answer, self.cacheable(answer)
 
     def generate_response(self, user_query: str, retrieved_results: list, top_N: int = 20) -> str:
         """
@@ -92,44 +151,23 @@ class RAGGenerator:
 
         Args:
             user_query (str): Original query from the user.
-            retrieved_results (list): List of retrieved product objects.
+            retrieved_results (RankedResults): Ranked results returned by the search engine
+                (only the first top_N are read).
             top_N (int): Maximum number of results to include in the prompt.
 
         Returns:
             str: The generated answer from the LLM, or a default error message.
         """
-        DEFAULT_ANSWER = "RAG is not available. Check your credentials (.env file) or account limits."
         try:
-            client = Groq(
-                api_key=os.environ.get("GROQ_API_KEY"),
+            products_block = self.format_products(retrieved_results, top_N)
+            prompt = self.build_prompt(user_query, products_block)
+            if self.cache is None:
+                return self.complete(prompt)
+            return self.cache.get_or_compute(
+                self.cache_key(user_query, products_block),
+                lambda: self._answer_for_cache(prompt),
+                timeout=self.timeout,
             )
-            model_name = os.environ.get("GROQ_MODEL", "llama-3.1-8b-instant")
-
-            # Use richer data instead of only PID + title
-            top_results = retrieved_results[:top_N] if retrieved_results else []
-            formatted_results = "\n".join(
-                self._format_product(res) for res in top_results
-            ) if top_results else "No products were retrieved."
-
-            # Plug rich results into the refined prompt
-            prompt = self.PROMPT_TEMPLATE.format(
-                retrieved_results=formatted_results,
-                user_query=user_query,
-            )
-
-            chat_completion = client.chat.completions.create(
-                messages=[
-                    {
-                        "role": "user",
-                        "content": prompt,
-                    }
-                ],
-                model=model_name,
-            )
-
-            generation = chat_completion.choices[0].message.content
-            return generation
         except Exception as e:
             print(f"Error during RAG generation: {e}")
-            return DEFAULT_ANSWER
-
+            return self.DEFAULT_ANSWER
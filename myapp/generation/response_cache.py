@@ -0,0 +1,179 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+
+from myapp.core.cache import LRUCache
+
+
+class _Flight:
+    """A computation in progress that other callers with the same key wait for."""
+
+    __slots__ = ("done", "answer")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.answer = None
+
+
+class RAGResponseCache:
+    """
+    Cache of RAG answers keyed by the normalised query and a hash of the products sent in the prompt,
+    so the same query with the same retrieved products reuses the answer of the LLM.
+    - in memory: LRUCache (maxsize, ttl),
+    - optionally on disk: a SQLite file that survives restarts, read on memory misses; every
+      `prune_every` stores (and when it is opened) the expired answers are deleted and only the
+      `max_rows` newest ones are kept,
+    - single flight: concurrent identical requests wait for the first one instead of calling the LLM again.
+    Only answers that the caller marks as cacheable are stored (not the error answer, nor cancelled ones).
+    """
+
+    def __init__(self, maxsize=512, ttl=3600, path=None, max_rows=100_000, prune_every=100):
+        """
+        :param maxsize: answers kept in memory
+        :param ttl: seconds an answer stays valid (in memory and on disk), None for no expiry
+        :param path: SQLite file of the on-disk store, None to keep the answers in memory only
+        :param max_rows: answers kept on disk, the oldest ones are deleted
+        :param prune_every: stores between two prunings of the on-disk store
+        """
+        self.ttl = ttl
+        self.max_rows = max_rows
+        self.prune_every = prune_every
+        self.memory = LRUCache(maxsize=maxsize, ttl=ttl)
+        self.path = path
+        self._db = None
+        self._db_lock = threading.Lock()
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS rag_answers (key TEXT PRIMARY KEY, answer TEXT NOT NULL, created REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS rag_answers_created ON rag_answers (created)")
+            self._db.commit()
+        self._flights = {}
+        self._flights_lock = threading.Lock()
+        self.disk_hits = 0
+        self.coalesced = 0
+        self.stores = 0
+        self.pruned = 0
+        if self._db is not None:
+            self.prune()
+
+    @staticmethod
+    def normalize_query(user_query):
+        """Case, unicode form and whitespace do not change the answer."""
+        return " ".join(unicodedata.normalize("NFKC", user_query or "").lower().split())
+
+    @classmethod
+    def key(cls, user_query, products_block):
+        """Cache key of a query and the formatted products of its prompt."""
+        products_hash = hashlib.sha256(products_block.encode("utf-8")).hexdigest()
+        return hashlib.sha256(f"{cls.normalize_query(user_query)}\0{products_hash}".encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        answer = self.memory.get(key)
+        if answer is not None or self._db is None:
+            return answer
+        with self._db_lock:
+            row = self._db.execute("SELECT answer, created FROM rag_answers WHERE key = ?", (key,)).fetchone()
+            if row is not None and self.ttl is not None and row[1] + self.ttl < time.time():
+                self._db.execute("DELETE FROM rag_answers WHERE key = ?", (key,))
+                self._db.commit()
+                row = None
+        if row is None:
+            return None
+        self.disk_hits += 1
+        self.memory.set(key, row[0])
+        return row[0]
+
+    def set(self, key, answer):
+        self.memory.set(key, answer)
+        self.stores += 1
+        if self._db is not None:
+            with self._db_lock:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO rag_answers (key, answer, created) VALUES (?, ?, ?)",
+                    (key, answer, time.time()),
+                )
+                self._db.commit()
+            if self.stores % self.prune_every == 0:
+                self.prune()
+
+    def prune(self):
+        """Delete the expired answers from disk, then the oldest ones past max_rows; returns how many."""
+        if self._db is None:
+            return 0
+        with self._db_lock:
+            deleted = 0
+            if self.ttl is not None:
+                deleted += self._db.execute(
+                    "DELETE FROM rag_answers WHERE created < ?", (time.time() - self.ttl,)
+                ).rowcount
+            if self.max_rows is not None:
+                deleted += self._db.execute(
+                    "DELETE FROM rag_answers WHERE key IN "
+                    "(SELECT key FROM rag_answers ORDER BY created DESC LIMIT -1 OFFSET ?)",
+                    (self.max_rows,),
+                ).rowcount
+            self._db.commit()
+        self.pruned += deleted
+        return deleted
+
+    def get_or_compute(self, key, compute, timeout=None, lookup=True):
+        """
+        Cached answer of `key`, or compute() once for all the concurrent callers of the same key.
+        :param compute: returns (answer, cacheable); exceptions propagate to the caller that computed
+        :param timeout: seconds to wait for another caller computing the same key, then compute anyway
+        :param lookup: False when the caller already missed the cache for this key
+        """
+        answer = self.get(key) if lookup else None
+        if answer is not None:
+            return answer
+        while True:
+            with self._flights_lock:
+                flight = self._flights.get(key)
+                leader = flight is None
+                if leader:
+                    flight = self._flights[key] = _Flight()
+                else:
+                    self.coalesced += 1
+            if leader:
+                break
+            if flight.done.wait(timeout) and flight.answer is not None:
+                return flight.answer
+            if not flight.done.is_set():
+                # The other request is too slow: do not wait for it any more
+                answer, _ = compute()
+                return answer
+            # The other request failed or its answer was not cacheable: try again (possibly as leader)
+
+        try:
+            answer, cacheable = compute()
+            if cacheable:
+                self.set(key, answer)
+                flight.answer = answer
+            return answer
+        finally:
+            with self._flights_lock:
+                self._flights.pop(key, None)
+            flight.done.set()
+
+    def stats(self):
+        stats = self.memory.stats()
+        stats.update(
+            disk_hits=self.disk_hits, coalesced=self.coalesced, stores=self.stores, pruned=self.pruned, path=self.path,
+        )
+        lookups = stats["hits"] + stats["misses"]
+        # Memory misses served from disk are hits too
+        stats["hit_rate"] = (stats["hits"] + self.disk_hits) / lookups if lookups else 0.0
+        return stats
+
+    def close(self):
+        if self._db is not None:
+            with self._db_lock:
+                self._db.close()
+                self._db = None
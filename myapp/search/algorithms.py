@@ -1,7 +1,13 @@
 import math
-from collections import defaultdict
+import multiprocessing
+import os
+import re
+from collections import defaultdict, deque
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor
 
-from myapp.search.objects import Document
+from myapp.search.results import RankedResults
+from myapp.search.tokenizer import Tokenizer
 
 import nltk
 from nltk.corpus import stopwords
@@ -36,9 +42,28 @@ def preproces_text(text):
     tokens = [STEMMER.stem(t) for t in tokens]
     return tokens
 
+# Same tokens as preproces_text, with stem / text caches and the fast tokenization mode
+TOKENIZER = Tokenizer(EN_STOP_WORDS, STEMMER, mode="regex")
+
 # We apply it to all the search engine
 def _tokenize(text):
-    return preproces_text(text)
+    return TOKENIZER.tokenize(text)
+
+# Quoted parts of a query are phrases: their terms must appear at consecutive positions
+_PHRASE_RE = re.compile(r'"([^"]+)"')
+
+def parse_query(query):
+    """
+    Terms of the query and its quoted phrases.
+    :return: (terms, phrases) with the terms of the whole query (quotes ignored) and a tuple of terms
+        per quoted phrase (stop words are removed, as in the index, so phrase positions stay consecutive)
+    """
+    if not isinstance(query, str):
+        return [], ()
+    phrases = tuple(
+        phrase for phrase in (tuple(_tokenize(match)) for match in _PHRASE_RE.findall(query)) if phrase
+    )
+    return _tokenize(query), phrases
 
 
 # Dictionary used for our search
@@ -71,6 +96,20 @@ def _doc_fields(doc):
     return fields
 
 
+# Postings of a single doc, as build_indexes computes them: term -> [positions], term -> {fields}, doc length
+def doc_postings(doc):
+    positions = defaultdict(list)
+    fields_of_term = defaultdict(set)
+    fields = _doc_fields(doc)
+    pos = 0
+    for field_name, terms in zip(fields.keys(), TOKENIZER.tokenize_many(fields.values())):
+        for term in terms:
+            positions[term].append(pos)
+            fields_of_term[term].add(field_name)
+            pos += 1
+    return positions, fields_of_term, pos
+
+
 # Wieghts for the fields
 field_weights = {
     "title": 0.9,
@@ -83,28 +122,26 @@ field_weights = {
 }
 
 # Function to create all the needed indexes at the start of the web
-def build_indexes(corpus):
-    # term -> pid -> [positions]
-    index = defaultdict(lambda: defaultdict(list))
-    # term -> pid -> {fields}
-    field_index = defaultdict(lambda: defaultdict(set))
-    # pid -> doc_lenght
-    doc_length = {}
+# With workers > 1 the corpus is split in chunks indexed by a process pool and then merged,
+# giving exactly the same indexes as the serial build (positions are per document).
+# The pool forks its workers (build the indexes before starting other threads): with spawn they would
+# import the web app (and build its engine) again, so without fork the indexes are built serially.
+# corpus is a pid -> Document dict or an iterable of Documents (e.g. streamed by iter_documents).
+def build_indexes(corpus, workers=1):
+    if workers is None or workers <= 0:
+        workers = os.cpu_count() or 1
 
-    for pid, doc in corpus.items():
-        fields = _doc_fields(doc)
-
-        pos = 0
-        for field_name, text in fields.items():
-            terms = _tokenize(text)
-            for term in terms:
-                # Positions of the term at the doc
-                index[term][pid].append(pos)
-                # Which fields appers the term
-                field_index[term][pid].add(field_name)
-                pos += 1
-        if pos > 0:
-            doc_length[pid] = pos
+    can_fork = "fork" in multiprocessing.get_all_start_methods()
+    if workers > 1 and can_fork and (not isinstance(corpus, Mapping) or len(corpus) > workers):
+        index, field_index, doc_length = _build_indexes_parallel(corpus, workers)
+    else:
+        # term -> pid -> [positions]
+        index = defaultdict(lambda: defaultdict(list))
+        # term -> pid -> {fields}
+        field_index = defaultdict(lambda: defaultdict(set))
+        # pid -> doc_lenght
+        doc_length = {}
+        _index_docs(_corpus_items(corpus), index, field_index, doc_length)
     if not doc_length:
         return {}, {}, {}, {}, 0.0
 
@@ -120,6 +157,66 @@ def build_indexes(corpus):
             idf[term] = 0.0
     return index, field_index, idf, doc_length, avgdl
 
+def _corpus_items(corpus):
+    if isinstance(corpus, Mapping):
+        return corpus.items()
+    return ((doc.pid, doc) for doc in corpus)
+
+# Add the postings of (pid, Document) items to the indexes (term -> pid -> positions / fields, pid -> length)
+def _index_docs(items, index, field_index, doc_length):
+    for pid, doc in items:
+        positions, fields_of_term, length = doc_postings(doc)
+        for term, term_positions in positions.items():
+            index[term][pid] = term_positions
+            field_index[term][pid] = fields_of_term[term]
+        if length > 0:
+            doc_length[pid] = length
+
+# Partial indexes of a chunk of (pid, Document) items, built in a worker process.
+# defaultdict(dict) (no lambda), so they can be sent back to the parent process.
+def _build_partial_indexes(items):
+    index = defaultdict(dict)
+    field_index = defaultdict(dict)
+    doc_length = {}
+    _index_docs(items, index, field_index, doc_length)
+    return index, field_index, doc_length
+
+def _chunks(items, size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def _build_indexes_parallel(corpus, workers, chunk_size=2_000, chunks_per_worker=2):
+    index = defaultdict(lambda: defaultdict(list))
+    field_index = defaultdict(lambda: defaultdict(set))
+    doc_length = {}
+
+    def merge(part):
+        part_index, part_fields, part_lengths = part
+        for term, postings in part_index.items():
+            index[term].update(postings)
+        for term, postings in part_fields.items():
+            field_index[term].update(postings)
+        doc_length.update(part_lengths)
+
+    # The corpus is read as the pool needs it: at most chunks_per_worker chunks per worker are in flight
+    # (pool.map would submit the whole stream at once). Chunks are contiguous and merged in corpus order,
+    # so terms and pids keep the serial insertion order.
+    pending = deque()
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("fork")) as pool:
+        for chunk in _chunks(_corpus_items(corpus), chunk_size):
+            pending.append(pool.submit(_build_partial_indexes, chunk))
+            if len(pending) >= workers * chunks_per_worker:
+                merge(pending.popleft().result())
+        while pending:
+            merge(pending.popleft().result())
+    return index, field_index, doc_length
+
 # Our ranking algorithm
 def rank_documents_ours(terms,docs,index,field_index,idf,doc_length,avgdl,k1=1.2,b=0.75,):
     if not docs or not doc_length:
@@ -158,12 +255,21 @@ def rank_documents_ours(terms,docs,index,field_index,idf,doc_length,avgdl,k1=1.2
     return result_docs, doc_scores_list
 
 # We do the search
-def search_in_corpus(query,search_id,corpus,index,field_index,idf,doc_length,avgdl,):
+# With a scorer (TermAtATimeScorer) the candidate selection and the ranking walk the postings arrays
+# instead of the dictionaries, with the same candidates and scores.
+# mask (boolean array over the scorer doc ids, see DocumentColumns) restricts the search to the docs
+# passing the structured filters; quoted phrases (and the proximity boost) also need the scorer.
+# Returns a RankedResults handle: documents are only read when a result is displayed.
+def search_in_corpus(query,search_id,corpus,index,field_index,idf,doc_length,avgdl,scorer=None,k1=1.2,b=0.75,mask=None,):
     if not query or not corpus:
-        return []
-    terms = _tokenize(query)
+        return RankedResults([], None, search_id, corpus)
+    terms, phrases = parse_query(query)
     if not terms:
-        return []
+        return RankedResults([], None, search_id, corpus)
+
+    if scorer is not None:
+        ranked_pids, scores = scorer.search(terms, k1, b, mask=mask, phrases=phrases)
+        return RankedResults(ranked_pids, scores, search_id, corpus)
 
     # Docs that have all the terms
     candidate_docs = None
@@ -186,21 +292,22 @@ def search_in_corpus(query,search_id,corpus,index,field_index,idf,doc_length,avg
                 candidate_docs.update(postings.keys())
 
     if not candidate_docs:
-        return []
+        return RankedResults([], None, search_id, corpus)
 
     candidate_docs_list = list(candidate_docs)
-    ranked_pids, _scores = rank_documents_ours(terms,candidate_docs_list,index,field_index,idf,doc_length,avgdl,)
-
-    if not ranked_pids:
-        return []
+    ranked_pids, scores = rank_documents_ours(terms,candidate_docs_list,index,field_index,idf,doc_length,avgdl,k1,b,)
 
-    results = []
-    for pid in ranked_pids:
-        orig_doc = corpus[pid]
+    return RankedResults(ranked_pids, [x[0] for x in scores], search_id, corpus)
 
-        data = orig_doc.model_dump()
-        data["url"] = f"doc_details?pid={orig_doc.pid}&search_id={search_id}"
-
-        doc_copy = Document(**data)
-        results.append(doc_copy)
-    return results
+# Only the best k results (for the page that is rendered), plus the total number of hits for the counter.
+# With columns (DocumentColumns) the brand / category / sub_category facets of all the hits are counted too.
+def search_top_k_in_corpus(query,search_id,corpus,scorer,k,k1=1.2,b=0.75,mask=None,columns=None,):
+    if not query or not corpus:
+        return RankedResults([], None, search_id, corpus)
+    terms, phrases = parse_query(query)
+    if not terms:
+        return RankedResults([], None, search_id, corpus)
+    hits = scorer.hits(terms, mask, phrases)
+    ranked_pids, scores, total_hits = scorer.top_k(terms, k, k1, b, hits=hits)
+    facets = columns.facets(hits) if columns is not None else None
+    return RankedResults(ranked_pids, scores, search_id, corpus, total_hits=total_hits, facets=facets)
@@ -0,0 +1,391 @@
+import hashlib
+import json
+import mmap
+import os
+import struct
+import tempfile
+from collections.abc import Mapping
+from functools import lru_cache
+
+import numpy as np
+
+# Compact index file layout (all sections 8-byte aligned, little endian):
+#   header    magic, version, corpus sha256, body sha256, counts and section offsets
+#   meta      json: field names, pids (doc id order), terms (term id order), avgdl
+#   doc_len   uint32[num_docs]
+#   idf       float64[num_terms]
+#   df        uint32[num_terms]
+#   directory uint64[num_terms, 5]: start of the doc, mask, tf and position streams of each term + end
+#   postings  varint streams
+#
+# Per term the postings are stored column-wise as four varint streams:
+#   doc ids (first absolute, then deltas), field bitmasks, term frequencies and
+#   positions (first of each posting absolute, then deltas within the posting).
+# Column-wise streams can be decoded with numpy without a python loop per posting.
+COMPACT_MAGIC = b"IRWACIX\0"
+COMPACT_VERSION = 1
+_HEADER = struct.Struct("<8sH6x32s32sIIIxxxxQQQQQQQQ")
+_ALIGN = 8
+
+
+def _encode_varints(values):
+    values = np.asarray(values, dtype=np.uint64)
+    if values.size == 0:
+        return b""
+    nbytes = np.ones(values.size, dtype=np.int64)
+    rest = values >> np.uint64(7)
+    while rest.any():
+        nbytes += rest > 0
+        rest >>= np.uint64(7)
+    starts = np.cumsum(nbytes) - nbytes
+    owner = np.repeat(np.arange(values.size), nbytes)
+    k = np.arange(int(nbytes.sum())) - starts[owner]
+    out = ((values[owner] >> (np.uint64(7) * k.astype(np.uint64))) & np.uint64(0x7F)).astype(np.uint8)
+    out[k != nbytes[owner] - 1] |= 0x80
+    return out.tobytes()
+
+
+def _decode_varints(buf):
+    if buf.size == 0:
+        return np.zeros(0, dtype=np.uint64)
+    ends = np.flatnonzero(buf < 0x80)
+    starts = np.empty_like(ends)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+    owner = np.repeat(np.arange(ends.size), ends - starts + 1)
+    k = np.arange(buf.size) - starts[owner]
+    values = (buf & 0x7F).astype(np.uint64) << (np.uint64(7) * k.astype(np.uint64))
+    return np.add.reduceat(values, starts)
+
+
+def _pad(f):
+    extra = (-f.tell()) % _ALIGN
+    if extra:
+        f.write(b"\0" * extra)
+
+
+def write_compact_index(path, corpus_hash, index, field_index, idf, doc_length, avgdl):
+    """
+    Write the indexes returned by build_indexes as a compact, memory-mappable file.
+    Doc ids follow the order of doc_length (the corpus order), so postings keep the same order.
+    :param path: output file
+    :param corpus_hash: checksum of the corpus file the indexes were built from
+    """
+    pids = list(doc_length.keys())
+    pid_to_doc = {pid: i for i, pid in enumerate(pids)}
+    terms = list(index.keys())
+    fields = sorted({f for postings in field_index.values() for fs in postings.values() for f in fs})
+    field_bit = {f: 1 << i for i, f in enumerate(fields)}
+
+    streams = []
+    directory = np.zeros((len(terms), 5), dtype=np.uint64)
+    offset = 0
+    for tid, term in enumerate(terms):
+        postings = index[term]
+        term_fields = field_index.get(term, {})
+        order = sorted(postings.keys(), key=pid_to_doc.__getitem__)
+        docs = np.fromiter((pid_to_doc[pid] for pid in order), dtype=np.int64, count=len(order))
+        masks = [sum(field_bit[f] for f in term_fields.get(pid, ())) for pid in order]
+        tfs = [len(postings[pid]) for pid in order]
+        positions = []
+        for pid in order:
+            prev = 0
+            for p in postings[pid]:
+                positions.append(p - prev)
+                prev = p
+
+        doc_deltas = np.diff(docs, prepend=0)
+        for col, values in enumerate((doc_deltas, masks, tfs, positions)):
+            encoded = _encode_varints(values)
+            directory[tid, col] = offset
+            streams.append(encoded)
+            offset += len(encoded)
+        directory[tid, 4] = offset
+
+    meta = json.dumps({"fields": fields, "pids": pids, "terms": terms, "avgdl": float(avgdl)}).encode("utf-8")
+    doc_len = np.fromiter((doc_length[pid] for pid in pids), dtype=np.uint32, count=len(pids))
+    idf_arr = np.fromiter((idf.get(term, 0.0) for term in terms), dtype=np.float64, count=len(terms))
+    df = np.fromiter((len(index[term]) for term in terms), dtype=np.uint32, count=len(terms))
+
+    directory_name = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory_name, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory_name, prefix=".cidx-")
+    try:
+        with os.fdopen(fd, "w+b") as f:
+            f.write(b"\0" * _HEADER.size)
+            _pad(f)
+            meta_off = f.tell()
+            f.write(meta)
+            _pad(f)
+            doc_len_off = f.tell()
+            f.write(doc_len.tobytes())
+            _pad(f)
+            idf_off = f.tell()
+            f.write(idf_arr.tobytes())
+            _pad(f)
+            df_off = f.tell()
+            f.write(df.tobytes())
+            _pad(f)
+            dir_off = f.tell()
+            f.write(directory.tobytes())
+            _pad(f)
+            post_off = f.tell()
+            for chunk in streams:
+                f.write(chunk)
+
+            body_start = _HEADER.size + (-_HEADER.size) % _ALIGN
+            f.seek(body_start)
+            digest = hashlib.sha256()
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+
+            f.seek(0)
+            f.write(_HEADER.pack(
+                COMPACT_MAGIC,
+                COMPACT_VERSION,
+                bytes.fromhex(corpus_hash),
+                digest.digest(),
+                len(pids),
+                len(terms),
+                len(fields),
+                meta_off,
+                len(meta),
+                doc_len_off,
+                idf_off,
+                df_off,
+                dir_off,
+                post_off,
+                offset,
+            ))
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class CompactPostings(Mapping):
+    """pid -> [positions] (or pid -> {fields} when `fields` is True) for a single term."""
+
+    def __init__(self, compact, tid, fields=False):
+        self._compact = compact
+        self._tid = tid
+        self._fields = fields
+
+    def _lookup(self, pid):
+        doc = self._compact.pid_to_doc.get(pid)
+        if doc is None:
+            return None, None
+        decoded = self._compact.decode_term(self._tid)
+        i = int(np.searchsorted(decoded.docs, doc))
+        if i == decoded.docs.size or decoded.docs[i] != doc:
+            return None, None
+        return decoded, i
+
+    def __getitem__(self, pid):
+        decoded, i = self._lookup(pid)
+        if decoded is None:
+            raise KeyError(pid)
+        if self._fields:
+            return self._compact.field_sets[decoded.masks[i]]
+        return decoded.positions[decoded.offsets[i]:decoded.offsets[i + 1]].tolist()
+
+    def get(self, pid, default=None):
+        decoded, i = self._lookup(pid)
+        if decoded is None:
+            return default
+        if self._fields:
+            return self._compact.field_sets[decoded.masks[i]]
+        return decoded.positions[decoded.offsets[i]:decoded.offsets[i + 1]].tolist()
+
+    def __contains__(self, pid):
+        return self._lookup(pid)[0] is not None
+
+    def __iter__(self):
+        pids = self._compact.pids
+        return (pids[d] for d in self._compact.decode_term(self._tid).docs.tolist())
+
+    def __len__(self):
+        return int(self._compact.df[self._tid])
+
+
+class _CompactTermIndex(Mapping):
+    """term -> CompactPostings, used as `index` (positions) or `field_index` (field sets)."""
+
+    def __init__(self, compact, fields):
+        self._compact = compact
+        self._fields = fields
+
+    def __getitem__(self, term):
+        tid = self._compact.term_to_id[term]
+        return CompactPostings(self._compact, tid, self._fields)
+
+    def get(self, term, default=None):
+        tid = self._compact.term_to_id.get(term)
+        if tid is None:
+            return default
+        return CompactPostings(self._compact, tid, self._fields)
+
+    def __contains__(self, term):
+        return term in self._compact.term_to_id
+
+    def __iter__(self):
+        return iter(self._compact.terms)
+
+    def __len__(self):
+        return len(self._compact.terms)
+
+
+class _CompactDocLength(Mapping):
+    """pid -> number of indexed tokens, read from the mapped doc length array."""
+
+    def __init__(self, compact):
+        self._compact = compact
+
+    def __getitem__(self, pid):
+        return int(self._compact.doc_len[self._compact.pid_to_doc[pid]])
+
+    def get(self, pid, default=None):
+        doc = self._compact.pid_to_doc.get(pid)
+        if doc is None:
+            return default
+        return int(self._compact.doc_len[doc])
+
+    def __contains__(self, pid):
+        return pid in self._compact.pid_to_doc
+
+    def __iter__(self):
+        return iter(self._compact.pids)
+
+    def __len__(self):
+        return len(self._compact.pids)
+
+
+class DecodedPostings:
+    """Decoded postings of one term: sorted doc ids, field masks, tfs and flattened positions."""
+
+    __slots__ = ("docs", "masks", "tfs", "offsets", "positions")
+
+    def __init__(self, docs, masks, tfs, offsets, positions):
+        self.docs = docs
+        self.masks = masks
+        self.tfs = tfs
+        self.offsets = offsets
+        self.positions = positions
+
+
+class CompactIndex:
+    """
+    Read-only view over a compact index file.
+    The file is memory mapped, so processes opening the same file share its pages. Only the json metadata
+    (pids, terms) and the recently used decoded postings are private to each process.
+    `index`, `field_index`, `idf`, `doc_length` and `avgdl` can be passed to the ranking functions
+    in place of the dictionaries returned by build_indexes.
+    """
+
+    def __init__(self, path, corpus_hash=None, decoded_cache_size=4096):
+        self.path = path
+        self._file = open(path, "rb")
+        try:
+            self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self._file.close()
+            raise
+
+        if len(self._mm) < _HEADER.size:
+            self.close()
+            raise ValueError("Compact index file is truncated")
+        (
+            magic, version, snap_corpus, digest, num_docs, num_terms, num_fields,
+            meta_off, meta_len, doc_len_off, idf_off, df_off, dir_off, post_off, post_len,
+        ) = _HEADER.unpack_from(self._mm, 0)
+        if magic != COMPACT_MAGIC or version != COMPACT_VERSION:
+            self.close()
+            raise ValueError("Not a compact index file (or unsupported version)")
+        if corpus_hash is not None and snap_corpus != bytes.fromhex(corpus_hash):
+            self.close()
+            raise ValueError("Compact index was built from another corpus")
+        body_start = _HEADER.size + (-_HEADER.size) % _ALIGN
+        if post_off + post_len != len(self._mm) or self._body_digest(body_start) != digest:
+            self.close()
+            raise ValueError("Compact index checksum mismatch")
+
+        meta = json.loads(self._mm[meta_off:meta_off + meta_len].decode("utf-8"))
+        self.fields = meta["fields"]
+        self.pids = meta["pids"]
+        self.terms = meta["terms"]
+        self.avgdl = meta["avgdl"]
+        self.pid_to_doc = {pid: i for i, pid in enumerate(self.pids)}
+        self.term_to_id = {term: i for i, term in enumerate(self.terms)}
+
+        self.doc_len = np.frombuffer(self._mm, dtype=np.uint32, count=num_docs, offset=doc_len_off)
+        idf_arr = np.frombuffer(self._mm, dtype=np.float64, count=num_terms, offset=idf_off)
+        self._directory = np.frombuffer(self._mm, dtype=np.uint64, count=num_terms * 5, offset=dir_off).reshape(-1, 5)
+        self._postings = np.frombuffer(self._mm, dtype=np.uint8, count=post_len, offset=post_off)
+
+        # Field bitmask -> set of field names, for every possible mask
+        self.field_sets = [
+            {f for bit, f in enumerate(self.fields) if mask & (1 << bit)}
+            for mask in range(1 << len(self.fields))
+        ]
+        self.df = np.frombuffer(self._mm, dtype=np.uint32, count=num_terms, offset=df_off)
+
+        self.decode_term = lru_cache(maxsize=decoded_cache_size)(self._decode_term)
+
+        self.index = _CompactTermIndex(self, fields=False)
+        self.field_index = _CompactTermIndex(self, fields=True)
+        self.idf = dict(zip(self.terms, idf_arr.tolist()))
+        self.doc_length = _CompactDocLength(self)
+
+    @classmethod
+    def open(cls, path, corpus_hash=None):
+        """
+        Open a compact index file.
+        :return: the CompactIndex, or None when the file is missing, stale or corrupted.
+        """
+        if not os.path.exists(path):
+            return None
+        try:
+            return cls(path, corpus_hash)
+        except ValueError:
+            return None
+
+    def _body_digest(self, start, chunk_size=1 << 20):
+        digest = hashlib.sha256()
+        with memoryview(self._mm) as view:
+            for i in range(start, len(view), chunk_size):
+                digest.update(view[i:i + chunk_size])
+        return digest.digest()
+
+    def _decode_term(self, tid):
+        bounds = self._directory[tid]
+        streams = [
+            _decode_varints(self._postings[int(bounds[col]):int(bounds[col + 1])])
+            for col in range(4)
+        ]
+        docs = np.cumsum(streams[0]).astype(np.int64)
+        masks = streams[1].astype(np.int64)
+        tfs = streams[2].astype(np.int64)
+        offsets = np.zeros(tfs.size + 1, dtype=np.int64)
+        np.cumsum(tfs, out=offsets[1:])
+        # Positions were delta encoded inside each posting: cumulative sum, then remove the running
+        # total reached at the end of the previous posting
+        cum = np.cumsum(streams[3]).astype(np.int64)
+        base = np.zeros(tfs.size, dtype=np.int64)
+        if tfs.size > 1:
+            base[1:] = cum[offsets[1:-1] - 1]
+        positions = cum - np.repeat(base, tfs)
+        return DecodedPostings(docs, masks, tfs, offsets, positions)
+
+    def indexes(self):
+        """(index, field_index, idf, doc_length, avgdl), same shape as build_indexes."""
+        return self.index, self.field_index, self.idf, self.doc_length, self.avgdl
+
+    def close(self):
+        # numpy views keep the mmap buffer exported, drop them before closing it
+        for name in ("doc_len", "df", "_directory", "_postings"):
+            self.__dict__.pop(name, None)
+        if hasattr(self, "decode_term"):
+            self.decode_term.cache_clear()
+        self._mm.close()
+        self._file.close()
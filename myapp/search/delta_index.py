@@ -0,0 +1,271 @@
+import math
+from collections import Counter
+from collections.abc import Mapping
+
+from myapp.search.algorithms import doc_postings
+
+
+class _TermView(Mapping):
+    """term -> postings of the live docs (base segment without the tombstoned docs + delta segment)."""
+
+    def __init__(self, segments, fields):
+        self._segments = segments
+        self._fields = fields
+
+    def __getitem__(self, term):
+        postings = self._segments.postings(term, self._fields)
+        if postings is None:
+            raise KeyError(term)
+        return postings
+
+    def get(self, term, default=None):
+        postings = self._segments.postings(term, self._fields)
+        return default if postings is None else postings
+
+    def __contains__(self, term):
+        return self._segments.df(term) > 0
+
+    def __iter__(self):
+        return self._segments.terms()
+
+    def __len__(self):
+        return sum(1 for _ in self._segments.terms())
+
+
+class _DocLengthView(Mapping):
+    """pid -> length of the live docs."""
+
+    def __init__(self, segments):
+        self._segments = segments
+
+    def __getitem__(self, pid):
+        length = self._segments.length(pid)
+        if length is None:
+            raise KeyError(pid)
+        return length
+
+    def get(self, pid, default=None):
+        length = self._segments.length(pid)
+        return default if length is None else length
+
+    def __contains__(self, pid):
+        return self._segments.length(pid) is not None
+
+    def __iter__(self):
+        tombstones = self._segments._tombstones
+        for pid in self._segments._base_doc_length:
+            if pid not in tombstones:
+                yield pid
+        yield from self._segments._delta_doc_length
+
+    def __len__(self):
+        return self._segments.num_docs
+
+
+class _IdfView(Mapping):
+    """term -> idf over the live docs, log(N / df) as in build_indexes."""
+
+    def __init__(self, segments):
+        self._segments = segments
+
+    def __getitem__(self, term):
+        idf = self._segments.idf_of(term)
+        if idf is None:
+            raise KeyError(term)
+        return idf
+
+    def get(self, term, default=None):
+        idf = self._segments.idf_of(term)
+        return default if idf is None else idf
+
+    def __contains__(self, term):
+        return self._segments.df(term) > 0
+
+    def __iter__(self):
+        return self._segments.terms()
+
+    def __len__(self):
+        return sum(1 for _ in self._segments.terms())
+
+
+class DeltaIndex:
+    """
+    Indexes that can be updated without a full rebuild.
+    The base segment (the indexes of build_indexes, a snapshot or a compact index) is never modified:
+    deleted or replaced docs are tombstoned and upserted docs go to an in-memory delta segment.
+    `index`, `field_index`, `idf` and `doc_length` are Mapping views over both segments, used like the
+    dictionaries returned by build_indexes; df, N and the total length are kept up to date so idf and
+    avgdl are the same as after a rebuild. merge() folds the delta segment into plain dictionaries.
+    """
+
+    def __init__(self, index, field_index, idf, doc_length, avgdl):
+        self._base_index = index
+        self._base_field_index = field_index
+        self._base_idf = idf
+        self._base_doc_length = doc_length
+        # term -> pid -> [positions] / {fields}, pid -> length, pid -> terms of the delta docs
+        self._delta_index = {}
+        self._delta_field_index = {}
+        self._delta_doc_length = {}
+        self._delta_terms = {}
+        # Base pids that were deleted or replaced, and how many of them contain each term
+        self._tombstones = set()
+        self._tombstoned_df = Counter()
+        self._df = {}
+        self._changed = False
+
+        self.num_docs = len(doc_length)
+        self.total_length = sum(doc_length.values())
+        self.avgdl = avgdl
+
+        self.index = _TermView(self, fields=False)
+        self.field_index = _TermView(self, fields=True)
+        self.idf = _IdfView(self)
+        self.doc_length = _DocLengthView(self)
+
+    def indexes(self):
+        """The views, in the order returned by build_indexes."""
+        return self.index, self.field_index, self.idf, self.doc_length, self.avgdl
+
+    @property
+    def delta_size(self):
+        """Number of docs in the delta segment plus tombstoned base docs, used to decide when to merge."""
+        return len(self._delta_doc_length) + len(self._tombstones)
+
+    def length(self, pid):
+        length = self._delta_doc_length.get(pid)
+        if length is None and pid not in self._tombstones:
+            length = self._base_doc_length.get(pid)
+        return length
+
+    def df(self, term):
+        df = self._df.get(term)
+        if df is None:
+            base = self._base_index.get(term)
+            df = (len(base) if base else 0) - self._tombstoned_df.get(term, 0)
+            df += len(self._delta_index.get(term, ()))
+            self._df[term] = df
+        return df
+
+    def idf_of(self, term):
+        if not self._changed:
+            return self._base_idf.get(term)
+        df = self.df(term)
+        if df <= 0:
+            return None
+        return math.log(self.num_docs / df)
+
+    def postings(self, term, fields=False):
+        base = (self._base_field_index if fields else self._base_index).get(term)
+        delta = (self._delta_field_index if fields else self._delta_index).get(term)
+        if not delta and not self._tombstoned_df.get(term):
+            return base if base else None
+        merged = {}
+        if base:
+            tombstones = self._tombstones
+            merged = {pid: value for pid, value in base.items() if pid not in tombstones}
+        if delta:
+            merged.update(delta)
+        return merged or None
+
+    def terms(self):
+        for term in self._base_index:
+            if term in self._delta_index or self.df(term) > 0:
+                yield term
+        for term in self._delta_index:
+            if term not in self._base_index:
+                yield term
+
+    def _remove(self, pid, old_doc):
+        """Remove the live version of `pid`; returns the terms whose postings changed."""
+        length = self._delta_doc_length.pop(pid, None)
+        if length is not None:
+            terms = self._delta_terms.pop(pid)
+            for term in terms:
+                for delta in (self._delta_index, self._delta_field_index):
+                    postings = delta[term]
+                    del postings[pid]
+                    if not postings:
+                        del delta[term]
+        elif pid in self._base_doc_length and pid not in self._tombstones:
+            # The base segment has no forward index: the terms come from the indexed version of the doc,
+            # without them the df of its terms would stay wrong
+            if old_doc is None:
+                raise ValueError(f"Document {pid} is in the base segment: its indexed version is needed")
+            length = self._base_doc_length[pid]
+            terms = list(doc_postings(old_doc)[0])
+            self._tombstones.add(pid)
+            self._tombstoned_df.update(terms)
+        else:
+            return set()
+        self.num_docs -= 1
+        self.total_length -= length
+        return set(terms)
+
+    def _after_change(self, terms):
+        self._changed = True
+        for term in terms:
+            self._df.pop(term, None)
+        self.avgdl = self.total_length / float(self.num_docs) if self.num_docs else 0.0
+
+    def upsert(self, doc, old_doc=None):
+        """
+        Index `doc`, replacing the live version of the same pid.
+        :param old_doc: version of the doc that is currently indexed (needed when it is in the base segment)
+        :return: the terms whose postings changed
+        :raises ValueError: the doc is in the base segment and old_doc is not given
+        """
+        changed = self._remove(doc.pid, old_doc)
+        positions, fields_of_term, length = doc_postings(doc)
+        if length > 0:
+            for term, pos in positions.items():
+                self._delta_index.setdefault(term, {})[doc.pid] = pos
+                self._delta_field_index.setdefault(term, {})[doc.pid] = fields_of_term[term]
+            self._delta_doc_length[doc.pid] = length
+            self._delta_terms[doc.pid] = list(positions)
+            self.num_docs += 1
+            self.total_length += length
+            changed.update(positions)
+        self._after_change(changed)
+        return changed
+
+    def delete(self, pid, old_doc=None):
+        """
+        Remove `pid` from the indexes; returns the terms whose postings changed.
+        :param old_doc: version of the doc that is currently indexed (needed when it is in the base segment)
+        :raises ValueError: the doc is in the base segment and old_doc is not given
+        """
+        changed = self._remove(pid, old_doc)
+        self._after_change(changed)
+        return changed
+
+    def merge(self):
+        """
+        Fold the delta segment and the tombstones into plain dictionaries.
+        A base built in memory (dicts) is updated in place, only the changed terms are touched;
+        a snapshot or compact base is copied into dictionaries.
+        :return: (index, field_index, idf, doc_length, avgdl) as returned by build_indexes
+        """
+        if isinstance(self._base_index, dict) and isinstance(self._base_doc_length, dict):
+            index, field_index = self._base_index, self._base_field_index
+            doc_length = self._base_doc_length
+            for term in set(self._tombstoned_df) | set(self._delta_index):
+                for target, fields in ((index, False), (field_index, True)):
+                    postings = self.postings(term, fields)
+                    if postings is None:
+                        target.pop(term, None)
+                    else:
+                        target[term] = dict(postings)
+            for pid in self._tombstones:
+                doc_length.pop(pid, None)
+            doc_length.update(self._delta_doc_length)
+        else:
+            index = {term: dict(self.postings(term)) for term in self.terms()}
+            field_index = {term: dict(self.postings(term, True)) for term in index}
+            doc_length = dict(self.doc_length)
+
+        if not doc_length:
+            return {}, {}, {}, {}, 0.0
+        N = len(doc_length)
+        idf = {term: math.log(N / len(postings)) for term, postings in index.items()}
+        return index, field_index, idf, doc_length, self.avgdl
@@ -0,0 +1,323 @@
+import hashlib
+import json
+import mmap
+import os
+import struct
+import tempfile
+from collections.abc import MutableMapping
+
+import numpy as np
+
+from myapp.search.objects import Document
+
+# Document store file layout (all sections 8-byte aligned, little endian):
+#   header    magic, version, corpus sha256, body sha256, counts and section offsets
+#   meta      json: numeric, text and json column names
+#   numeric   float64[num_numeric, num_docs], NaN for missing values (out_of_stock as 0 / 1)
+#   nulls     uint8[num_text, num_docs], 1 when the text (or json) value is None
+#   offsets   uint64[num_text, num_docs + 1], start of each value in the text section + end
+#   text      utf-8 values, column after column (json columns are json encoded)
+#
+# Rows follow the order of the documents given to write_document_store (the corpus order).
+DOC_STORE_MAGIC = b"IRWADOC\0"
+DOC_STORE_VERSION = 1
+_HEADER = struct.Struct("<8sH6x32s32sIIIxxxxQQQQQQQ")
+_ALIGN = 8
+
+NUMERIC_FIELDS = ("selling_price", "discount", "actual_price", "average_rating", "out_of_stock")
+JSON_FIELDS = ("product_details", "images")
+TEXT_FIELDS = tuple(f for f in Document.model_fields if f not in NUMERIC_FIELDS and f not in JSON_FIELDS)
+
+
+def _pad(f):
+    extra = (-f.tell()) % _ALIGN
+    if extra:
+        f.write(b"\0" * extra)
+
+
+def write_document_store(path, corpus_hash, docs):
+    """
+    Write the documents as a columnar, memory-mappable file.
+    :param path: output file
+    :param corpus_hash: checksum of the corpus file the documents were read from
+    :param docs: iterable of Document (e.g. iter_documents), consumed once
+    """
+    text_columns = TEXT_FIELDS + JSON_FIELDS
+    numeric = [[] for _ in NUMERIC_FIELDS]
+    blobs = [bytearray() for _ in text_columns]
+    ends = [[] for _ in text_columns]
+    nulls = [[] for _ in text_columns]
+    num_docs = 0
+    for doc in docs:
+        num_docs += 1
+        for col, name in enumerate(NUMERIC_FIELDS):
+            value = getattr(doc, name)
+            numeric[col].append(np.nan if value is None else float(value))
+        for col, name in enumerate(text_columns):
+            value = getattr(doc, name)
+            nulls[col].append(value is None)
+            if value is not None:
+                blobs[col] += (json.dumps(value) if name in JSON_FIELDS else str(value)).encode("utf-8")
+            ends[col].append(len(blobs[col]))
+
+    numeric_arr = np.array(numeric, dtype=np.float64).reshape(len(NUMERIC_FIELDS), num_docs)
+    nulls_arr = np.array(nulls, dtype=np.uint8).reshape(len(text_columns), num_docs)
+    offsets = np.zeros((len(text_columns), num_docs + 1), dtype=np.uint64)
+    start = 0
+    for col in range(len(text_columns)):
+        offsets[col, 0] = start
+        offsets[col, 1:] = np.asarray(ends[col], dtype=np.uint64) + start
+        start += len(blobs[col])
+
+    meta = json.dumps({"numeric": NUMERIC_FIELDS, "text": TEXT_FIELDS, "json": JSON_FIELDS}).encode("utf-8")
+
+    directory_name = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory_name, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory_name, prefix=".docs-")
+    try:
+        with os.fdopen(fd, "w+b") as f:
+            f.write(b"\0" * _HEADER.size)
+            _pad(f)
+            meta_off = f.tell()
+            f.write(meta)
+            _pad(f)
+            numeric_off = f.tell()
+            f.write(numeric_arr.tobytes())
+            _pad(f)
+            nulls_off = f.tell()
+            f.write(nulls_arr.tobytes())
+            _pad(f)
+            offsets_off = f.tell()
+            f.write(offsets.tobytes())
+            _pad(f)
+            text_off = f.tell()
+            for blob in blobs:
+                f.write(blob)
+
+            body_start = _HEADER.size + (-_HEADER.size) % _ALIGN
+            f.seek(body_start)
+            digest = hashlib.sha256()
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+
+            f.seek(0)
+            f.write(_HEADER.pack(
+                DOC_STORE_MAGIC,
+                DOC_STORE_VERSION,
+                bytes.fromhex(corpus_hash),
+                digest.digest(),
+                num_docs,
+                len(NUMERIC_FIELDS),
+                len(text_columns),
+                meta_off,
+                len(meta),
+                numeric_off,
+                nulls_off,
+                offsets_off,
+                text_off,
+                start,
+            ))
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class StoredDocument:
+    """
+    Lazy, read-only Document view over one row of a DocumentStore.
+    Attributes are decoded from the store when they are read; model_dump / to_json / to_document
+    give the same values as the original Document.
+    """
+
+    __slots__ = ("_store", "_row")
+
+    def __init__(self, store, row):
+        self._store = store
+        self._row = row
+
+    def __getattr__(self, name):
+        return self._store.value(self._row, name)
+
+    def model_dump(self):
+        return {name: self._store.value(self._row, name) for name in Document.model_fields}
+
+    def to_document(self):
+        """Materialize the row as a Document (values are not validated again)."""
+        return Document.model_construct(**self.model_dump())
+
+    def to_json(self):
+        return self.to_document().model_dump_json()
+
+    def __str__(self):
+        return str(self.to_document())
+
+
+class DocumentStore(MutableMapping):
+    """
+    pid -> document mapping over a document store file, used in place of the dict of Documents.
+    The file is memory mapped, so processes opening the same file share its pages: only the pid -> row
+    dict and the overlay are private to each process. Numeric fields are NumPy arrays indexed by row
+    (`column(name)`), text fields are decoded on access through StoredDocument views.
+    Upserted documents are kept in an in-memory overlay and deleted ones are hidden; the file is
+    never modified.
+    """
+
+    def __init__(self, path, corpus_hash=None):
+        self.path = path
+        self._file = open(path, "rb")
+        try:
+            self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self._file.close()
+            raise
+
+        if len(self._mm) < _HEADER.size:
+            self.close()
+            raise ValueError("Document store file is truncated")
+        (
+            magic, version, store_corpus, digest, num_docs, num_numeric, num_text,
+            meta_off, meta_len, numeric_off, nulls_off, offsets_off, text_off, text_len,
+        ) = _HEADER.unpack_from(self._mm, 0)
+        if magic != DOC_STORE_MAGIC or version != DOC_STORE_VERSION:
+            self.close()
+            raise ValueError("Not a document store file (or unsupported version)")
+        if corpus_hash is not None and store_corpus != bytes.fromhex(corpus_hash):
+            self.close()
+            raise ValueError("Document store was built from another corpus")
+        body_start = _HEADER.size + (-_HEADER.size) % _ALIGN
+        if text_off + text_len != len(self._mm) or self._body_digest(body_start) != digest:
+            self.close()
+            raise ValueError("Document store checksum mismatch")
+
+        meta = json.loads(self._mm[meta_off:meta_off + meta_len].decode("utf-8"))
+        self.num_rows = num_docs
+        self._numeric = np.frombuffer(
+            self._mm, dtype=np.float64, count=num_numeric * num_docs, offset=numeric_off
+        ).reshape(num_numeric, num_docs)
+        self._nulls = np.frombuffer(
+            self._mm, dtype=np.uint8, count=num_text * num_docs, offset=nulls_off
+        ).reshape(num_text, num_docs)
+        self._offsets = np.frombuffer(
+            self._mm, dtype=np.uint64, count=num_text * (num_docs + 1), offset=offsets_off
+        ).reshape(num_text, num_docs + 1)
+        self._text_off = text_off
+
+        # field name -> (kind, column)
+        self._columns = {name: ("numeric", col) for col, name in enumerate(meta["numeric"])}
+        for col, name in enumerate(meta["text"] + meta["json"]):
+            self._columns[name] = ("json" if name in meta["json"] else "text", col)
+
+        self.pids = [self._text(self._columns["pid"][1], row) for row in range(num_docs)]
+        self.pid_to_row = {pid: row for row, pid in enumerate(self.pids)}
+        # pid -> Document upserted after the file was written, base pids deleted since
+        self._overlay = {}
+        self._deleted = set()
+
+    @classmethod
+    def open(cls, path, corpus_hash=None):
+        """
+        Open a document store file.
+        :return: the DocumentStore, or None when the file is missing, stale or corrupted.
+        """
+        if not os.path.exists(path):
+            return None
+        try:
+            return cls(path, corpus_hash)
+        except ValueError:
+            return None
+
+    def _body_digest(self, start, chunk_size=1 << 20):
+        digest = hashlib.sha256()
+        with memoryview(self._mm) as view:
+            for i in range(start, len(view), chunk_size):
+                digest.update(view[i:i + chunk_size])
+        return digest.digest()
+
+    def _text(self, col, row):
+        if self._nulls[col, row]:
+            return None
+        start = self._text_off + int(self._offsets[col, row])
+        end = self._text_off + int(self._offsets[col, row + 1])
+        return self._mm[start:end].decode("utf-8")
+
+    def value(self, row, name):
+        """Value of field `name` for the base row `row`, as in the Document."""
+        column = self._columns.get(name)
+        if column is None:
+            raise AttributeError(name)
+        kind, col = column
+        if kind == "numeric":
+            value = self._numeric[col, row]
+            if name == "out_of_stock":
+                return bool(value)
+            return None if np.isnan(value) else float(value)
+        text = self._text(col, row)
+        if kind == "json" and text is not None:
+            return json.loads(text)
+        return text
+
+    def column(self, name):
+        """NumPy array of a numeric field over the base rows (NaN for missing values, bool for out_of_stock)."""
+        kind, col = self._columns[name]
+        if kind != "numeric":
+            raise KeyError(name)
+        if name == "out_of_stock":
+            return self._numeric[col] != 0.0
+        return self._numeric[col]
+
+    def base_rows(self, pids):
+        """Row of each pid in the file, -1 for pids that are not served by the file (new, upserted, deleted)."""
+        rows = np.full(len(pids), -1, dtype=np.int64)
+        for i, pid in enumerate(pids):
+            row = self.pid_to_row.get(pid)
+            if row is not None and pid not in self._overlay and pid not in self._deleted:
+                rows[i] = row
+        return rows
+
+    def __getitem__(self, pid):
+        doc = self._overlay.get(pid)
+        if doc is not None:
+            return doc
+        row = self.pid_to_row.get(pid)
+        if row is None or pid in self._deleted:
+            raise KeyError(pid)
+        return StoredDocument(self, row)
+
+    def __setitem__(self, pid, doc):
+        self._overlay[pid] = doc
+        self._deleted.discard(pid)
+
+    def __delitem__(self, pid):
+        if pid not in self:
+            raise KeyError(pid)
+        self._overlay.pop(pid, None)
+        if pid in self.pid_to_row:
+            self._deleted.add(pid)
+
+    def __contains__(self, pid):
+        if pid in self._overlay:
+            return True
+        return pid in self.pid_to_row and pid not in self._deleted
+
+    def __iter__(self):
+        # Same order as a dict updated in place: base rows first, then the new pids
+        deleted = self._deleted
+        for pid in self.pids:
+            if pid not in deleted:
+                yield pid
+        for pid in self._overlay:
+            if pid not in self.pid_to_row:
+                yield pid
+
+    def __len__(self):
+        new = sum(1 for pid in self._overlay if pid not in self.pid_to_row)
+        return self.num_rows - len(self._deleted) + new
+
+    def close(self):
+        # numpy views keep the mmap buffer exported, drop them before closing it
+        for name in ("_numeric", "_nulls", "_offsets"):
+            self.__dict__.pop(name, None)
+        self._mm.close()
+        self._file.close()
@@ -0,0 +1,194 @@
+import numpy as np
+
+# Fields that can be used as facets, and the numeric fields copied in DocumentColumns
+FACET_FIELDS = ("brand", "category", "sub_category")
+NUMERIC_FIELDS = ("selling_price", "discount", "actual_price", "average_rating")
+
+
+def _parse_float(value):
+    if value is None:
+        return None
+    try:
+        value = float(str(value).strip())
+    except ValueError:
+        return None
+    return value if value == value else None
+
+
+class SearchFilters:
+    """
+    Structured filters of a search, None (or False) meaning no constraint.
+    Prices are in the unit of the corpus (cents); the web form shows them divided by 100.
+    """
+
+    __slots__ = ("min_price", "max_price", "min_discount", "min_rating", "in_stock",
+                 "brand", "category", "sub_category")
+
+    def __init__(self, min_price=None, max_price=None, min_discount=None, min_rating=None,
+                 in_stock=False, brand=None, category=None, sub_category=None):
+        self.min_price = min_price
+        self.max_price = max_price
+        self.min_discount = min_discount
+        self.min_rating = min_rating
+        self.in_stock = bool(in_stock)
+        self.brand = brand or None
+        self.category = category or None
+        self.sub_category = sub_category or None
+
+    @classmethod
+    def from_form(cls, form):
+        """Filters of the /search form (or of the dict saved by to_form); invalid numbers are ignored."""
+        min_price = _parse_float(form.get("min-price"))
+        max_price = _parse_float(form.get("max-price"))
+        return cls(
+            min_price=None if min_price is None else min_price * 100,
+            max_price=None if max_price is None else max_price * 100,
+            min_discount=_parse_float(form.get("min-discount")),
+            min_rating=_parse_float(form.get("min-rating")),
+            in_stock=form.get("in-stock") in ("on", "1", "true", True),
+            brand=(form.get("brand") or "").strip(),
+            category=(form.get("category") or "").strip(),
+            sub_category=(form.get("sub-category") or "").strip(),
+        )
+
+    def to_form(self):
+        """Form field -> value, to render the form again (and to keep the filters in the session)."""
+        return {
+            "min-price": "" if self.min_price is None else f"{self.min_price / 100:g}",
+            "max-price": "" if self.max_price is None else f"{self.max_price / 100:g}",
+            "min-discount": "" if self.min_discount is None else f"{self.min_discount:g}",
+            "min-rating": "" if self.min_rating is None else f"{self.min_rating:g}",
+            "in-stock": "on" if self.in_stock else "",
+            "brand": self.brand or "",
+            "category": self.category or "",
+            "sub-category": self.sub_category or "",
+        }
+
+    def key(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def is_empty(self):
+        return not any(self.key())
+
+    def __repr__(self):
+        active = ", ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__ if getattr(self, name))
+        return f"SearchFilters({active})"
+
+
+class DocumentColumns:
+    """
+    Columnar copies of the filterable Document fields, one row per scorer doc id, so filters are
+    evaluated as NumPy boolean masks over all the docs and facets are counted with np.bincount:
+    - numeric fields as float64 arrays (NaN when missing, so they never pass a numeric filter),
+    - out_of_stock as a bool array,
+    - brand / category / sub_category as int32 codes (0 for missing) into a per field vocabulary.
+    """
+
+    def __init__(self, pids, corpus):
+        n = len(pids)
+        self.numeric = {name: np.full(n, np.nan, dtype=np.float64) for name in NUMERIC_FIELDS}
+        self.out_of_stock = np.zeros(n, dtype=bool)
+        self.codes = {name: np.zeros(n, dtype=np.int32) for name in FACET_FIELDS}
+        self.values = {name: [None] for name in FACET_FIELDS}
+        self._value_codes = {name: {} for name in FACET_FIELDS}
+
+        # Numeric fields of docs served by a DocumentStore file are copied column-wise
+        base_rows = corpus.base_rows(pids) if hasattr(corpus, "base_rows") else np.full(n, -1)
+        in_base = base_rows >= 0
+        if in_base.any():
+            for name in NUMERIC_FIELDS:
+                self.numeric[name][in_base] = corpus.column(name)[base_rows[in_base]]
+            self.out_of_stock[in_base] = corpus.column("out_of_stock")[base_rows[in_base]]
+
+        for i, pid in enumerate(pids):
+            doc = corpus.get(pid)
+            if doc is None:
+                continue
+            if in_base[i]:
+                self._set_codes(i, doc)
+            else:
+                self.set_doc(i, doc)
+
+    @property
+    def num_docs(self):
+        return self.out_of_stock.size
+
+    def _code(self, field, value):
+        if not value:
+            return 0
+        codes = self._value_codes[field]
+        code = codes.get(value)
+        if code is None:
+            code = len(self.values[field])
+            codes[value] = code
+            self.values[field].append(value)
+        return code
+
+    def _set_codes(self, i, doc):
+        for name in FACET_FIELDS:
+            self.codes[name][i] = self._code(name, getattr(doc, name, None))
+
+    def set_doc(self, i, doc):
+        """Copy the fields of `doc` to row i (doc None clears the row)."""
+        for name in NUMERIC_FIELDS:
+            value = getattr(doc, name, None) if doc is not None else None
+            self.numeric[name][i] = np.nan if value is None else value
+        self.out_of_stock[i] = bool(getattr(doc, "out_of_stock", False)) if doc is not None else False
+        if doc is None:
+            for name in FACET_FIELDS:
+                self.codes[name][i] = 0
+        else:
+            self._set_codes(i, doc)
+
+    def update(self, docs, pid_to_doc):
+        """
+        Follow an incremental update of the corpus.
+        :param docs: pid -> new Document (None when deleted)
+        :param pid_to_doc: pid -> doc id of the scorer (new pids included)
+        """
+        size = max((pid_to_doc[pid] for pid in docs), default=-1) + 1
+        if size > self.num_docs:
+            extra = size - self.num_docs
+            for name in NUMERIC_FIELDS:
+                self.numeric[name] = np.concatenate([self.numeric[name], np.full(extra, np.nan)])
+            self.out_of_stock = np.concatenate([self.out_of_stock, np.zeros(extra, dtype=bool)])
+            for name in FACET_FIELDS:
+                self.codes[name] = np.concatenate([self.codes[name], np.zeros(extra, dtype=np.int32)])
+        for pid, doc in docs.items():
+            self.set_doc(pid_to_doc[pid], doc)
+
+    def mask(self, filters):
+        """Boolean mask over the doc ids of the docs that pass `filters`, or None when there is no filter."""
+        if filters is None or filters.is_empty():
+            return None
+        mask = np.ones(self.num_docs, dtype=bool)
+        price = self.numeric["selling_price"]
+        if filters.min_price is not None:
+            mask &= price >= filters.min_price
+        if filters.max_price is not None:
+            mask &= price <= filters.max_price
+        if filters.min_discount is not None:
+            mask &= self.numeric["discount"] >= filters.min_discount
+        if filters.min_rating is not None:
+            mask &= self.numeric["average_rating"] >= filters.min_rating
+        if filters.in_stock:
+            mask &= ~self.out_of_stock
+        for name in FACET_FIELDS:
+            value = getattr(filters, name)
+            if value:
+                code = self._value_codes[name].get(value)
+                if code is None:
+                    mask[:] = False
+                else:
+                    mask &= self.codes[name] == code
+        return mask
+
+    def facets(self, docs, limit=20):
+        """field -> [(value, count), ...] over the doc ids `docs`, most frequent values first."""
+        facets = {}
+        for name in FACET_FIELDS:
+            counts = np.bincount(self.codes[name][docs], minlength=len(self.values[name]))
+            counts[0] = 0
+            top = np.argsort(-counts, kind="stable")[:limit]
+            facets[name] = [(self.values[name][c], int(counts[c])) for c in top if counts[c] > 0]
+        return facets
@@ -0,0 +1,159 @@
+import hashlib
+import marshal
+import os
+import struct
+import sys
+import tempfile
+from collections.abc import Mapping
+
+# Snapshot layout:
+#   magic | format version | python version | corpus sha256 | payload sha256 | payload length | payload
+# The payload is a marshal dump, so the python version is part of the header and a
+# snapshot written by another interpreter is simply rebuilt.
+SNAPSHOT_MAGIC = b"IRWAIDX\0"
+SNAPSHOT_VERSION = 1
+_HEADER = struct.Struct("<8sHBB32s32sQ")
+
+
+def file_checksum(path, chunk_size=1 << 20):
+    """
+    sha256 of a file, read in chunks so big corpus files are not loaded in memory.
+    :param path: file to hash
+    :param chunk_size: bytes read per iteration
+    :return: hex digest
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class _TermBlobs:
+    """Per-term marshal blobs, decoded only the first time a term is requested."""
+
+    def __init__(self, blobs):
+        self._blobs = blobs
+        self._decoded = {}
+
+    def decode(self, term):
+        entry = self._decoded.get(term)
+        if entry is None:
+            blob = self._blobs.get(term)
+            if blob is None:
+                return None
+            entry = marshal.loads(blob)
+            self._decoded[term] = entry
+        return entry
+
+
+class LazyIndex(Mapping):
+    """
+    Read-only term -> {pid: value} mapping backed by a snapshot.
+    `which` selects the positional postings (0) or the field postings (1) of each term blob,
+    so `index` and `field_index` share the same decoded entries.
+    """
+
+    def __init__(self, term_blobs, which):
+        self._term_blobs = term_blobs
+        self._which = which
+
+    def __getitem__(self, term):
+        entry = self._term_blobs.decode(term)
+        if entry is None:
+            raise KeyError(term)
+        return entry[self._which]
+
+    def get(self, term, default=None):
+        entry = self._term_blobs.decode(term)
+        if entry is None:
+            return default
+        return entry[self._which]
+
+    def __contains__(self, term):
+        return term in self._term_blobs._blobs
+
+    def __iter__(self):
+        return iter(self._term_blobs._blobs)
+
+    def __len__(self):
+        return len(self._term_blobs._blobs)
+
+
+def save_index_snapshot(path, corpus_hash, index, field_index, idf, doc_length, avgdl):
+    """
+    Write the indexes returned by build_indexes to `path`.
+    The file is written next to the target and renamed, so concurrent workers never read a half written snapshot.
+    :param path: snapshot file
+    :param corpus_hash: checksum of the corpus file the indexes were built from
+    """
+    blobs = {}
+    for term, postings in index.items():
+        fields = field_index.get(term, {})
+        blobs[term] = marshal.dumps((dict(postings), {pid: set(f) for pid, f in fields.items()}))
+
+    payload = marshal.dumps({
+        "blobs": blobs,
+        "idf": dict(idf),
+        "doc_length": dict(doc_length),
+        "avgdl": float(avgdl),
+    })
+    header = _HEADER.pack(
+        SNAPSHOT_MAGIC,
+        SNAPSHOT_VERSION,
+        sys.version_info[0],
+        sys.version_info[1],
+        bytes.fromhex(corpus_hash),
+        hashlib.sha256(payload).digest(),
+        len(payload),
+    )
+
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".snapshot-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(header)
+            f.write(payload)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def load_index_snapshot(path, corpus_hash):
+    """
+    Load a snapshot written by save_index_snapshot.
+    :param path: snapshot file
+    :param corpus_hash: checksum of the current corpus file
+    :return: (index, field_index, idf, doc_length, avgdl), or None when the snapshot is missing,
+     stale, written by another format/python version or corrupted.
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        raw_header = f.read(_HEADER.size)
+        if len(raw_header) != _HEADER.size:
+            return None
+        magic, version, py_major, py_minor, snap_corpus, digest, length = _HEADER.unpack(raw_header)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            return None
+        if (py_major, py_minor) != sys.version_info[:2]:
+            return None
+        if snap_corpus != bytes.fromhex(corpus_hash):
+            return None
+        payload = f.read(length)
+
+    if len(payload) != length or hashlib.sha256(payload).digest() != digest:
+        return None
+
+    data = marshal.loads(payload)
+    term_blobs = _TermBlobs(data["blobs"])
+    return (
+        LazyIndex(term_blobs, 0),
+        LazyIndex(term_blobs, 1),
+        data["idf"],
+        data["doc_length"],
+        data["avgdl"],
+    )
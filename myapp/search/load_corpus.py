@@ -1,29 +1,97 @@
-import pandas as pd
+import json
+from itertools import islice
+
+from pydantic import TypeAdapter
 
 from myapp.search.objects import Document
-from typing import List, Dict
+from typing import Dict, Iterator, List
+
+# Validates a whole batch of records in one call
+_DOCUMENT_BATCH = TypeAdapter(List[Document])
 
 
-def load_corpus(path) -> List[Document]:
+def load_corpus(path) -> Dict[str, Document]:
     """
     Load file and transform to dictionary with each document as an object for easier treatment when needed for displaying
      in results, stats, etc.
-    :param path:
-    :return:
+    :param path: JSON array or JSON Lines file
+    :return: pid -> Document
     """
-    df = pd.read_json(path)
-    corpus = _build_corpus(df)
+    corpus = {}
+    for _ in iter_documents(path, into=corpus):
+        pass
     return corpus
 
-def _build_corpus(df: pd.DataFrame) -> Dict[str, Document]:
+
+def iter_documents(path, batch_size=1000, into=None) -> Iterator[Document]:
     """
-    Build corpus from dataframe
-    :param df:
-    :return:
+    Stream the documents of the file, without loading the whole file.
+    Records are parsed one by one (JSON array or JSON Lines) and validated by batches.
+    :param path: JSON array or JSON Lines file
+    :param batch_size: records validated together
+    :param into: optional dict where each document is also stored by pid, so the corpus can be filled
+        while the documents are indexed
+    :return: generator of Document
     """
-    corpus = {}
-    for _, row in df.iterrows():
-        doc = Document(**row.to_dict())
-        corpus[doc.pid] = doc
-    return corpus
+    with open(path, encoding="utf-8") as f:
+        records = _iter_records(f)
+        while True:
+            batch = list(islice(records, batch_size))
+            if not batch:
+                return
+            for doc in _DOCUMENT_BATCH.validate_python(batch):
+                if into is not None:
+                    into[doc.pid] = doc
+                yield doc
+
+
+def _iter_records(f, chunk_size=1 << 16):
+    # The first non blank character tells a JSON array from JSON Lines
+    head = f.read(chunk_size)
+    stripped = head.lstrip()
+    if stripped.startswith("["):
+        yield from _iter_json_array(f, stripped, chunk_size)
+        return
+    # Lines end at "\n" only, as when iterating on the file: str.splitlines also breaks on characters
+    # such as U+2028 that JSON strings may contain
+    lines = head.split("\n")
+    # The last line of the first chunk can be incomplete
+    rest = lines.pop()
+    for line in lines:
+        if line.strip():
+            yield json.loads(line)
+    for line in f:
+        line = rest + line
+        rest = ""
+        if line.strip():
+            yield json.loads(line)
+    if rest.strip():
+        yield json.loads(rest)
+
 
+def _iter_json_array(f, buf, chunk_size):
+    decoder = json.JSONDecoder()
+    pos = 1
+    while True:
+        # Skip the separators, reading more when the buffer is exhausted
+        while pos < len(buf) and buf[pos] in " \t\r\n,":
+            pos += 1
+        if pos == len(buf):
+            chunk = f.read(chunk_size)
+            if not chunk:
+                raise ValueError("Unterminated JSON array")
+            buf, pos = chunk, 0
+            continue
+        if buf[pos] == "]":
+            return
+        try:
+            record, end = decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError:
+            # The record continues in the next chunk
+            chunk = f.read(chunk_size)
+            if not chunk:
+                raise
+            buf, pos = buf[pos:] + chunk, 0
+            continue
+        yield record
+        pos = end
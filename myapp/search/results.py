@@ -0,0 +1,78 @@
+from collections.abc import Sequence
+
+
+class ResultView:
+    """
+    Lightweight view of one ranked document, created only for the results that are rendered.
+    Attributes are read from the corpus document; `url` (link to the details page) and
+    `ranking` (retrieval score) are computed for this search.
+    """
+
+    __slots__ = ("_doc", "_search_id", "ranking")
+
+    def __init__(self, doc, search_id, ranking=None):
+        self._doc = doc
+        self._search_id = search_id
+        self.ranking = ranking
+
+    @property
+    def url(self):
+        return f"doc_details?pid={self._doc.pid}&search_id={self._search_id}"
+
+    def __getattr__(self, name):
+        return getattr(self._doc, name)
+
+    def to_json(self):
+        data = self._doc.model_dump()
+        data["url"] = self.url
+        data["ranking"] = self.ranking
+        return data
+
+
+class RankedResults(Sequence):
+    """
+    Ranked (pid, score) list returned by a search.
+    Indexing or slicing it gives ResultView objects, built on demand, so a query with thousands of hits
+    only creates views for the page (or the RAG context) that uses them.
+    `total_hits` is the number of documents that matched, which can be larger than the ranked list
+    when only the top k was computed. `facets` holds the facet counts of all the hits, when computed.
+    """
+
+    def __init__(self, pids, scores, search_id, corpus, total_hits=None, facets=None):
+        self.pids = pids
+        self.scores = scores
+        self.search_id = search_id
+        self.corpus = corpus
+        self.total_hits = len(pids) if total_hits is None else total_hits
+        self.facets = facets
+
+    def _view(self, i):
+        score = float(self.scores[i]) if self.scores is not None else None
+        return ResultView(self.corpus[self.pids[i]], self.search_id, score)
+
+    def __len__(self):
+        return len(self.pids)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self._view(j) for j in range(*i.indices(len(self.pids)))]
+        if i < 0:
+            i += len(self.pids)
+        if not 0 <= i < len(self.pids):
+            raise IndexError("result index out of range")
+        return self._view(i)
+
+    def page(self, page, per_page):
+        """Views of the results shown in the 1-based `page`."""
+        start = (page - 1) * per_page
+        return self[start:start + per_page]
+
+    def ranking(self):
+        """(pid, rank) pairs, rank starting at 1, without touching the documents."""
+        return zip(self.pids, range(1, len(self.pids) + 1))
+
+    def head(self, k, search_id):
+        """First k results (all of them when k is None) as a new handle for another search id."""
+        pids = self.pids if k is None else self.pids[:k]
+        scores = self.scores if k is None or self.scores is None else self.scores[:k]
+        return RankedResults(pids, scores, search_id, self.corpus, total_hits=self.total_hits, facets=self.facets)
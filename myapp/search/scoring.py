@@ -0,0 +1,462 @@
+import numpy as np
+
+from myapp.core.cache import LRUCache
+from myapp.search.algorithms import field_weights
+
+_MISSING = object()
+
+
+class TermPostings:
+    """Scoring view of one term: sorted doc ids, term frequencies and field coefficients per posting."""
+
+    __slots__ = ("docs", "tfs", "coeffs")
+
+    def __init__(self, docs, tfs, coeffs):
+        self.docs = docs
+        self.tfs = tfs
+        self.coeffs = coeffs
+
+
+def _field_coeff(fields):
+    # Same expression as rank_documents_ours, so the coefficients are the same floats
+    if fields:
+        return sum(field_weights.get(f, 0.0) for f in fields)
+    return 0.0
+
+
+class TermAtATimeScorer:
+    """
+    BM25 + field weights scorer that walks the postings of each query term instead of looking up
+    every candidate doc in every term.
+    Docs get integer ids (doc_length order) and scores are accumulated in a NumPy array indexed by doc id.
+    Per term, doc ids, tfs and field coefficients are precomputed the first time the term is queried;
+    per doc length norms are precomputed once per (k1, b).
+    Scores are computed with the same float operations, in the same order, as rank_documents_ours,
+    so they are bit-for-bit identical.
+    """
+
+    PRUNE_FACTOR = 4
+    PRUNE_MIN_CANDIDATES = 1024
+    # Upper bounds are keyed by (term, k1, b, idf, avgdl); stale keys pile up while the index is updated
+    MAX_UPPER_BOUNDS = 65536
+
+    def __init__(self, index, field_index, idf, doc_length, avgdl, compact=None, term_cache_size=4096,
+                 proximity_weight=0.0, proximity_window=5):
+        self.index = index
+        self.field_index = field_index
+        self.idf = idf
+        self.avgdl = avgdl
+        self.compact = compact
+
+        if compact is not None:
+            self.pids = compact.pids
+            self.pid_to_doc = compact.pid_to_doc
+            self.doc_len = compact.doc_len.astype(np.float64)
+            self._mask_coeffs = np.array([_field_coeff(fs) for fs in compact.field_sets], dtype=np.float64)
+        else:
+            self.pids = list(doc_length.keys())
+            self.pid_to_doc = {pid: i for i, pid in enumerate(self.pids)}
+            self.doc_len = np.fromiter(doc_length.values(), dtype=np.float64, count=len(self.pids))
+
+        self._pid_array = np.array(self.pids, dtype=object)
+        self._norms = {}
+        self._upper_bounds = {}
+        self._term_cache = LRUCache(maxsize=term_cache_size)
+        self._positions_cache = LRUCache(maxsize=term_cache_size)
+        # Boost of the docs where adjacent query terms appear within proximity_window positions (0 = off)
+        self.proximity_weight = proximity_weight
+        self.proximity_window = proximity_window
+        # Terms changed by incremental updates: their compact postings are stale, the index views are used
+        self._stale_terms = set()
+
+    @property
+    def num_docs(self):
+        return len(self.pids)
+
+    def term_postings(self, term):
+        """TermPostings of `term` (None when it is not indexed), built the first time the term is queried."""
+        postings = self._term_cache.get(term, _MISSING)
+        if postings is _MISSING:
+            postings = self._build_term_postings(term)
+            self._term_cache.set(term, postings)
+        return postings
+
+    def _build_term_postings(self, term):
+        if self.compact is not None and term not in self._stale_terms:
+            tid = self.compact.term_to_id.get(term)
+            if tid is None:
+                return None
+            decoded = self.compact.decode_term(tid)
+            return TermPostings(decoded.docs, decoded.tfs.astype(np.float64), self._mask_coeffs[decoded.masks])
+
+        postings = self.index.get(term)
+        if not postings:
+            return None
+        term_fields = self.field_index.get(term, {})
+        n = len(postings)
+        docs = np.empty(n, dtype=np.int64)
+        tfs = np.empty(n, dtype=np.float64)
+        coeffs = np.empty(n, dtype=np.float64)
+        for i, (pid, positions) in enumerate(postings.items()):
+            docs[i] = self.pid_to_doc[pid]
+            tfs[i] = len(positions)
+            coeffs[i] = _field_coeff(term_fields.get(pid))
+        order = np.argsort(docs, kind="stable")
+        return TermPostings(docs[order], tfs[order], coeffs[order])
+
+    def term_positions(self, term):
+        """
+        (doc id, position) of every occurrence of `term` as two arrays sorted by doc id and position,
+        or None when the term is not indexed.
+        """
+        positions = self._positions_cache.get(term, _MISSING)
+        if positions is _MISSING:
+            positions = self._build_term_positions(term)
+            self._positions_cache.set(term, positions)
+        return positions
+
+    def _build_term_positions(self, term):
+        if self.compact is not None and term not in self._stale_terms:
+            tid = self.compact.term_to_id.get(term)
+            if tid is None:
+                return None
+            decoded = self.compact.decode_term(tid)
+            return np.repeat(decoded.docs, decoded.tfs), decoded.positions
+
+        postings = self.index.get(term)
+        if not postings:
+            return None
+        docs = []
+        positions = []
+        for pid, term_positions in postings.items():
+            docs.extend([self.pid_to_doc[pid]] * len(term_positions))
+            positions.extend(term_positions)
+        docs = np.array(docs, dtype=np.int64)
+        positions = np.array(positions, dtype=np.int64)
+        order = np.lexsort((positions, docs))
+        return docs[order], positions[order]
+
+    def _positions_in(self, term, allowed):
+        docs, positions = self.term_positions(term)
+        keep = allowed[docs]
+        return docs[keep], positions[keep]
+
+    def phrase_docs(self, phrase, candidates):
+        """
+        Doc ids of the sorted array `candidates` where the terms of `phrase` appear at consecutive positions.
+        Candidates without every phrase term are dropped before looking at positions, then the positions
+        are intersected from the rarest term, stopping as soon as no doc is left.
+        """
+        if not phrase or candidates.size == 0:
+            return candidates
+        for term in set(phrase):
+            postings = self.term_postings(term)
+            if postings is None:
+                return np.zeros(0, dtype=np.int64)
+            candidates = np.intersect1d(candidates, postings.docs, assume_unique=True)
+            if candidates.size == 0:
+                return candidates
+        if len(phrase) == 1:
+            return candidates
+
+        # Occurrence i of the phrase starts at position p - i: key = doc * stride + start (shifted to be >= 0)
+        n = len(phrase)
+        stride = int(self.doc_len.max()) + n + 1
+        allowed = np.zeros(self.num_docs, dtype=bool)
+        allowed[candidates] = True
+        keys = None
+        for i in sorted(range(n), key=lambda i: self.term_postings(phrase[i]).docs.size):
+            docs, positions = self._positions_in(phrase[i], allowed)
+            term_keys = docs * stride + (positions + (n - i))
+            keys = term_keys if keys is None else np.intersect1d(keys, term_keys, assume_unique=True)
+            if keys.size == 0:
+                return np.zeros(0, dtype=np.int64)
+            allowed[:] = False
+            allowed[keys // stride] = True
+        return np.unique(keys // stride)
+
+    def _proximity_terms(self, terms, indexed=None):
+        """Distinct query terms the proximity pairs are made of: the indexed ones, in query order."""
+        if indexed is None:
+            indexed = [t for t in terms if self.term_postings(t) is not None]
+        return list(dict.fromkeys(indexed))
+
+    def proximity_bound(self, terms, indexed=None):
+        """
+        Highest proximity boost a doc can get for `terms`.
+        :param indexed: the terms indexed in the whole corpus when this scorer only has a part of it
+        """
+        if not self.proximity_weight:
+            return 0.0
+        return self.proximity_weight if len(self._proximity_terms(terms, indexed)) > 1 else 0.0
+
+    def proximity_scores(self, terms, docs, indexed=None):
+        """
+        Proximity boost of each doc of the sorted array `docs`: proximity_weight times the fraction of the
+        adjacent (distinct, indexed) query term pairs that appear within proximity_window positions.
+        :param indexed: the terms indexed in the whole corpus when this scorer only has a part of it
+            (a pair with a term that has no posting here is never matched, but it counts)
+        """
+        out = np.zeros(docs.size, dtype=np.float64)
+        indexed = self._proximity_terms(terms, indexed)
+        pairs = list(zip(indexed, indexed[1:]))
+        if not self.proximity_weight or not pairs or docs.size == 0:
+            return out
+        allowed = np.zeros(self.num_docs, dtype=bool)
+        allowed[docs] = True
+        stride = int(self.doc_len.max()) + 1
+        matched = np.zeros(self.num_docs, dtype=np.float64)
+        for a, b in pairs:
+            if self.term_postings(a) is None or self.term_postings(b) is None:
+                continue
+            docs_a, pos_a = self._positions_in(a, allowed)
+            docs_b, pos_b = self._positions_in(b, allowed)
+            if docs_a.size == 0 or docs_b.size == 0:
+                continue
+            # Nearest occurrence of `a` before / after each occurrence of `b` in the sorted keys
+            keys_a = docs_a * stride + pos_a
+            idx = np.searchsorted(keys_a, docs_b * stride + pos_b)
+            near = np.zeros(docs_b.size, dtype=bool)
+            for j in (idx - 1, idx):
+                valid = (j >= 0) & (j < keys_a.size)
+                j = np.clip(j, 0, keys_a.size - 1)
+                near |= valid & (docs_a[j] == docs_b) & (np.abs(pos_a[j] - pos_b) <= self.proximity_window)
+            matched[np.unique(docs_b[near])] += 1.0
+        return self.proximity_weight * (matched[docs] / len(pairs))
+
+    def norms(self, k1, b):
+        """k1 * ((1 - b) + b * Ld / avgdl) for every doc, the length part of the BM25 denominator."""
+        key = (k1, b, self.avgdl)
+        norm = self._norms.get(key)
+        if norm is None:
+            norm = k1 * ((1.0 - b) + b * (self.doc_len / self.avgdl))
+            self._norms = {key: norm}
+        return norm
+
+    def term_scores(self, term, k1=1.2, b=0.75):
+        """(doc ids, score contribution) of every posting of `term`, or None when the term does not score."""
+        postings = self.term_postings(term)
+        if postings is None:
+            return None
+        term_idf = self.idf.get(term, 0.0)
+        if term_idf == 0.0:
+            return None
+        denom = self.norms(k1, b)[postings.docs] + postings.tfs
+        scores = term_idf * ((k1 + 1.0) * postings.tfs) / denom
+        scores *= postings.coeffs
+        return postings.docs, scores
+
+    def upper_bound(self, term, k1=1.2, b=0.75):
+        """Highest score contribution of `term` over all its postings (0.0 when the term does not score)."""
+        key = (term, k1, b, self.idf.get(term, 0.0), self.avgdl)
+        bound = self._upper_bounds.get(key)
+        if bound is None:
+            scored = self.term_scores(term, k1, b)
+            bound = float(scored[1].max()) if scored is not None and scored[1].size else 0.0
+            if len(self._upper_bounds) >= self.MAX_UPPER_BOUNDS:
+                self._upper_bounds.clear()
+            self._upper_bounds[key] = bound
+        return bound
+
+    def update(self, changed_terms, doc_lengths, avgdl):
+        """
+        Follow an incremental update of the indexes (DeltaIndex).
+        :param changed_terms: terms whose postings changed, rebuilt from the index views on next use
+        :param doc_lengths: pid -> new length of the upserted / deleted docs (0 when deleted);
+            new pids get the next doc ids
+        :param avgdl: new average doc length
+        """
+        if self.compact is not None and self.pids is self.compact.pids:
+            # Doc ids of the compact index are kept, new docs are numbered after them
+            self.pids = list(self.pids)
+            self.pid_to_doc = dict(self.pid_to_doc)
+        new_pids = [pid for pid in doc_lengths if pid not in self.pid_to_doc]
+        if new_pids:
+            for pid in new_pids:
+                self.pid_to_doc[pid] = len(self.pids)
+                self.pids.append(pid)
+            self.doc_len = np.concatenate([self.doc_len, np.zeros(len(new_pids), dtype=np.float64)])
+            self._pid_array = np.array(self.pids, dtype=object)
+        for pid, length in doc_lengths.items():
+            self.doc_len[self.pid_to_doc[pid]] = length
+
+        self.avgdl = avgdl
+        self._norms = {}
+        self._upper_bounds = {}
+        for term in changed_terms:
+            self._stale_terms.add(term)
+            self._term_cache.pop(term)
+            self._positions_cache.pop(term)
+
+    def _gather_scores(self, term, docs, k1, b):
+        """Score contribution of `term` for each doc of the sorted array `docs` (0.0 for docs without the term)."""
+        out = np.zeros(docs.size, dtype=np.float64)
+        postings = self.term_postings(term)
+        term_idf = self.idf.get(term, 0.0)
+        if postings is None or term_idf == 0.0 or docs.size == 0:
+            return out
+        pos = np.searchsorted(postings.docs, docs)
+        pos[pos == postings.docs.size] = 0
+        hit = postings.docs[pos] == docs
+        pos = pos[hit]
+        tfs = postings.tfs[pos]
+        scores = term_idf * ((k1 + 1.0) * tfs) / (self.norms(k1, b)[docs[hit]] + tfs)
+        scores *= postings.coeffs[pos]
+        out[hit] = scores
+        return out
+
+    def _candidates(self, terms, mask=None):
+        lists = [p.docs for p in map(self.term_postings, terms) if p is not None]
+        if mask is not None:
+            lists = [docs[mask[docs]] for docs in lists]
+        if not lists:
+            return np.zeros(0, dtype=np.int64), True
+        lists.sort(key=len)
+        docs = lists[0]
+        for other in lists[1:]:
+            if docs.size == 0:
+                break
+            docs = np.intersect1d(docs, other, assume_unique=True)
+        if docs.size == 0:
+            return np.unique(np.concatenate(lists)), False
+        return docs, True
+
+    def match(self, terms, mask=None):
+        """
+        (candidate doc ids, True when they contain all the terms / False when no doc does and they
+        contain at least one of them).
+        """
+        return self._candidates(terms, mask)
+
+    def candidates(self, terms, mask=None):
+        """
+        Doc ids of the docs that contain all the (indexed) terms, or at least one of them when no doc
+        contains them all. Same semantics as search_in_corpus.
+        :param mask: boolean array over the doc ids (structured filters), docs outside it are never candidates
+        """
+        return self._candidates(terms, mask)[0]
+
+    def hits(self, terms, mask=None, phrases=(), candidates=None):
+        """
+        Sorted doc ids of the docs that search() returns for `terms` (the candidates with a scoring term).
+        :param phrases: tuples of terms that must appear at consecutive positions
+        :param candidates: (doc ids, all terms matched) from match(), when the caller already computed it
+        """
+        indexed = [t for t in terms if self.term_postings(t) is not None]
+        scoring = [t for t in indexed if self.idf.get(t, 0.0) != 0.0]
+        candidates, all_terms = self._candidates(terms, mask) if candidates is None else candidates
+        if not scoring or candidates.size == 0:
+            return np.zeros(0, dtype=np.int64)
+        # Only docs containing at least one scoring term are hits (search() skips terms with idf 0).
+        # When every candidate contains every term, or every term scores, all the candidates are hits.
+        if not all_terms and len(scoring) != len(indexed):
+            hits = np.unique(np.concatenate([self.term_postings(t).docs for t in set(scoring)]))
+            candidates = np.intersect1d(candidates, hits, assume_unique=True)
+        for phrase in phrases:
+            candidates = self.phrase_docs(phrase, candidates)
+        return candidates
+
+    def score(self, terms, candidates=None, k1=1.2, b=0.75):
+        """
+        Accumulate the scores of `terms`, term by term.
+        :param candidates: sorted doc ids allowed to score, or None for every doc
+        :return: (doc ids, scores) of the docs touched by at least one term, by doc id
+        """
+        acc = np.zeros(self.num_docs, dtype=np.float64)
+        touched = np.zeros(self.num_docs, dtype=bool)
+        allowed = None
+        if candidates is not None:
+            allowed = np.zeros(self.num_docs, dtype=bool)
+            allowed[candidates] = True
+
+        for term in terms:
+            scored = self.term_scores(term, k1, b)
+            if scored is None:
+                continue
+            docs, scores = scored
+            if allowed is not None:
+                keep = allowed[docs]
+                docs = docs[keep]
+                scores = scores[keep]
+            acc[docs] += scores
+            touched[docs] = True
+
+        docs = np.flatnonzero(touched)
+        return docs, acc[docs] + self.proximity_scores(terms, docs)
+
+    def top_k(self, terms, k, k1=1.2, b=0.75, mask=None, hits=None, phrases=(), indexed=None):
+        """
+        Exact top k of search(terms) without scoring the whole candidate set (MaxScore).
+        Terms are visited by decreasing score upper bound. After each term, the k-th best partial score is
+        a lower bound of the k-th best final score, and docs whose partial score plus the upper bounds of the
+        terms still to visit cannot reach it are dropped. The survivors are scored in query term order, so
+        their scores are the same as in search(). The proximity boost is bounded by proximity_bound(),
+        which is part of the upper bound of every doc until the final scoring.
+        :param mask: boolean array over the doc ids (structured filters), applied before scoring
+        :param hits: result of hits(terms, mask, phrases) when the caller already computed it
+        :param phrases: tuples of terms that must appear at consecutive positions
+        :param indexed: the terms indexed in the whole corpus, for the proximity pairs (see proximity_scores)
+        :return: (top k pids, their scores, total number of hits)
+        """
+        candidates = self.hits(terms, mask, phrases) if hits is None else hits
+        scoring = [t for t in terms if self.term_postings(t) is not None and self.idf.get(t, 0.0) != 0.0]
+        if k < 1 or candidates.size == 0:
+            return [], np.zeros(0, dtype=np.float64), int(candidates.size)
+        total = int(candidates.size)
+
+        # Pruning only pays off when there are many more candidates than results
+        if total > max(self.PRUNE_FACTOR * k, self.PRUNE_MIN_CANDIDATES):
+            bounds = [self.upper_bound(t, k1, b) for t in scoring]
+            order = sorted(range(len(scoring)), key=lambda i: -bounds[i])
+            remaining = sum(bounds) + self.proximity_bound(terms, indexed)
+            live = candidates
+            partial = np.zeros(live.size, dtype=np.float64)
+            for i in order:
+                partial += self._gather_scores(scoring[i], live, k1, b)
+                remaining -= bounds[i]
+                if live.size <= k:
+                    break
+                threshold = np.partition(partial, live.size - k)[live.size - k]
+                # Small slack: partial sums are accumulated in another order than the final scores
+                keep = partial + max(remaining, 0.0) >= threshold - 1e-9 * max(1.0, threshold)
+                live = live[keep]
+                partial = partial[keep]
+            candidates = live
+
+        scores = np.zeros(candidates.size, dtype=np.float64)
+        for term in terms:
+            scores += self._gather_scores(term, candidates, k1, b)
+        scores += self.proximity_scores(terms, candidates, indexed)
+        if candidates.size > k:
+            top = np.argpartition(-scores, k - 1)[:k]
+            # Keep every doc tied with the k-th score, ties are resolved by doc id below
+            kth = scores[top].min()
+            top = np.flatnonzero(scores >= kth)
+            candidates = candidates[top]
+            scores = scores[top]
+        pids, scores = self._sorted(candidates, scores)
+        return pids[:k], scores[:k], total
+
+    def _sorted(self, docs, scores):
+        # Best score first, ties by doc id
+        order = np.lexsort((docs, -scores))
+        return self._pid_array[docs[order]].tolist(), scores[order]
+
+    def rank(self, terms, docs, k1=1.2, b=0.75):
+        """Drop-in replacement of rank_documents_ours: (ranked pids, [[score, pid], ...])."""
+        if not docs or not self.num_docs:
+            return [], []
+        candidates = np.unique(np.fromiter(
+            (self.pid_to_doc[pid] for pid in docs if pid in self.pid_to_doc), dtype=np.int64
+        ))
+        ranked, scores = self._sorted(*self.score(terms, candidates, k1, b))
+        return ranked, [[score, pid] for score, pid in zip(scores.tolist(), ranked)]
+
+    def search(self, terms, k1=1.2, b=0.75, mask=None, phrases=()):
+        """Candidate selection + ranking of search_in_corpus: (ranked pids, scores array)."""
+        candidates = self.candidates(terms, mask)
+        for phrase in phrases:
+            candidates = self.phrase_docs(phrase, candidates)
+        if candidates.size == 0:
+            return [], np.zeros(0, dtype=np.float64)
+        return self._sorted(*self.score(terms, candidates, k1, b))
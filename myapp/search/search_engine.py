@@ -1,8 +1,18 @@
+import hashlib
 import random
+import threading
 import numpy as np
 
 from myapp.search.objects import Document
-from myapp.search.algorithms import search_in_corpus, build_indexes
+from myapp.core.cache import LRUCache
+from myapp.search.algorithms import parse_query, search_in_corpus, search_top_k_in_corpus, build_indexes
+from myapp.search.delta_index import DeltaIndex
+from myapp.search.document_store import DocumentStore, write_document_store
+from myapp.search.filters import DocumentColumns
+from myapp.search.load_corpus import iter_documents, load_corpus
+from myapp.search.compact_index import CompactIndex, write_compact_index
+from myapp.search.index_store import file_checksum, load_index_snapshot, save_index_snapshot
+from myapp.search.scoring import TermAtATimeScorer
 
 
 def dummy_search(corpus: dict, search_id, num_results=20):
@@ -35,35 +45,248 @@ def dummy_search(corpus: dict, search_id, num_results=20):
 class SearchEngine:
     """Class that implements the search engine logic"""
 
-    # Initialize the index when the app is iniziated, so we do not have to create the indexes each time
-    def __init__(self, corpus):
-        self.corpus = corpus
+    # Rankings are cached by at least this many results, so the next pages of a query are served from the cache
+    CACHE_MIN_K = 100
+
+    # Initialize the index when the app is iniziated, so we do not have to create the indexes each time.
+    # If the corpus file and a snapshot path are given, the indexes are loaded from the snapshot when it
+    # was built from the same corpus file, and rebuilt (and saved) otherwise.
+    # With a compact_path the indexes are served from a memory-mapped compact index file instead,
+    # so several worker processes share the same postings pages.
+    # build_workers processes are used when the indexes have to be built (0 = one per CPU).
+    # Docs can then be upserted / deleted without a rebuild; the delta segment is merged into the
+    # indexes once it holds merge_threshold docs (None to only merge on merge_index()).
+    # With corpus=None the corpus is streamed from corpus_path; when the indexes have to be built
+    # the documents are indexed while they are read.
+    # With a doc_store_path (and corpus=None) the documents are served from a memory-mapped columnar
+    # document store file built from corpus_path, instead of a dict of Documents.
+    # Docs where adjacent query terms are at most proximity_window positions apart get up to
+    # proximity_weight added to their score (0 disables it); quoted phrases must match exactly.
+    def __init__(self, corpus, corpus_path=None, snapshot_path=None, compact_path=None,
+                 k1=1.2, b=0.75, result_cache_size=1024, result_cache_ttl=300, build_workers=1,
+                 merge_threshold=10_000, doc_store_path=None, proximity_weight=1.0, proximity_window=5):
+        self.corpus = corpus if corpus is not None else {}
+        self._corpus_pending = corpus is None
+        self.corpus_path = corpus_path
+        if corpus is None and doc_store_path and corpus_path:
+            self.corpus = self._load_doc_store(doc_store_path, file_checksum(corpus_path))
+            self._corpus_pending = False
+        self.snapshot_path = snapshot_path
+        self.compact_path = compact_path
+        self.k1 = k1
+        self.b = b
+        self.compact = None
+        self.build_workers = build_workers
+        self.merge_threshold = merge_threshold
+        self.proximity_weight = proximity_weight
+        self.proximity_window = proximity_window
+        # Updates and rankings are serialized, so a query never sees a half-applied update
+        self._lock = threading.RLock()
+        # (stemmed query terms, k1, b) -> RankedResults, shared by /search, pagination and /last_search
+        self.result_cache = LRUCache(maxsize=result_cache_size, ttl=result_cache_ttl)
+
+        indexes = self._load_indexes()
+        if self._corpus_pending:
+            # The indexes came from a snapshot / compact file, the documents still have to be read
+            self.corpus.update(load_corpus(self.corpus_path))
+            self._corpus_pending = False
+        self._set_indexes(indexes)
+
+        print(f"  #docs = {len(self.doc_length)}")
+        print(f"  avgdl = {self.avgdl}")
+
+    def _load_doc_store(self, doc_store_path, corpus_hash):
+        store = DocumentStore.open(doc_store_path, corpus_hash)
+        if store is not None:
+            print(f"SearchEngine: documents mapped from {doc_store_path}.")
+            return store
+        write_document_store(doc_store_path, corpus_hash, iter_documents(self.corpus_path))
+        print(f"SearchEngine: document store saved to {doc_store_path}.")
+        return DocumentStore.open(doc_store_path, corpus_hash)
+
+    def _documents(self):
+        if self._corpus_pending:
+            self._corpus_pending = False
+            return iter_documents(self.corpus_path, into=self.corpus)
+        return self.corpus
+
+    def _load_indexes(self, rebuild=False):
+        corpus_hash = file_checksum(self.corpus_path) if self.corpus_path else None
+        if self.compact_path and corpus_hash is not None:
+            return self._load_compact(self.compact_path, corpus_hash, rebuild)
+        return self._load_snapshot(self.snapshot_path, corpus_hash, rebuild)
+
+    def _load_snapshot(self, snapshot_path, corpus_hash, rebuild=False):
+        indexes = None
+        if snapshot_path and corpus_hash is not None and not rebuild:
+            indexes = load_index_snapshot(snapshot_path, corpus_hash)
+
+        if indexes is not None:
+            print(f"SearchEngine: indexes loaded from snapshot {snapshot_path}.")
+            return indexes
+
+        indexes = build_indexes(self._documents(), self.build_workers)
+        print("SearchEngine: indexes built at startup.")
+        if snapshot_path and corpus_hash is not None:
+            save_index_snapshot(snapshot_path, corpus_hash, *indexes)
+            print(f"SearchEngine: snapshot saved to {snapshot_path}.")
+        return indexes
+
+    def _load_compact(self, compact_path, corpus_hash, rebuild=False):
+        compact = None if rebuild else CompactIndex.open(compact_path, corpus_hash)
+        if compact is not None:
+            print(f"SearchEngine: compact index mapped from {compact_path}.")
+        else:
+            write_compact_index(compact_path, corpus_hash, *build_indexes(self._documents(), self.build_workers))
+            compact = CompactIndex.open(compact_path, corpus_hash)
+            print(f"SearchEngine: indexes built at startup and saved to {compact_path}.")
+        self.compact = compact
+        return compact.indexes()
+
+    def _set_indexes(self, indexes):
+        self.segments = DeltaIndex(*indexes)
         (
             self.index,
             self.field_index,
             self.idf,
             self.doc_length,
             self.avgdl,
-        ) = build_indexes(corpus)
+        ) = self.segments.indexes()
 
-        print("SearchEngine: indexes built at startup.")
-        print(f"  #docs = {len(self.doc_length)}")
-        print(f"  avgdl = {self.avgdl}")
+        self.scorer = TermAtATimeScorer(
+            self.index,
+            self.field_index,
+            self.idf,
+            self.doc_length,
+            self.avgdl,
+            compact=self.compact,
+            proximity_weight=self.proximity_weight,
+            proximity_window=self.proximity_window,
+        )
+        # Filterable fields, aligned with the scorer doc ids
+        self.columns = DocumentColumns(self.scorer.pids, self.corpus)
+        # Cached rankings were computed with the previous indexes
+        self.result_cache.clear()
+
+    def rebuild_index(self):
+        """Rebuild the indexes from the corpus (rewriting the snapshot / compact file) and drop cached results."""
+        with self._lock:
+            self._set_indexes(self._load_indexes(rebuild=True))
+
+    def upsert_documents(self, docs):
+        """
+        Add new documents or replace existing ones (same pid) in the corpus and the indexes,
+        without rebuilding them. Cached rankings are dropped.
+        """
+        with self._lock:
+            docs = list(docs)
+            changed_terms = set()
+            doc_lengths = {}
+            for doc in docs:
+                changed_terms |= self.segments.upsert(doc, self.corpus.get(doc.pid))
+                self.corpus[doc.pid] = doc
+                doc_lengths[doc.pid] = self.segments.length(doc.pid) or 0
+            self._after_update(changed_terms, doc_lengths, {doc.pid: doc for doc in docs})
+
+    def delete_documents(self, pids):
+        """Remove documents from the corpus and the indexes. Cached rankings are dropped."""
+        with self._lock:
+            changed_terms = set()
+            doc_lengths = {}
+            for pid in pids:
+                if pid not in self.corpus:
+                    continue
+                changed_terms |= self.segments.delete(pid, self.corpus.pop(pid))
+                doc_lengths[pid] = 0
+            self._after_update(changed_terms, doc_lengths, dict.fromkeys(doc_lengths))
+
+    def _after_update(self, changed_terms, doc_lengths, docs):
+        self.avgdl = self.segments.avgdl
+        self.scorer.update(changed_terms, doc_lengths, self.avgdl)
+        self.columns.update(docs, self.scorer.pid_to_doc)
+        self.result_cache.clear()
+        if self.merge_threshold is not None and self.segments.delta_size >= self.merge_threshold:
+            self.merge_index()
+
+    def merge_index(self):
+        """
+        Merge the delta segment into the indexes (plain dictionaries afterwards, the compact file is
+        no longer used) and reset the scorer.
+        """
+        with self._lock:
+            if not self.segments.delta_size:
+                return
+            indexes = self.segments.merge()
+            self.compact = None
+            self._set_indexes(indexes)
+            print(f"SearchEngine: delta segment merged, #docs = {len(self.doc_length)}")
 
+    def cache_stats(self):
+        return self.result_cache.stats()
 
-    def search(self, search_query, search_id, corpus):
-        print("Search query:", search_query)
+    def _cache_key(self, search_query, filters=None):
+        filters_key = filters.key() if filters is not None and not filters.is_empty() else None
+        terms, phrases = parse_query(search_query)
+        return tuple(terms), phrases, self.k1, self.b, filters_key
+
+    def ranking_key(self, search_query, filters=None):
+        """Digest of the result cache key of a search: searches with the same key get the same ranking."""
+        return hashlib.sha1(repr(self._cache_key(search_query, filters)).encode("utf-8")).hexdigest()
+
+    def search(self, search_query, search_id, corpus, filters=None):
+        print("Search query:", search_query, filters if filters is not None and not filters.is_empty() else "")
         # results = dummy_search(self.corpus, search_id)
 
+        key = self._cache_key(search_query, filters)
+        cached = self.result_cache.get(key)
+        if cached is not None and len(cached) == cached.total_hits:
+            return cached.head(None, search_id)
+
         # Search with the precomputated indexes
-        results = search_in_corpus(
-            query=search_query,
-            search_id=search_id,
-            corpus=self.corpus,
-            index=self.index,
-            field_index=self.field_index,
-            idf=self.idf,
-            doc_length=self.doc_length,
-            avgdl=self.avgdl,
-        )
+        with self._lock:
+            results = search_in_corpus(
+                query=search_query,
+                search_id=search_id,
+                corpus=self.corpus,
+                index=self.index,
+                field_index=self.field_index,
+                idf=self.idf,
+                doc_length=self.doc_length,
+                avgdl=self.avgdl,
+                scorer=self.scorer,
+                k1=self.k1,
+                b=self.b,
+                mask=self.columns.mask(filters),
+            )
+            self.result_cache.set(key, results)
         return results
+
+    def search_top_k(self, search_query, search_id, k, filters=None):
+        """
+        Best k results of the query (exact, same order as search), as a RankedResults handle whose
+        total_hits is the total number of hits and facets the brand / category / sub_category counts
+        of the hits. Used by the web app, which only renders one page of results.
+        :param filters: SearchFilters, evaluated as a mask over all the docs before scoring
+        """
+        print("Search query:", search_query, f"(top {k})", filters if filters is not None and not filters.is_empty() else "")
+
+        # A cached ranking is enough if it has k results or all the hits (and the facets)
+        key = self._cache_key(search_query, filters)
+        cached = self.result_cache.get(key)
+        if cached is not None and cached.facets is not None and (len(cached) >= k or len(cached) == cached.total_hits):
+            return cached.head(k, search_id)
+
+        with self._lock:
+            results = search_top_k_in_corpus(
+                query=search_query,
+                search_id=search_id,
+                corpus=self.corpus,
+                scorer=self.scorer,
+                k=max(k, self.CACHE_MIN_K),
+                k1=self.k1,
+                b=self.b,
+                mask=self.columns.mask(filters),
+                columns=self.columns,
+            )
+            self.result_cache.set(key, results)
+        return results.head(k, search_id)
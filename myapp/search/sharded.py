@@ -0,0 +1,557 @@
+import hashlib
+import math
+import multiprocessing
+import queue
+import threading
+import zlib
+from collections import Counter
+
+import numpy as np
+
+from myapp.core.cache import LRUCache
+from myapp.search.algorithms import build_indexes, doc_postings, parse_query
+from myapp.search.delta_index import DeltaIndex
+from myapp.search.filters import DocumentColumns
+from myapp.search.load_corpus import iter_documents, load_corpus
+from myapp.search.document_store import DocumentStore, write_document_store
+from myapp.search.index_store import file_checksum
+from myapp.search.results import RankedResults
+from myapp.search.scoring import TermAtATimeScorer
+
+# Values per facet field sent by every shard: the merged counts of the top values are exact unless a
+# value is past this rank in some shard
+SHARD_FACET_LIMIT = 100
+
+
+def shard_of(pid, num_shards):
+    """Shard owning `pid` (stable across processes and restarts, unlike hash())."""
+    return zlib.crc32(str(pid).encode("utf-8")) % num_shards
+
+
+class _GlobalIdf:
+    """term -> idf over the whole corpus, log(N / df) as in build_indexes, from the df summed over the shards."""
+
+    def __init__(self, df, num_docs):
+        self.df = df
+        self.num_docs = num_docs
+
+    def get(self, term, default=None):
+        df = self.df.get(term)
+        if not df:
+            return default
+        return math.log(self.num_docs / df)
+
+    def __getitem__(self, term):
+        idf = self.get(term)
+        if idf is None:
+            raise KeyError(term)
+        return idf
+
+    def __contains__(self, term):
+        return bool(self.df.get(term))
+
+
+class _Shard:
+    """Index shard living in a worker process: the documents of the shard, their indexes and scorer."""
+
+    def __init__(self, merge_threshold, proximity_weight, proximity_window):
+        self.merge_threshold = merge_threshold
+        self.proximity_weight = proximity_weight
+        self.proximity_window = proximity_window
+        self.corpus = {}
+
+    def add(self, docs):
+        """Documents of the shard, streamed by the parent before build()."""
+        for doc in docs:
+            self.corpus[doc.pid] = doc
+
+    def build(self):
+        self.segments = DeltaIndex(*build_indexes(self.corpus))
+        return self.local_stats()
+
+    def local_stats(self):
+        """(number of docs, total length, term -> df) of the shard."""
+        df = {term: len(postings) for term, postings in self.segments.index.items()}
+        return self.segments.num_docs, self.segments.total_length, df
+
+    def set_stats(self, df, num_docs, total_length):
+        self.idf = _GlobalIdf(df, num_docs)
+        self._set_scorer(total_length)
+
+    def _set_scorer(self, total_length):
+        num_docs = self.idf.num_docs
+        self.avgdl = total_length / float(num_docs) if num_docs else 0.0
+        self.scorer = TermAtATimeScorer(
+            self.segments.index,
+            self.segments.field_index,
+            self.idf,
+            self.segments.doc_length,
+            self.avgdl,
+            proximity_weight=self.proximity_weight,
+            proximity_window=self.proximity_window,
+        )
+        self.columns = DocumentColumns(self.scorer.pids, self.corpus)
+
+    def update_stats(self, df_changes, num_docs, total_length):
+        self.idf.df.update(df_changes)
+        self.idf.num_docs = num_docs
+        if self.merge_threshold is not None and self.segments.delta_size >= self.merge_threshold:
+            self.segments = DeltaIndex(*self.segments.merge())
+            self._set_scorer(total_length)
+            return
+        self.avgdl = total_length / float(num_docs) if num_docs else 0.0
+        # idf and avgdl changed: drop the norms and upper bounds
+        self.scorer.update((), {}, self.avgdl)
+
+    def _match(self, terms, mask):
+        """
+        scorer.match() with the AND over the terms indexed in the whole corpus: a term that only
+        other shards have leaves no doc of this shard with all the terms.
+        """
+        indexed = [t for t in terms if t in self.idf]
+        lists = [p.docs for p in map(self.scorer.term_postings, indexed) if p is not None]
+        if len(lists) == len(indexed):
+            return self.scorer.match(indexed, mask)
+        if mask is not None:
+            lists = [docs[mask[docs]] for docs in lists]
+        if not lists:
+            return np.zeros(0, dtype=np.int64), False
+        return np.unique(np.concatenate(lists)), False
+
+    def top_k(self, terms, phrases, k, k1, b, filters):
+        """
+        Top k of the shard (all the hits when k is None).
+        :return: (number of docs with all the terms, pids, scores, total hits, facet counts)
+        """
+        mask = self.columns.mask(filters)
+        candidates, all_terms = self._match(terms, mask)
+        hits = self.scorer.hits(terms, mask, phrases, candidates=(candidates, all_terms))
+        # Proximity pairs of the terms indexed in the whole corpus, as in the single engine
+        indexed = [t for t in terms if t in self.idf]
+        pids, scores, total = self.scorer.top_k(
+            terms, hits.size if k is None else k, k1, b, hits=hits, indexed=indexed,
+        )
+        facets = self.columns.facets(hits, limit=SHARD_FACET_LIMIT)
+        and_count = int(candidates.size) if all_terms else 0
+        return and_count, pids, scores.tolist(), total, facets
+
+    def _save_df(self, df_before, doc):
+        # The postings that an upsert / delete changes are the ones of the terms of the old and new doc
+        for term in doc_postings(doc)[0]:
+            if term not in df_before:
+                df_before[term] = self.segments.df(term)
+
+    def upsert(self, docs):
+        """Index Documents of the shard; returns (df changes, docs delta, length delta)."""
+        num_docs, total_length = self.segments.num_docs, self.segments.total_length
+        df_before = {}
+        changed_terms = set()
+        doc_lengths = {}
+        for doc in docs:
+            old = self.corpus.get(doc.pid)
+            if old is not None:
+                self._save_df(df_before, old)
+            self._save_df(df_before, doc)
+            changed_terms |= self.segments.upsert(doc, old)
+            self.corpus[doc.pid] = doc
+            doc_lengths[doc.pid] = self.segments.length(doc.pid) or 0
+        docs = {pid: self.corpus[pid] for pid in doc_lengths}
+        return self._after_update(changed_terms, doc_lengths, docs, df_before, num_docs, total_length)
+
+    def delete(self, pids):
+        num_docs, total_length = self.segments.num_docs, self.segments.total_length
+        df_before = {}
+        changed_terms = set()
+        doc_lengths = {}
+        for pid in pids:
+            old = self.corpus.pop(pid, None)
+            if old is None:
+                continue
+            self._save_df(df_before, old)
+            changed_terms |= self.segments.delete(pid, old)
+            doc_lengths[pid] = 0
+        docs = dict.fromkeys(doc_lengths)
+        return self._after_update(changed_terms, doc_lengths, docs, df_before, num_docs, total_length)
+
+    def _after_update(self, changed_terms, doc_lengths, docs, df_before, num_docs, total_length):
+        # Scores use the global stats, the scorer is refreshed again by update_stats
+        self.scorer.update(changed_terms, doc_lengths, self.avgdl)
+        self.columns.update(docs, self.scorer.pid_to_doc)
+        df_changes = {term: self.segments.df(term) - df_before.get(term, 0) for term in changed_terms}
+        return (
+            {term: change for term, change in df_changes.items() if change},
+            self.segments.num_docs - num_docs,
+            self.segments.total_length - total_length,
+        )
+
+
+def _shard_main(conn, merge_threshold, proximity_weight, proximity_window):
+    """
+    Worker process: receives the documents of its shard ("add", no answer), then answers
+    (op, args) requests until close.
+    """
+    shard = _Shard(merge_threshold, proximity_weight, proximity_window)
+    while True:
+        try:
+            op, args = conn.recv()
+        except EOFError:
+            break
+        if op == "close":
+            break
+        if op == "add":
+            shard.add(*args)
+            continue
+        try:
+            conn.send((True, getattr(shard, op)(*args)))
+        except Exception as e:
+            conn.send((False, f"{type(e).__name__}: {e}"))
+    conn.close()
+
+
+def _as_document(doc):
+    """Document to send to a shard (the documents of a DocumentStore are read lazily from the file)."""
+    to_document = getattr(doc, "to_document", None)
+    return to_document() if to_document is not None else doc
+
+
+class ShardedSearchEngine:
+    """
+    Search engine whose indexes are split by pid (crc32) over worker processes.
+    Every shard is served by `workers_per_shard` processes with the same documents. A query takes an
+    idle worker of every shard, sends it the query over its pipe (scatter) and merges the per shard top
+    k lists (gather), so queries run side by side as long as there are idle workers.
+    The df of every term, the number of docs and the total length are summed over the shards and shared
+    with them, so idf, avgdl and the scores are the same as with the single process SearchEngine.
+    The AND / OR fallback is decided over the whole corpus: each shard answers with its AND candidates
+    when it has some and with its OR candidates otherwise, and the OR answers are only used when no
+    shard has a doc with all the terms.
+    The corpus is read once, in this process, and each worker is sent the documents of its shard. The
+    documents used to render the results stay in this process (a dict, or a DocumentStore file), and a
+    worker that dies is started again from them (the request it was serving fails).
+    """
+
+    # Rankings are cached by at least this many results, as in SearchEngine
+    CACHE_MIN_K = 100
+    # Documents sent to a worker at once while the shards are loaded
+    LOAD_BATCH_SIZE = 1000
+
+    def __init__(self, corpus, corpus_path=None, num_shards=2, k1=1.2, b=0.75, result_cache_size=1024,
+                 result_cache_ttl=300, doc_store_path=None, merge_threshold=10_000, proximity_weight=1.0,
+                 proximity_window=5, mp_context=None, workers_per_shard=2):
+        self.corpus_path = corpus_path
+        self.num_shards = num_shards
+        self.workers_per_shard = workers_per_shard
+        self.k1 = k1
+        self.b = b
+        self.result_cache = LRUCache(maxsize=result_cache_size, ttl=result_cache_ttl)
+        # Updates take every worker of every shard, one update at a time
+        self._update_lock = threading.Lock()
+        # Rankings computed before an update are not cached after it (see _cache_set)
+        self._cache_lock = threading.Lock()
+        self._generation = 0
+        self._worker_args = (merge_threshold, proximity_weight, proximity_window)
+
+        # Fork keeps the start fast and does not import the web app again in the workers
+        if mp_context is None:
+            methods = multiprocessing.get_all_start_methods()
+            mp_context = "fork" if "fork" in methods else "spawn"
+        self._context = multiprocessing.get_context(mp_context)
+        # shard -> [(process, conn)], and the indexes of the idle workers of every shard
+        self._workers = [[self._spawn() for _ in range(workers_per_shard)] for _ in range(num_shards)]
+        self._idle = [queue.Queue() for _ in range(num_shards)]
+
+        # pid -> position in the corpus, so merged ties are resolved as in the single engine
+        self._ordinals = {}
+        if corpus is not None:
+            self._load(corpus.values())
+        elif doc_store_path and corpus_path:
+            corpus_hash = file_checksum(corpus_path)
+            corpus = DocumentStore.open(doc_store_path, corpus_hash)
+            if corpus is None:
+                # The shards are sent the documents while the store is written
+                write_document_store(doc_store_path, corpus_hash, self._dispatch(iter_documents(corpus_path)))
+                corpus = DocumentStore.open(doc_store_path, corpus_hash)
+            else:
+                self._load(corpus.values())
+        else:
+            corpus = {}
+            self._load(iter_documents(corpus_path, into=corpus))
+        self.corpus = corpus
+        self._next_ordinal = len(self._ordinals)
+
+        # Global statistics, from one worker of every shard (the others have the same documents)
+        all_workers = self._all_workers()
+        stats = self._request("build", all_workers, [()] * len(all_workers))[::workers_per_shard]
+        self.num_docs = sum(s[0] for s in stats)
+        self.total_length = sum(s[1] for s in stats)
+        self.df = Counter()
+        for _, _, df in stats:
+            self.df.update(df)
+        self._set_stats(all_workers)
+        for idle in self._idle:
+            for i in range(workers_per_shard):
+                idle.put(i)
+
+        print(f"ShardedSearchEngine: {num_shards} shards x {workers_per_shard} workers")
+        print(f"  #docs = {self.num_docs}")
+        print(f"  avgdl = {self.avgdl}")
+
+    @property
+    def avgdl(self):
+        return self.total_length / float(self.num_docs) if self.num_docs else 0.0
+
+    # Workers
+    def _spawn(self):
+        parent_conn, child_conn = self._context.Pipe()
+        process = self._context.Process(target=_shard_main, args=(child_conn, *self._worker_args), daemon=True)
+        process.start()
+        child_conn.close()
+        return process, parent_conn
+
+    def _all_workers(self):
+        return [(shard_id, i) for shard_id in range(self.num_shards) for i in range(self.workers_per_shard)]
+
+    def _dispatch(self, docs):
+        """Send every document to the workers of its shard, by batches; yields the documents."""
+        batches = [[] for _ in range(self.num_shards)]
+        for doc in docs:
+            self._ordinals.setdefault(doc.pid, len(self._ordinals))
+            shard_id = shard_of(doc.pid, self.num_shards)
+            batch = batches[shard_id]
+            batch.append(_as_document(doc))
+            if len(batch) >= self.LOAD_BATCH_SIZE:
+                self._send_batch(shard_id, range(self.workers_per_shard), batch)
+                batches[shard_id] = []
+            yield doc
+        for shard_id, batch in enumerate(batches):
+            if batch:
+                self._send_batch(shard_id, range(self.workers_per_shard), batch)
+
+    def _load(self, docs):
+        for _ in self._dispatch(docs):
+            pass
+
+    def _send_batch(self, shard_id, workers, batch):
+        for i in workers:
+            self._workers[shard_id][i][1].send(("add", (batch,)))
+
+    def _respawn(self, shard_id, i):
+        """Start a dead worker again, with the documents of its shard and the current global stats."""
+        process, conn = self._workers[shard_id][i]
+        conn.close()
+        process.join(timeout=1)
+        self._workers[shard_id][i] = self._spawn()
+        batch = []
+        for pid in self._ordinals:
+            if shard_of(pid, self.num_shards) == shard_id:
+                batch.append(_as_document(self.corpus[pid]))
+                if len(batch) >= self.LOAD_BATCH_SIZE:
+                    self._send_batch(shard_id, (i,), batch)
+                    batch = []
+        if batch:
+            self._send_batch(shard_id, (i,), batch)
+        self._request("build", [(shard_id, i)], [()])
+        self._set_stats([(shard_id, i)])
+
+    def _set_stats(self, workers):
+        self._request("set_stats", workers, [(dict(self.df), self.num_docs, self.total_length)] * len(workers))
+
+    def _exchange(self, op, workers, args_per_worker):
+        """
+        Send the request to the workers [(shard, i)], then gather the answers (in the same order).
+        :return: (answers, workers that died), None answers for the dead ones
+        """
+        dead = []
+        for worker, args in zip(workers, args_per_worker):
+            try:
+                self._workers[worker[0]][worker[1]][1].send((op, args))
+            except OSError:
+                dead.append(worker)
+        answers = []
+        for worker in workers:
+            answer = None
+            if worker not in dead:
+                try:
+                    answer = self._workers[worker[0]][worker[1]][1].recv()
+                except (EOFError, OSError):
+                    dead.append(worker)
+            answers.append(answer)
+        return answers, dead
+
+    def _request(self, op, workers, args_per_worker):
+        """_exchange(); the dead workers are started again and the request fails."""
+        answers, dead = self._exchange(op, workers, args_per_worker)
+        for shard_id, i in dead:
+            self._respawn(shard_id, i)
+        if dead:
+            raise RuntimeError(f"Shard request {op} failed: worker {dead[0][1]} of shard {dead[0][0]} died")
+        return self._results(op, answers)
+
+    @staticmethod
+    def _results(op, answers):
+        errors = [message for ok, message in answers if not ok]
+        if errors:
+            raise RuntimeError(f"Shard request {op} failed: {errors[0]}")
+        return [result for _, result in answers]
+
+    def _call_all(self, op, args_per_shard):
+        """Send the request to an idle worker of every shard, then gather the answers (in shard order)."""
+        # Workers are taken in shard order, so requests waiting for each other's workers cannot deadlock
+        workers = [(shard_id, idle.get()) for shard_id, idle in enumerate(self._idle)]
+        try:
+            return self._request(op, workers, args_per_shard)
+        finally:
+            for shard_id, i in workers:
+                self._idle[shard_id].put(i)
+
+    # Search
+    def cache_stats(self):
+        return self.result_cache.stats()
+
+    def _cache_key(self, search_query, filters=None):
+        filters_key = filters.key() if filters is not None and not filters.is_empty() else None
+        terms, phrases = parse_query(search_query)
+        return tuple(terms), phrases, self.k1, self.b, filters_key
+
+    def _cache_set(self, key, results, generation):
+        """Cache a ranking unless the index was updated since it was computed."""
+        with self._cache_lock:
+            if generation == self._generation:
+                self.result_cache.set(key, results)
+
+    def ranking_key(self, search_query, filters=None):
+        """Digest of the result cache key of a search: searches with the same key get the same ranking."""
+        return hashlib.sha1(repr(self._cache_key(search_query, filters)).encode("utf-8")).hexdigest()
+
+    def _gather_top_k(self, search_query, search_id, k, filters):
+        terms, phrases = parse_query(search_query)
+        if not search_query or not terms:
+            return RankedResults([], None, search_id, self.corpus)
+        answers = self._call_all("top_k", [(terms, phrases, k, self.k1, self.b, filters)] * self.num_shards)
+        # Docs with all the terms somewhere: only the shards that have some of them answer
+        if any(answer[0] for answer in answers):
+            answers = [answer for answer in answers if answer[0]]
+
+        merged = []
+        total = 0
+        facets = {}
+        for _, pids, scores, shard_total, shard_facets in answers:
+            merged.extend(zip(scores, (self._ordinals[pid] for pid in pids), pids))
+            total += shard_total
+            for field, counts in shard_facets.items():
+                field_counts = facets.setdefault(field, Counter())
+                for value, count in counts:
+                    field_counts[value] += count
+        # Best score first, ties by position in the corpus (the doc id order of the single engine)
+        merged.sort(key=lambda entry: (-entry[0], entry[1]))
+        if k is not None:
+            merged = merged[:k]
+        facets = {
+            field: sorted(counts.items(), key=lambda item: (-item[1], item[0]))[:20]
+            for field, counts in facets.items()
+        }
+        return RankedResults(
+            [pid for _, _, pid in merged],
+            np.array([score for score, _, _ in merged], dtype=np.float64),
+            search_id,
+            self.corpus,
+            total_hits=total,
+            facets=facets,
+        )
+
+    def search(self, search_query, search_id, corpus=None, filters=None):
+        print("Search query:", search_query, f"({self.num_shards} shards)")
+        key = self._cache_key(search_query, filters)
+        cached = self.result_cache.get(key)
+        if cached is not None and len(cached) == cached.total_hits:
+            return cached.head(None, search_id)
+        generation = self._generation
+        results = self._gather_top_k(search_query, search_id, None, filters)
+        self._cache_set(key, results, generation)
+        return results
+
+    def search_top_k(self, search_query, search_id, k, filters=None):
+        """Best k results of the query, merged from the top k of every shard (same as SearchEngine.search_top_k)."""
+        print("Search query:", search_query, f"(top {k}, {self.num_shards} shards)")
+        key = self._cache_key(search_query, filters)
+        cached = self.result_cache.get(key)
+        if cached is not None and (len(cached) >= k or len(cached) == cached.total_hits):
+            return cached.head(k, search_id)
+        generation = self._generation
+        results = self._gather_top_k(search_query, search_id, max(k, self.CACHE_MIN_K), filters)
+        self._cache_set(key, results, generation)
+        return results.head(k, search_id)
+
+    # Updates
+    def _update(self, op, items_per_shard):
+        """Run the update on every worker (waiting for the searches in progress), then share the global stats."""
+        # Every worker is taken, in shard order as in _call_all
+        workers = [
+            (shard_id, idle.get()) for shard_id, idle in enumerate(self._idle) for _ in range(self.workers_per_shard)
+        ]
+        try:
+            answers, dead = self._exchange(op, workers, [items_per_shard[shard_id] for shard_id, _ in workers])
+            if dead:
+                # The documents are updated: the restarted workers have them, the global stats are
+                # computed again from the shards
+                for shard_id, i in dead:
+                    self._respawn(shard_id, i)
+                stats = self._request("local_stats", workers[::self.workers_per_shard], [()] * self.num_shards)
+                self.num_docs = sum(s[0] for s in stats)
+                self.total_length = sum(s[1] for s in stats)
+                self.df = Counter()
+                for _, _, df in stats:
+                    self.df.update(df)
+                self._set_stats(workers)
+                raise RuntimeError(f"Shard request {op} failed: worker {dead[0][1]} of shard {dead[0][0]} died")
+            # Every worker of a shard answers the same changes
+            df_changes = {}
+            for deltas, docs_delta, length_delta in self._results(op, answers)[::self.workers_per_shard]:
+                self.num_docs += docs_delta
+                self.total_length += length_delta
+                for term, delta in deltas.items():
+                    self.df[term] += delta
+                    df_changes[term] = self.df[term]
+            self._request("update_stats", workers, [(df_changes, self.num_docs, self.total_length)] * len(workers))
+        finally:
+            with self._cache_lock:
+                self._generation += 1
+                self.result_cache.clear()
+            for shard_id, i in workers:
+                self._idle[shard_id].put(i)
+
+    def upsert_documents(self, docs):
+        """Add or replace documents: each one is sent to the shard owning its pid, then the global stats are shared."""
+        items = [[] for _ in range(self.num_shards)]
+        with self._update_lock:
+            for doc in docs:
+                if doc.pid not in self._ordinals:
+                    self._ordinals[doc.pid] = self._next_ordinal
+                    self._next_ordinal += 1
+                self.corpus[doc.pid] = doc
+                items[shard_of(doc.pid, self.num_shards)].append(doc)
+            self._update("upsert", [(shard_items,) for shard_items in items])
+
+    def delete_documents(self, pids):
+        items = [[] for _ in range(self.num_shards)]
+        with self._update_lock:
+            for pid in pids:
+                if pid in self.corpus:
+                    del self.corpus[pid]
+                    del self._ordinals[pid]
+                    items[shard_of(pid, self.num_shards)].append(pid)
+            self._update("delete", [(shard_items,) for shard_items in items])
+
+    def close(self):
+        with self._update_lock:
+            for workers in self._workers:
+                for process, conn in workers:
+                    try:
+                        conn.send(("close", ()))
+                    except (BrokenPipeError, OSError):
+                        pass
+                    conn.close()
+            for workers in self._workers:
+                for process, _ in workers:
+                    process.join(timeout=5)
+            self._workers = []
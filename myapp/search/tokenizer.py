@@ -0,0 +1,85 @@
+from functools import lru_cache
+
+from nltk.tokenize import NLTKWordTokenizer, word_tokenize
+
+# Whole words that the NLTK word tokenizer splits in two (its CONTRACTIONS2 rules)
+_SPLIT_WORDS = {
+    "cannot": ["can", "not"],
+    "gimme": ["gim", "me"],
+    "gonna": ["gon", "na"],
+    "gotta": ["got", "ta"],
+    "lemme": ["lem", "me"],
+    "wanna": ["wan", "na"],
+}
+# Characters where punkt can end a sentence
+_SENTENCE_END = frozenset(".?!")
+
+
+class Tokenizer:
+    """
+    Text -> stemmed tokens pipeline (lowercase, word tokenize, keep alphabetic tokens, drop stop words, stem),
+    giving the same tokens as preproces_text, with memoisation:
+    - stems are cached in a bounded LRU, the vocabulary is small compared to the number of tokens,
+    - short texts (brands, categories, sellers, queries...) are cached in a bounded LRU.
+
+    mode="regex" avoids most of the NLTK tokenizer work while giving the same tokens:
+    - texts made only of alphabetic words are split on whitespace,
+    - texts without sentence ending punctuation are one punkt sentence, so the treebank word tokenizer is
+      applied directly without the punkt sentence splitter,
+    - other texts go through word_tokenize.
+    mode="nltk" always uses word_tokenize.
+    """
+
+    def __init__(self, stop_words, stemmer, mode="regex", stem_cache_size=100_000,
+                 text_cache_size=50_000, max_cached_text=256):
+        if mode not in ("regex", "nltk"):
+            raise ValueError(f"Unknown tokenizer mode: {mode}")
+        self.stop_words = stop_words
+        self.mode = mode
+        self.max_cached_text = max_cached_text
+        self.stem = lru_cache(maxsize=stem_cache_size)(stemmer.stem)
+        self._cached_tokens = lru_cache(maxsize=text_cache_size)(self._tokenize)
+        self._treebank = NLTKWordTokenizer()
+
+    def _words(self, text):
+        if self.mode == "regex":
+            words = text.split()
+            if all(w.isalpha() for w in words):
+                if not _SPLIT_WORDS.keys() & set(words):
+                    return words
+                return [part for w in words for part in _SPLIT_WORDS.get(w, (w,))]
+            if not _SENTENCE_END & set(text):
+                return self._treebank.tokenize(text)
+        return word_tokenize(text)
+
+    def _tokenize(self, text):
+        stop_words = self.stop_words
+        stem = self.stem
+        return tuple(
+            stem(t) for t in self._words(text.lower())
+            if t.isalpha() and t not in stop_words
+        )
+
+    def tokenize(self, text):
+        """Stemmed tokens of `text` (empty list if it is not a string)."""
+        if not isinstance(text, str):
+            return []
+        if len(text) <= self.max_cached_text:
+            return list(self._cached_tokens(text))
+        return list(self._tokenize(text))
+
+    def tokenize_many(self, texts):
+        """Stemmed tokens of each text; repeated texts in the batch are only tokenized once."""
+        seen = {}
+        out = []
+        for text in texts:
+            tokens = seen.get(text) if isinstance(text, str) else None
+            if tokens is None:
+                tokens = self.tokenize(text)
+                if isinstance(text, str):
+                    seen[text] = tokens
+            out.append(tokens)
+        return out
+
+    def cache_info(self):
+        return {"stems": self.stem.cache_info(), "texts": self._cached_tokens.cache_info()}
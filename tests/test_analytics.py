@@ -0,0 +1,124 @@
+import os
+import sqlite3
+import time
+
+import pytest
+
+from myapp.analytics.analytics_data import AnalyticsData
+from myapp.analytics.columnar import ColumnarStore
+from myapp.analytics.event_log import EventLog
+from myapp.analytics.sessions import SessionStore
+
+
+def _analytics(tmp_path):
+    return AnalyticsData(event_log=EventLog(str(tmp_path / "events.sqlite")), session_timeout=60)
+
+
+def test_click_pending_at_session_expiry_is_censored(tmp_path):
+    analytics = _analytics(tmp_path)
+    session_id = analytics.start_session()
+    # The request of the click refreshes the session before the click is saved
+    analytics.update_physical_session(session_id)
+    analytics.save_doc_click(session_id, "PID1", "title", "description")
+
+    # The user never comes back: the session expires with the click pending
+    assert analytics.fact_sessions.expire(time.time() + 3600) == 1
+    assert session_id not in analytics.fact_sessions
+
+    summary = analytics.aggregates.summary()
+    assert summary["total_dwell_events"] == 0
+    assert summary["total_abandoned"] == 1
+    [doc] = analytics.aggregates.document_stats()
+    assert doc["abandoned"] == 1
+    assert doc["dwell_times"] == []
+    assert sum(doc["dwell_histogram"].values()) == 0
+    assert analytics.event_log.query("SELECT doc_id, censored FROM dwell") == [("PID1", 1)]
+    analytics.event_log.close()
+
+
+def test_dwell_of_returning_user_is_not_censored(tmp_path):
+    analytics = _analytics(tmp_path)
+    session_id = analytics.start_session()
+    analytics.save_doc_click(session_id, "PID1", "title", "description")
+    event = analytics.compute_dwell(session_id)
+
+    assert not event["censored"]
+    assert analytics.aggregates.summary()["total_dwell_events"] == 1
+    analytics.fact_sessions.expire(time.time() + 3600)
+    assert analytics.aggregates.summary()["total_abandoned"] == 0
+    assert analytics.event_log.query("SELECT censored FROM dwell") == [(0,)]
+    analytics.event_log.close()
+
+
+def _log_clicks(event_log, count, ts):
+    for i in range(count):
+        event_log.append("clicks", ("S", f"PID{i}", ts + i))
+
+
+def test_compaction_saves_the_manifest_before_deleting_parts(tmp_path, monkeypatch):
+    event_log = EventLog(str(tmp_path / "events.sqlite"))
+    store = ColumnarStore(str(tmp_path / "columnar"), event_log, max_parts=2)
+    ts = time.time()
+    for _ in range(2):
+        _log_clicks(event_log, 5, ts)
+        store.sync()
+
+    # The third part makes the day compacted; crash right after the merged part is written
+    def crash(path):
+        raise OSError("crash")
+
+    _log_clicks(event_log, 5, ts)
+    monkeypatch.setattr(os, "remove", crash)
+    with pytest.raises(OSError):
+        store.sync()
+    monkeypatch.undo()
+
+    reopened = ColumnarStore(str(tmp_path / "columnar"), event_log, max_parts=2)
+    assert len(reopened.scan("clicks")) == 15
+    for part in reopened.manifest["clicks"]["parts"]:
+        assert os.path.exists(os.path.join(reopened.root, part["path"]))
+    event_log.close()
+
+
+def test_background_sync(tmp_path):
+    event_log = EventLog(str(tmp_path / "events.sqlite"), flush_interval=0.01)
+    store = ColumnarStore(str(tmp_path / "columnar"), event_log, sync_interval=0.01)
+    _log_clicks(event_log, 3, time.time())
+    deadline = time.time() + 5
+    while len(store.scan("clicks")) < 3 and time.time() < deadline:
+        time.sleep(0.01)
+    assert len(store.scan("clicks")) == 3
+    store.close()
+    event_log.close()
+
+
+def test_rows_of_a_failed_write_are_kept(tmp_path):
+    path = str(tmp_path / "events.sqlite")
+    event_log = EventLog(path, flush_interval=60)
+    other = sqlite3.connect(path)
+    other.execute("ALTER TABLE clicks RENAME TO clicks_moved")
+    other.commit()
+    event_log.append("clicks", ("S", "PID1", time.time()))
+    with pytest.raises(sqlite3.OperationalError):
+        event_log.flush()
+    assert event_log.stats()["buffered"] == 1
+    assert event_log.stats()["dropped"] == 0
+
+    other.execute("ALTER TABLE clicks_moved RENAME TO clicks")
+    other.commit()
+    other.close()
+    assert event_log.flush() == 1
+    assert event_log.query("SELECT doc_id FROM clicks") == [("PID1",)]
+    event_log.close()
+
+
+def test_recent_sessions_in_activity_order():
+    store = SessionStore(idle_timeout=60)
+    for i in range(5):
+        store.set(f"S{i}", {"num_requests": i}, now=i)
+    store.touch("S1", now=10)
+    store.set("S3", {"num_requests": 30}, now=11)
+
+    assert [s_id for s_id, _ in store.recent(3)] == ["S3", "S1", "S4"]
+    assert store.recent(1) == [("S3", {"num_requests": 30})]
+    assert len(store.recent(100)) == len(store) == 5
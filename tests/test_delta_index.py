@@ -0,0 +1,41 @@
+import pytest
+
+from myapp.search.algorithms import build_indexes
+from myapp.search.delta_index import DeltaIndex
+from myapp.search.objects import Document
+
+
+def _doc(pid, title):
+    return Document(pid=pid, title=title, description=title)
+
+
+def _segments(docs):
+    return DeltaIndex(*build_indexes({doc.pid: doc for doc in docs}))
+
+
+def test_df_and_idf_after_updates_match_a_rebuild():
+    docs = [_doc("P1", "red shirt"), _doc("P2", "blue shirt"), _doc("P3", "red jeans")]
+    segments = _segments(docs)
+    segments.delete("P1", docs[0])
+    segments.upsert(_doc("P2", "green jeans"), docs[1])
+    segments.upsert(_doc("P4", "red hat"))
+
+    rebuilt = {doc.pid: doc for doc in (_doc("P2", "green jeans"), docs[2], _doc("P4", "red hat"))}
+    _, _, idf, doc_length, avgdl = build_indexes(rebuilt)
+    assert dict(segments.idf) == pytest.approx(idf)
+    assert dict(segments.doc_length) == doc_length
+    assert segments.avgdl == pytest.approx(avgdl)
+
+def test_removing_a_base_doc_needs_its_indexed_version():
+    docs = [_doc("P1", "red shirt"), _doc("P2", "blue shirt")]
+    segments = _segments(docs)
+    with pytest.raises(ValueError):
+        segments.delete("P1")
+    with pytest.raises(ValueError):
+        segments.upsert(_doc("P1", "green shirt"))
+    # Nothing was removed
+    assert segments.num_docs == 2
+    assert segments.df("red") == 1
+    # Delta docs have their terms
+    segments.upsert(_doc("P3", "red hat"))
+    assert segments.delete("P3") == {"red", "hat"}
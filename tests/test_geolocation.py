@@ -0,0 +1,18 @@
+import threading
+
+from myapp.analytics.geolocation import GeoLocator
+
+
+def test_failing_callback_does_not_stop_the_worker():
+    geolocator = GeoLocator()
+    resolved = threading.Event()
+
+    def failing(city, country):
+        raise RuntimeError("callback error")
+
+    geolocator.enqueue("8.8.8.8", failing)
+    geolocator.enqueue("1.1.1.1", lambda city, country: resolved.set())
+    try:
+        assert resolved.wait(timeout=5)
+    finally:
+        geolocator.close()
@@ -0,0 +1,31 @@
+import sqlite3
+import time
+
+from myapp.generation.response_cache import RAGResponseCache
+
+
+def _rows(path):
+    with sqlite3.connect(path) as db:
+        return [key for key, in db.execute("SELECT key FROM rag_answers ORDER BY created")]
+
+
+def test_expired_answers_are_pruned_without_being_looked_up(tmp_path):
+    path = str(tmp_path / "rag.sqlite")
+    cache = RAGResponseCache(ttl=60, path=path, prune_every=2)
+    cache.set("old", "answer")
+    with cache._db_lock:
+        cache._db.execute("UPDATE rag_answers SET created = ? WHERE key = 'old'", (time.time() - 120,))
+        cache._db.commit()
+    cache.set("new", "answer")
+    assert _rows(path) == ["new"]
+    cache.close()
+
+
+def test_disk_store_keeps_the_newest_answers(tmp_path):
+    path = str(tmp_path / "rag.sqlite")
+    cache = RAGResponseCache(ttl=None, path=path, max_rows=3, prune_every=1)
+    for i in range(5):
+        cache.set(f"key{i}", f"answer {i}")
+    assert _rows(path) == ["key2", "key3", "key4"]
+    assert cache.stats()["pruned"] == 2
+    cache.close()
@@ -0,0 +1,50 @@
+import random
+
+import numpy as np
+import pytest
+
+from myapp.search.algorithms import build_indexes
+from myapp.search.objects import Document
+from myapp.search.scoring import TermAtATimeScorer
+
+WORDS = ["red", "blue", "green", "cotton", "slim", "jeans", "hat", "sock", "belt", "linen"]
+
+
+def _corpus(num_docs, seed=0):
+    rng = random.Random(seed)
+    corpus = {}
+    for i in range(num_docs):
+        # Every doc has "shirt", so a query with it has about as many candidates as docs
+        title = " ".join(["shirt"] + rng.choices(WORDS, k=rng.randint(1, 4)))
+        description = " ".join(rng.choices(WORDS + ["shirt"], k=rng.randint(3, 30)))
+        corpus[f"P{i}"] = Document(pid=f"P{i}", title=title, description=description)
+    return corpus
+
+
+@pytest.fixture(scope="module")
+def indexes():
+    return build_indexes(_corpus(3 * TermAtATimeScorer.PRUNE_MIN_CANDIDATES))
+
+
+@pytest.mark.parametrize("proximity_weight", [0.0, 0.1])
+@pytest.mark.parametrize("query", [["shirt", "red"], ["red", "shirt", "cotton"], ["slim", "linen", "belt"]])
+def test_top_k_is_the_head_of_search(indexes, monkeypatch, proximity_weight, query):
+    scorer = TermAtATimeScorer(*indexes, proximity_weight=proximity_weight)
+    pids, scores = scorer.search(query)
+
+    gathered = []
+    gather_scores = scorer._gather_scores
+
+    def spy(term, docs, k1, b):
+        gathered.append(docs.size)
+        return gather_scores(term, docs, k1, b)
+
+    monkeypatch.setattr(scorer, "_gather_scores", spy)
+    for k in (1, 10, 50):
+        gathered.clear()
+        top_pids, top_scores, total = scorer.top_k(query, k)
+        assert total == len(pids) > TermAtATimeScorer.PRUNE_MIN_CANDIDATES
+        # The pruning branch ran and dropped candidates before the final scoring
+        assert gathered[0] == total and min(gathered) < total
+        assert top_pids == pids[:k]
+        assert np.array_equal(top_scores, scores[:k])
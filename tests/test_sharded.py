@@ -0,0 +1,119 @@
+import numpy as np
+import pytest
+
+from myapp.search.objects import Document
+from myapp.search.search_engine import SearchEngine
+from myapp.search.sharded import ShardedSearchEngine, shard_of
+
+TITLES = [
+    "alpha beta gamma shirt",
+    "alpha gamma shirt blue",
+    "alpha gamma jeans",
+    "beta gamma shoes",
+    "alpha beta jacket",
+    "gamma watch leather",
+    "alpha shirt cotton slim",
+    "beta jeans slim fit",
+]
+
+
+def _corpus(titles):
+    return {
+        f"PID{i:03d}": Document(pid=f"PID{i:03d}", title=title, description=f"{title} product {i}")
+        for i, title in enumerate(titles)
+    }
+
+
+def _ranking(engine, query, k=100):
+    results = engine.search_top_k(query, 1, k)
+    return list(results.pids), np.asarray(results.scores, dtype=np.float64)
+
+
+@pytest.fixture(scope="module")
+def engines():
+    # Each engine updates its own corpus dict
+    single = SearchEngine(_corpus(TITLES))
+    sharded = ShardedSearchEngine(_corpus(TITLES), num_shards=2)
+    yield single, sharded
+    sharded.close()
+
+
+@pytest.mark.parametrize("query", [
+    "alpha", "alpha gamma", "shirt", "alpha beta", "slim jeans", '"alpha gamma"', "nothingatall",
+])
+def test_same_ranking_as_single_engine(engines, query):
+    single, sharded = engines
+    pids, scores = _ranking(single, query)
+    sharded_pids, sharded_scores = _ranking(sharded, query)
+    assert sharded_pids == pids
+    np.testing.assert_array_equal(sharded_scores, scores)
+
+
+def test_or_fallback_with_term_missing_in_a_shard():
+    # No doc has all the terms, and one shard has no doc with "beta": the proximity pairs
+    # must still be the ones of the whole corpus
+    titles = ["alpha gamma one", "alpha gamma two", "beta three", "alpha gamma four",
+              "gamma five", "alpha six", "delta seven", "gamma alpha eight"]
+    corpus = _corpus(titles)
+    beta_shards = {shard_of(pid, 2) for pid, doc in corpus.items() if "beta" in doc.title}
+    assert len(beta_shards) == 1, "the corpus must leave one shard without 'beta'"
+    single = SearchEngine(corpus)
+    sharded = ShardedSearchEngine(dict(corpus), num_shards=2)
+    try:
+        for query in ("alpha beta gamma", "beta alpha", "gamma beta alpha"):
+            pids, scores = _ranking(single, query)
+            sharded_pids, sharded_scores = _ranking(sharded, query)
+            assert sharded_pids == pids
+            np.testing.assert_array_equal(sharded_scores, scores)
+    finally:
+        sharded.close()
+
+
+def test_same_ranking_after_updates(engines):
+    single, sharded = engines
+    new = _corpus(["alpha beta gamma delta", "beta delta"])
+    new = {f"NEW{i}": doc.model_copy(update={"pid": f"NEW{i}"}) for i, doc in enumerate(new.values())}
+    single.upsert_documents(list(new.values()))
+    sharded.upsert_documents(list(new.values()))
+    single.delete_documents(["PID003"])
+    sharded.delete_documents(["PID003"])
+    for query in ("alpha beta", "delta", "gamma shoes"):
+        pids, scores = _ranking(single, query)
+        sharded_pids, sharded_scores = _ranking(sharded, query)
+        assert sharded_pids == pids
+        np.testing.assert_array_equal(sharded_scores, scores)
+
+
+def test_search_while_workers_are_busy():
+    single = SearchEngine(_corpus(TITLES))
+    sharded = ShardedSearchEngine(_corpus(TITLES), num_shards=2, workers_per_shard=2)
+    try:
+        # A request in progress holds one worker of every shard: the other ones serve this search
+        busy = [(shard_id, idle.get(timeout=1)) for shard_id, idle in enumerate(sharded._idle)]
+        pids, scores = _ranking(single, "alpha gamma")
+        sharded_pids, sharded_scores = _ranking(sharded, "alpha gamma")
+        assert sharded_pids == pids
+        np.testing.assert_array_equal(sharded_scores, scores)
+        for shard_id, i in busy:
+            sharded._idle[shard_id].put(i)
+    finally:
+        sharded.close()
+
+
+def test_dead_worker_is_started_again():
+    single = SearchEngine(_corpus(TITLES))
+    sharded = ShardedSearchEngine(_corpus(TITLES), num_shards=2, workers_per_shard=1)
+    try:
+        process, _ = sharded._workers[0][0]
+        process.kill()
+        process.join()
+        # Only the request the worker was serving fails
+        with pytest.raises(RuntimeError):
+            sharded.search_top_k("alpha", 1, 10)
+        for query in ("alpha", "beta gamma"):
+            pids, scores = _ranking(single, query)
+            sharded_pids, sharded_scores = _ranking(sharded, query)
+            assert sharded_pids == pids
+            np.testing.assert_array_equal(sharded_scores, scores)
+    finally:
+        sharded.close()
@@ -1,22 +1,35 @@
+import itertools
+import json
 import os
+import time
 from json import JSONEncoder
 
 import httpagentparser  # for getting the user agent as json
-from flask import Flask, render_template, session
+import pandas as pd
+from flask import Flask, g, jsonify, render_template, session
 from flask import request, redirect, url_for
 
 from myapp.analytics.analytics_data import AnalyticsData, ClickedDoc
-from myapp.search.load_corpus import load_corpus
+from myapp.analytics.columnar import ColumnarStore
+from myapp.analytics.event_log import SCHEMAS, EventLog
+from myapp.analytics.geolocation import GeoLocator
+from myapp.analytics.reports import AnalyticsReports
+from myapp.analytics.request_policy import LatencyHistograms, RequestPolicy
+from myapp.search.filters import SearchFilters
 from myapp.search.objects import Document, StatsDocument
 from myapp.search.search_engine import SearchEngine
+from myapp.search.sharded import ShardedSearchEngine
+from myapp.generation.jobs import RAGJobManager
 from myapp.generation.rag import RAGGenerator
+from myapp.generation.response_cache import RAGResponseCache
 from dotenv import load_dotenv
-from collections import Counter
 
 load_dotenv()  # take environment variables from .env
 
 import math
 PER_PAGE = 20
+# Rows of the raw logs and sessions shown on the stats pages (the latest ones)
+STATS_ROWS = 100
 
 # *** for using method to_json in objects ***
 def _default(self, obj):
@@ -33,22 +46,101 @@ app = Flask(__name__)
 app.secret_key = os.getenv("SECRET_KEY")
 # open browser dev tool to see the cookies
 app.session_cookie_name = os.getenv("SESSION_COOKIE_NAME")
-# instantiate our in memory persistence
-analytics_data = AnalyticsData()
-# instantiate RAG generator
-rag_generator = RAGGenerator()
 
 # load documents corpus into memory.
+# The engine is built first: its index build / shard workers are forked, before the analytics and
+# RAG threads are started.
 full_path = os.path.realpath(__file__)
 path, filename = os.path.split(full_path)
 file_path = path + "/" + os.getenv("DATA_FILE_PATH")
-corpus = load_corpus(file_path)
+
+# Instantiate our search engine (loading the index snapshot, or creating the indexes with the corpus).
+# The corpus file is streamed by the search engine: when the indexes have to be built, the documents
+# are indexed while they are read.
+# INDEX_FORMAT=compact serves the postings from a memory-mapped file shared by all the worker processes.
+snapshot_path = path + "/" + os.getenv("INDEX_SNAPSHOT_PATH", "data/index.snapshot")
+compact_path = None
+if os.getenv("INDEX_FORMAT", "snapshot") == "compact":
+    compact_path = path + "/" + os.getenv("COMPACT_INDEX_PATH", "data/index.cidx")
+# DOC_STORE_PATH serves the documents from a memory-mapped columnar file instead of a dict of Documents.
+doc_store_path = path + "/" + os.getenv("DOC_STORE_PATH") if os.getenv("DOC_STORE_PATH") else None
+# SEARCH_SHARDS > 1 splits the indexes over that many shards, queried in parallel, each one served by
+# SEARCH_SHARD_WORKERS processes so that concurrent searches do not wait for each other
+# (the postings are rebuilt in the workers at startup; the snapshot / compact files are not used).
+search_shards = int(os.getenv("SEARCH_SHARDS", 1))
+if search_shards > 1:
+    search_engine = ShardedSearchEngine(
+        None,
+        corpus_path=file_path,
+        num_shards=search_shards,
+        workers_per_shard=int(os.getenv("SEARCH_SHARD_WORKERS", 2)),
+        result_cache_size=int(os.getenv("RESULT_CACHE_SIZE", 1024)),
+        result_cache_ttl=float(os.getenv("RESULT_CACHE_TTL", 300)),
+        doc_store_path=doc_store_path,
+    )
+else:
+    search_engine = SearchEngine(
+        None,
+        corpus_path=file_path,
+        snapshot_path=snapshot_path,
+        compact_path=compact_path,
+        result_cache_size=int(os.getenv("RESULT_CACHE_SIZE", 1024)),
+        result_cache_ttl=float(os.getenv("RESULT_CACHE_TTL", 300)),
+        build_workers=int(os.getenv("INDEX_BUILD_WORKERS", 1)),
+        doc_store_path=doc_store_path,
+    )
+# instantiate our in memory persistence
+# IP locations come from a local MaxMind database (GEOIP_DB_PATH, e.g. GeoLite2-City.mmdb)
+geoip_db_path = None
+if os.getenv("GEOIP_DB_PATH"):
+    geoip_db_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), os.getenv("GEOIP_DB_PATH"))
+# Analytics events are written in the background to ANALYTICS_DIR/events.sqlite
+analytics_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), os.getenv("ANALYTICS_DIR", "data/analytics"))
+analytics_data = AnalyticsData(
+    GeoLocator(geoip_db_path),
+    EventLog(os.path.join(analytics_dir, "events.sqlite")),
+    max_events=int(os.getenv("ANALYTICS_MAX_EVENTS", 10_000)),
+    session_timeout=float(os.getenv("SESSION_IDLE_TIMEOUT", 30 * 60)),
+    max_sessions=int(os.getenv("ANALYTICS_MAX_SESSIONS", 100_000)),
+)
+# Requests that are not user activity are not recorded, busy routes can be sampled:
+# ANALYTICS_EXCLUDE adds endpoints to exclude, ANALYTICS_SAMPLE_RATES is "endpoint=rate,..." (e.g. "index=0.1")
+request_policy = RequestPolicy(
+    excluded_endpoints=(
+        "static", "health", "rag_status", "rag_cancel", "plot_number_of_views", "cache_stats", "latency_stats",
+        *filter(None, (e.strip() for e in os.getenv("ANALYTICS_EXCLUDE", "").split(","))),
+    ),
+    sample_rates=RequestPolicy.parse_rates(os.getenv("ANALYTICS_SAMPLE_RATES")),
+)
+request_latencies = LatencyHistograms()
+# instantiate RAG generator
+# Answers are cached by query + retrieved products (RAG_CACHE_PATH keeps them on disk across restarts)
+rag_cache_path = None
+if os.getenv("RAG_CACHE_PATH"):
+    rag_cache_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), os.getenv("RAG_CACHE_PATH"))
+rag_generator = RAGGenerator(cache=RAGResponseCache(
+    maxsize=int(os.getenv("RAG_CACHE_SIZE", 512)),
+    ttl=float(os.getenv("RAG_CACHE_TTL", 3600)),
+    path=rag_cache_path,
+    max_rows=int(os.getenv("RAG_CACHE_MAX_ROWS", 100_000)),
+))
+# RAG answers are generated in the background and polled by the results page
+rag_jobs = RAGJobManager(rag_generator, max_workers=int(os.getenv("RAG_WORKERS", 4)))
+
+corpus = search_engine.corpus
+# Historical reports read a columnar copy of the event log, partitioned by day in ANALYTICS_DIR/columnar,
+# synced in the background every ANALYTICS_SYNC_INTERVAL seconds
+analytics_reports = AnalyticsReports(
+    ColumnarStore(
+        os.path.join(analytics_dir, "columnar"),
+        analytics_data.event_log,
+        sync_interval=float(os.getenv("ANALYTICS_SYNC_INTERVAL", 60)),
+    ),
+    category_of=lambda doc_id: corpus[doc_id].category if doc_id in corpus else None,
+)
 # Log first element of corpus to verify it loaded correctly:
 print("\nCorpus is loaded \n")#, list(corpus.values())[0])
 
-# Instantiate our search engine (creating the indexes with the corpus)
-search_engine = SearchEngine(corpus)
-
 # Home URL "/"
 @app.route('/')
 def index():
@@ -70,25 +162,51 @@ def index():
 
 @app.before_request
 def log_request():
-    # Ensure session has unique ID
+    g.request_start = time.perf_counter()
+    # Static files, health checks, RAG polls... are not user activity (see request_policy)
+    if request_policy.is_excluded(request.endpoint, request.path):
+        return
+
+    # Ensure session has unique ID (open in the session store from its first request)
     if "session_id" not in session:
-        import uuid
-        session["session_id"] = str(uuid.uuid4())
+        session["session_id"] = analytics_data.start_session()
 
-    # Update physical session
-    session["session_id"] = analytics_data.update_physical_session(session["session_id"])
+    # Update physical session (the cookie is only rewritten when the session changes), also for the
+    # requests that are not recorded: they are still activity of the visitor
+    session_id = analytics_data.update_physical_session(session["session_id"])
+    if session_id != session["session_id"]:
+        session["session_id"] = session_id
+
+    # Requests of sampled routes that are not recorded
+    weight = request_policy.weight(request.endpoint, request.path)
+    if not weight:
+        return
 
     # Save HTTP request
-    analytics_data.save_http_request(request, session["session_id"])
+    analytics_data.save_http_request(request, session_id, weight)
+
+
+@app.after_request
+def record_latency(response):
+    start = g.pop("request_start", None)
+    if start is not None:
+        request_latencies.add(request.endpoint or "unmatched", (time.perf_counter() - start) * 1000)
+    return response
+
+
+@app.route('/health', methods=['GET'])
+def health():
+    return jsonify({"status": "ok"})
+
 
-    
-    
 @app.route('/search', methods=['POST'])
 def search_form_post():
     # Query de la cerca
     search_query = request.form['search-query'].strip()
 
     page = int(request.form.get('page', 1))
+    # Structured filters (price, discount, rating, stock, brand, category)
+    filters = SearchFilters.from_form(request.form)
 
     # Ensure session has unique ID
     if "session_id" not in session:
@@ -100,24 +218,21 @@ def search_form_post():
     analytics_data.compute_dwell(session_id)
 
     mission_id = analytics_data.assign_mission(session_id, search_query)
-    query_id = len(analytics_data.fact_queries)
+    query_id = analytics_data.num_queries
 
     session['last_search_query'] = search_query
     session['last_mission_id'] = mission_id
     session['last_search_page'] = page
+    session['last_search_filters'] = filters.to_form()
 
-    # 3️ Perform search (llista completa de resultats)
-    results = search_engine.search(search_query, query_id, corpus)
-
-    # 4️ Save results ranking
-    results_with_rank = [(doc.pid, idx + 1) for idx, doc in enumerate(results)]
-    analytics_data.save_results(session_id, search_query, results_with_rank)
+    # 3️ Perform search (only the ranking up to the requested page + the total number of hits)
+    results = search_engine.search_top_k(search_query, query_id, max(page, 1) * PER_PAGE, filters)
 
-    # 5️ Generate RAG response
-    rag_response = rag_generator.generate_response(search_query, results)
+    # 4️ Start the RAG response (the page polls it, so the results are sent without waiting for the LLM)
+    rag_job_id = rag_jobs.submit(search_query, results)
 
     # Comptador total
-    found_count = len(results)
+    found_count = results.total_hits
     session['last_found_count'] = found_count
 
     # Pagination
@@ -128,9 +243,12 @@ def search_form_post():
     elif page > total_pages:
         page = total_pages
 
-    start_idx = (page - 1) * PER_PAGE
-    end_idx = start_idx + PER_PAGE
-    page_results = results[start_idx:end_idx]
+    page_results = results.page(page, PER_PAGE)
+    # Impressions of the page that is rendered
+    analytics_data.save_results(
+        session_id, search_query, results, query_id=query_id, page=page, per_page=PER_PAGE,
+        ranking_key=search_engine.ranking_key(search_query, filters),
+    )
 
     pages = []
 
@@ -155,11 +273,13 @@ def search_form_post():
         results_list=page_results,
         page_title="Results",
         found_counter=found_count,
-        rag_response=rag_response,
+        rag_job_id=rag_job_id,
         search_query=search_query,
         page=page,
         total_pages=total_pages,
         pages=pages,
+        filters=filters.to_form(),
+        facets=results.facets or {},
     )
 
 @app.route('/last_search', methods=['GET'])
@@ -169,6 +289,7 @@ def last_search():
         return redirect(url_for('index'))
 
     page = int(session.get('last_search_page', 1))
+    filters = SearchFilters.from_form(session.get('last_search_filters', {}))
 
     if "session_id" not in session:
         import uuid
@@ -176,17 +297,15 @@ def last_search():
     session_id = session["session_id"]
     analytics_data.compute_dwell(session_id)
     mission_id = analytics_data.assign_mission(session_id, search_query)
-    query_id = len(analytics_data.fact_queries)
+    query_id = analytics_data.num_queries
 
     session['last_search_query'] = search_query
     session['last_mission_id'] = mission_id
     session['last_search_page'] = page
 
-    results = search_engine.search(search_query, query_id, corpus)
-    results_with_rank = [(doc.pid, idx + 1) for idx, doc in enumerate(results)]
-    analytics_data.save_results(session_id, search_query, results_with_rank)
-    rag_response = rag_generator.generate_response(search_query, results)
-    found_count = len(results)
+    results = search_engine.search_top_k(search_query, query_id, max(page, 1) * PER_PAGE, filters)
+    rag_job_id = rag_jobs.submit(search_query, results)
+    found_count = results.total_hits
     session['last_found_count'] = found_count
 
     total_pages = max(1, math.ceil(found_count / PER_PAGE)) if found_count else 1
@@ -195,9 +314,12 @@ def last_search():
     elif page > total_pages:
         page = total_pages
 
-    start_idx = (page - 1) * PER_PAGE
-    end_idx = start_idx + PER_PAGE
-    page_results = results[start_idx:end_idx]
+    page_results = results.page(page, PER_PAGE)
+    # Impressions of the page that is rendered
+    analytics_data.save_results(
+        session_id, search_query, results, query_id=query_id, page=page, per_page=PER_PAGE,
+        ranking_key=search_engine.ranking_key(search_query, filters),
+    )
 
     pages = []
     if total_pages <= 7:
@@ -222,14 +344,46 @@ def last_search():
         results_list=page_results,
         page_title="Results",
         found_counter=found_count,
-        rag_response=rag_response,
+        rag_job_id=rag_job_id,
         search_query=search_query,
         page=page,
         total_pages=total_pages,
         pages=pages,
+        filters=filters.to_form(),
+        facets=results.facets or {},
     )
 
     
+@app.route('/rag/<job_id>', methods=['GET'])
+def rag_status(job_id):
+    """Status and text generated so far of a RAG job (polled by the results page)."""
+    status = rag_jobs.status(job_id)
+    if status is None:
+        return jsonify({"id": job_id, "status": "expired", "text": "", "done": True}), 404
+    return jsonify(status)
+
+
+@app.route('/rag/<job_id>/cancel', methods=['POST'])
+def rag_cancel(job_id):
+    """Cancel a RAG job, sent by the results page (navigator.sendBeacon) when the user leaves it."""
+    return jsonify({"id": job_id, "cancelled": rag_jobs.cancel(job_id)})
+
+
+@app.route('/cache_stats', methods=['GET'])
+def cache_stats():
+    """Hit rates of the search result cache and of the RAG response cache."""
+    return jsonify({
+        "search": search_engine.cache_stats(),
+        "rag": rag_generator.cache.stats() if rag_generator.cache is not None else None,
+    })
+
+
+@app.route('/latency_stats', methods=['GET'])
+def latency_stats():
+    """Latency histograms per route."""
+    return jsonify(request_latencies.stats())
+
+
 @app.route('/doc_details', methods=['GET'])
 def doc_details():
     """
@@ -275,86 +429,21 @@ def stats():
     if session_id:
         analytics_data.compute_dwell(session_id)
 
-    # Data
+    # Precomputed views (see Aggregates), the raw logs only hold the last events
     document_stats = analytics_data.get_document_stats()
     query_stats = analytics_data.get_query_stats()
-    raw_queries = analytics_data.fact_queries
-    http_requests = analytics_data.fact_http
+    mission_stats = analytics_data.get_mission_stats()
+    raw_queries = _latest(analytics_data.fact_queries, STATS_ROWS)
     sessions = analytics_data.fact_sessions
-    dwell_events = analytics_data.fact_dwell
-
-    # Summary global
-    total_clicks = sum(d["clicks"] for d in document_stats)
-    total_docs_clicked = len(document_stats)
-
-    total_dwell_events = len(dwell_events)
-    total_dwell_time = sum(e["dwell_time"] for e in dwell_events) if total_dwell_events else 0
-    avg_dwell_global = total_dwell_time / total_dwell_events if total_dwell_events else 0
-
-    total_queries = len(raw_queries)
-    unique_queries = len({q["query"] for q in raw_queries}) if raw_queries else 0
-
-    total_sessions = len(sessions)
-    total_requests = len(http_requests)
-
-    method_counts = Counter(r["method"] for r in http_requests) if http_requests else {}
-
-    summary = {
-        "total_clicks": total_clicks,
-        "total_docs_clicked": total_docs_clicked,
-        "total_dwell_events": total_dwell_events,
-        "total_dwell_time": total_dwell_time,
-        "avg_dwell_time": avg_dwell_global,
-        "total_queries": total_queries,
-        "unique_queries": unique_queries,
-        "total_sessions": total_sessions,
-        "total_requests": total_requests,
-    }
-
-    # Missions
-    missions = {}
-    for q in raw_queries:
-        mission_id = q.get("mission_id")
-        if not mission_id:
-            continue
-
-        m = missions.setdefault(
-            mission_id,
-            {
-                "mission_id": mission_id,
-                "session_id": q["session_id"],
-                "queries": [],
-                "start": q["timestamp"],
-                "end": q["timestamp"],
-            },
-        )
-        m["queries"].append(q["query"])
-        if q["timestamp"] < m["start"]:
-            m["start"] = q["timestamp"]
-        if q["timestamp"] > m["end"]:
-            m["end"] = q["timestamp"]
-
-    for m in missions.values():
-        m["num_queries"] = len(m["queries"])
-        m["unique_queries"] = len(set(m["queries"]))
-        if m["start"] and m["end"]:
-            m["duration_seconds"] = (m["end"] - m["start"]).total_seconds()
-        else:
-            m["duration_seconds"] = 0
-
-    mission_list = sorted(missions.values(), key=lambda x: x["start"]) if missions else []
 
-    mission_summary = {
-        "total_missions": len(mission_list),
-        "avg_queries_per_mission": (
-            sum(m["num_queries"] for m in mission_list) / len(mission_list)
-        ) if mission_list else 0,
-    }
+    summary = analytics_data.aggregates.summary()
+    summary["total_sessions"] = len(sessions)
 
     http_stats = {
-        "requests": http_requests,
-        "sessions": sessions,
-        "method_counts": method_counts,
+        "requests": _latest(analytics_data.fact_http, STATS_ROWS),
+        "sessions": sessions.recent(STATS_ROWS),
+        "num_sessions": len(sessions),
+        "method_counts": analytics_data.aggregates.http_stats()["method_counts"],
     }
 
     return render_template(
@@ -365,10 +454,7 @@ def stats():
         raw_queries=raw_queries,
         http_stats=http_stats,
         summary=summary,
-        mission_stats={
-            "summary": mission_summary,
-            "missions": mission_list,
-        },
+        mission_stats=mission_stats,
     )
 
 
@@ -393,8 +479,7 @@ def dashboard():
     query_stats = analytics_data.get_query_stats()
 
     # HTTP stats
-    http_requests = analytics_data.fact_http or []
-    sessions = analytics_data.fact_sessions or {}
+    sessions = analytics_data.fact_sessions
 
     # Actual session
     current_session = sessions.get(session_id, {
@@ -403,23 +488,80 @@ def dashboard():
         "missions": []
     })
 
-    # User-agents
-    user_agents = [str(r.get("user_agent", "Unknown")) for r in analytics_data.fact_http]
+    # Historical reports (last 24 hours, as of the last background sync)
+    since = time.time() - 24 * 3600
+    reports = {
+        "ctr_by_rank": _records(analytics_reports.ctr_by_rank(start=since, max_rank=2 * PER_PAGE)),
+        "queries_per_hour": _records(analytics_reports.time_buckets("queries", "1h", start=since)),
+        "dwell_by_category": _records(analytics_reports.dwell_by_category(start=since)),
+        "zero_result_queries": _records(analytics_reports.zero_result_queries(start=since, limit=10)),
+    }
 
     return render_template(
         "dashboard.html",
         page_title="Analytics Dashboard",
         ranked_docs=enhanced_docs,
         query_stats=query_stats,
-        http_stats={
-            "requests": analytics_data.fact_http,
-            "sessions": sessions,
-            "user_agents": user_agents,
-        },
+        http_stats=dict(
+            analytics_data.aggregates.http_stats(),
+            sessions=sessions.recent(STATS_ROWS),
+            num_sessions=len(sessions),
+        ),
         current_session=current_session,
+        reports=reports,
     )
 
 
+def _latest(events, n):
+    """The last n events of a log (deque), the latest first."""
+    return list(itertools.islice(reversed(events), n))
+
+
+def _records(frame):
+    """JSON-ready rows of a report DataFrame (dates as ISO strings)."""
+    return json.loads(frame.to_json(orient="records", date_format="iso"))
+
+
+def _report_time(value):
+    """
+    Unix seconds of a report bound given as Unix seconds or as an ISO date (UTC unless it has an
+    offset, as the report dates), None when missing.
+    """
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return pd.Timestamp(value).timestamp()
+
+
+@app.route('/analytics/<report>', methods=['GET'])
+def analytics_report(report):
+    """
+    Historical report as JSON: ctr_by_rank, dwell_by_category, zero_result_queries or time_buckets.
+    Filters: start / end (Unix seconds or ISO date), session; time_buckets also takes table and bucket.
+    The events are the ones synced by the background thread of the columnar store.
+    """
+    try:
+        filters = {
+            "start": _report_time(request.args.get("start")),
+            "end": _report_time(request.args.get("end")),
+            "session_id": request.args.get("session") or None,
+        }
+        if report == "time_buckets":
+            table = request.args.get("table", "queries")
+            if table not in SCHEMAS:
+                return jsonify({"error": f"unknown table {table}"}), 400
+            result = analytics_reports.time_buckets(table, request.args.get("bucket", "1h"), **filters)
+        elif report in ("ctr_by_rank", "dwell_by_category", "zero_result_queries"):
+            result = getattr(analytics_reports, report)(**filters)
+        else:
+            return jsonify({"error": f"unknown report {report}"}), 404
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify(_records(result))
+
+
 
 # New route added for generating an examples of basic Altair plot (used for dashboard)
 @app.route('/plot_number_of_views', methods=['GET'])